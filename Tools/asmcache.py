@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import hashlib
+from collections import OrderedDict
+
+import assembler
+
+
+# The version of the assembler output, part of every cache key
+# Bump this whenever a change to the assembler would produce different objects for the same source
+AssemblerVersion = "2"
+
+
+# The result of assembling a program, holding everything the emulator needs from the assembler
+class Assembly:
+    def __init__(self, objects, symbols, source_lines=None):
+        self.objects = objects
+        self.symbol_table = symbols
+        self.source_lines = source_lines
+    
+    
+    # Makes an assembly from an assembler that has been run
+    @staticmethod
+    def from_assembler(asm):
+        return Assembly(asm.assembled_objects(), asm.symbols(), asm.source_map())
+    
+    
+    # Makes an assembly from a loaded .f80bin image
+    @staticmethod
+    def from_image(image):
+        source_map = image.source_map()
+        if source_map is not None:
+            source_map = [None if line == 0 else line for line in source_map]
+        return Assembly(image.instructions(), image.symbols(), source_map)
+    
+    
+    # A helper to get the assembled objects
+    def assembled_objects(self):
+        return self.objects
+    
+    
+    # A helper to get the symbol table as a {name : value} dict
+    def symbols(self):
+        return dict(self.symbol_table)
+    
+    
+    # A helper to get the source line of each instruction (None if it isn't known)
+    def source_map(self):
+        return self.source_lines
+    
+    
+    # A helper function to return the processed assembly in it's human-readable symbolic form
+    def processed_assembly(self):
+        return assembler.disassemble(self.objects)
+    
+    
+    # Writes the assembled program to a .f80bin file
+    def write_binary(self, file_out):
+        assembler.write_binary(file_out, self.objects, symbols=self.symbol_table, source_map=self.source_lines)
+
+
+
+# A cache of assembled programs, keyed by a hash of the source text and the assembler version
+# It keeps an in-process LRU, and optionally stores assemblies on disk as .f80bin files
+class AssemblyCache:
+    def __init__(self, max_entries=64, directory=None, max_disk_entries=1024):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.set_directory(directory)
+        self.reset_stats()
+    
+    
+    # Sets the directory for the on-disk store (None to disable it)
+    def set_directory(self, directory):
+        self.directory = directory
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+    
+    
+    # Resets the hit and miss counters
+    def reset_stats(self):
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+    
+    
+    # Returns the hit and miss counters
+    def stats(self):
+        return { "hits"           : self.hits,
+                 "disk_hits"      : self.disk_hits,
+                 "misses"         : self.misses,
+                 "evictions"      : self.evictions,
+                 "disk_evictions" : self.disk_evictions,
+                 "entries"        : len(self.entries) }
+    
+    
+    # Forgets every in-process entry (the on-disk store is kept)
+    def clear(self):
+        self.entries.clear()
+    
+    
+    # Returns the cache key for some source text
+    def key(self, source):
+        digest = hashlib.sha256()
+        digest.update("fet80-asm:{}:{}\n".format(AssemblerVersion, assembler.BinaryFormat.Version).encode("utf-8"))
+        digest.update(source)
+        return digest.hexdigest()
+    
+    
+    # Returns the path of an entry in the on-disk store
+    def disk_path(self, key):
+        return os.path.join(self.directory, key + ".f80bin")
+    
+    
+    # Adds an entry to the in-process LRU, evicting the least recently used entries past the limit
+    def remember(self, key, assembly):
+        self.entries[key] = assembly
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+    
+    
+    # Writes an entry to the on-disk store, removing the oldest entries past the limit
+    def store(self, key, assembly):
+        path = self.disk_path(key)
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        assembly.write_binary(temp_path)
+        os.replace(temp_path, path)
+        
+        stored = [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith(".f80bin")]
+        if len(stored) > self.max_disk_entries:
+            stored.sort(key=os.path.getmtime)
+            for old_path in stored[:len(stored) - self.max_disk_entries]:
+                try:
+                    os.remove(old_path)
+                    self.disk_evictions += 1
+                except FileNotFoundError:
+                    # Another process got to it first
+                    pass
+    
+    
+    # Tries to read an entry from the on-disk store
+    def load(self, key):
+        path = self.disk_path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with assembler.BinaryImage(path) as image:
+                assembly = Assembly.from_image(image)
+        except Exception:
+            # A damaged or foreign entry is just a miss
+            return None
+        # Mark it as recently used
+        os.utime(path)
+        return assembly
+    
+    
+    # Returns the assembly of a .f80asm file, only running the assembler if the source has not been seen before
+    def assemble(self, file_in):
+        with open(file_in, "rb") as f:
+            key = self.key(f.read())
+        
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        
+        if self.directory is not None:
+            assembly = self.load(key)
+            if assembly is not None:
+                self.disk_hits += 1
+                self.remember(key, assembly)
+                return assembly
+        
+        self.misses += 1
+        asm = assembler.Assembler(file_in)
+        asm.run()
+        assembly = Assembly.from_assembler(asm)
+        self.remember(key, assembly)
+        if self.directory is not None:
+            self.store(key, assembly)
+        return assembly
+
+
+# The cache used when loading programs into the emulator
+default_cache = AssemblyCache()
+
+
+if __name__ == '__main__':
+    print("This module is not meant to be run on it's own!")
+    sys.exit()
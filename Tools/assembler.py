@@ -2,7 +2,10 @@
 
 import os
 import sys
+import mmap
+import struct
 import argparse
+from array import array
 from enum import Enum
 
 import helpers
@@ -103,7 +106,351 @@ class Fet80Params:
                    "y" : 16 }
 
 
+# A class to encode assembled instruction objects as machine code
+# Each instruction is a 16 bit control word plus a value word (only meaningful when `src` is a direct value)
+# Control word bits: 0-2 are the instruction type, 3-6 the opcode, 7-9 the source + 1, and 10-11 the destination + 1 (0 means none)
+class MachineCode:
+    # The control word used for ROM words that hold no instruction (instruction type 7 is never used)
+    EmptyWord = 0x1FFF
+    
+    
+    # Encodes an instruction's (type, opcode, src, dest) into its control word
+    @staticmethod
+    def encode_kind(instruction_type, opcode, src, dest):
+        word = instruction_type.value | (opcode.value << 3)
+        if src is not None:
+            word |= (src.value + 1) << 7
+        if dest is not None:
+            word |= (dest.value + 1) << 10
+        return word
+    
+    
+    # Encodes an assembled instruction object into a (control word, value) pair
+    # Direct values are pre-overflowed the same way the register they end up in would
+    @staticmethod
+    def encode(instruction, data_bits=Fet80Params.DataWidth, address_bits=Fet80Params.AddressWidth):
+        word = MachineCode.encode_kind(instruction["type"], instruction["opcode"], instruction["src"], instruction["dest"])
+        
+        value = instruction["value"]
+        if value is not None:
+            if instruction["type"] in [AsmCodes.InstructionType.M_INSTRUCTION, AsmCodes.InstructionType.J_INSTRUCTION]:
+                value %= 2 ** address_bits
+            else:
+                value %= 2 ** data_bits
+        
+        return word, value
+    
+    
+    # Decodes a (control word, value) pair back into an instruction object
+    @staticmethod
+    def decode(word, value, address):
+        if word == MachineCode.EmptyWord:
+            return None
+        
+        src_code = (word >> 7) & 0b111
+        dest_code = (word >> 10) & 0b11
+        instruction = { "type" : AsmCodes.InstructionType(word & 0b111),
+                        "address" : address,
+                        "opcode" : AsmCodes.Opcode((word >> 3) & 0b1111),
+                        "value" : None,
+                        "src" : None if src_code == 0 else AsmCodes.Src(src_code - 1),
+                        "dest" : None if dest_code == 0 else AsmCodes.Dest(dest_code - 1) }
+        if instruction["src"] == AsmCodes.Src.DV:
+            instruction["value"] = value
+        return instruction
+
+
+
+# A class to describe the .f80bin binary program format
+# Layout (all little-endian):
+#   Header:   magic "F80B", format version, header size, data bits, address bits, instruction count, section count
+#   Words:    `count` control words (u16), padded to 4 bytes
+#   Values:   `count` value words (u16), padded to 4 bytes
+#   Sections: optional tagged blocks, each a 4 byte tag and a u32 payload size, then the payload padded to 4 bytes
+#             "SYMS" is the symbol table (per entry: u16 value, u8 name length, utf-8 name)
+#             "SMAP" is the source map (one u32 source line number per instruction, 0 if unknown)
+class BinaryFormat:
+    Magic = b"F80B"
+    Version = 1
+    
+    Header = struct.Struct("<4sHHBBxxII")
+    Section = struct.Struct("<4sI")
+    Symbol = struct.Struct("<HB")
+    
+    SymbolsTag = b"SYMS"
+    SourceMapTag = b"SMAP"
+    
+    
+    # Rounds a size up to the 4 byte alignment used between parts of the file
+    @staticmethod
+    def aligned(size):
+        return (size + 3) & ~3
+    
+    
+    # Tests if a file starts with the .f80bin magic
+    @staticmethod
+    def is_binary(file_in):
+        with open(file_in, "rb") as f:
+            return f.read(len(BinaryFormat.Magic)) == BinaryFormat.Magic
+
+
+
+# Writes assembled instruction objects to a .f80bin file, with optional symbols ({name : value}) and source map (list of line numbers)
+def write_binary(file_out, instructions, symbols=None, source_map=None, data_bits=Fet80Params.DataWidth, address_bits=Fet80Params.AddressWidth):
+    if data_bits > 16 or address_bits > 16:
+        raise Exception("The .f80bin format only supports widths up to 16 bits!")
+    
+    words = array("H")
+    values = array("H")
+    for i, instruction in enumerate(instructions):
+        if instruction["address"] != i:
+            raise Exception("Instructions must be contiguous from address 0! (address: {})".format(instruction["address"]))
+        word, value = MachineCode.encode(instruction, data_bits, address_bits)
+        words.append(word)
+        values.append(0 if value is None else value)
+    if sys.byteorder != "little":
+        words.byteswap()
+        values.byteswap()
+    
+    sections = list()
+    if symbols is not None:
+        payload = bytearray()
+        for name, value in symbols.items():
+            encoded_name = name.encode("utf-8")
+            payload += BinaryFormat.Symbol.pack(value % 2 ** 16, len(encoded_name)) + encoded_name
+        sections.append( (BinaryFormat.SymbolsTag, bytes(payload)) )
+    if source_map is not None:
+        lines = array("I", [0 if line is None else line for line in source_map])
+        if len(lines) != len(words):
+            raise Exception("The source map must have one line number per instruction!")
+        if sys.byteorder != "little":
+            lines.byteswap()
+        sections.append( (BinaryFormat.SourceMapTag, lines.tobytes()) )
+    
+    def padded(data):
+        return data + bytes(BinaryFormat.aligned(len(data)) - len(data))
+    
+    with open(file_out, "wb") as f:
+        f.write(BinaryFormat.Header.pack(BinaryFormat.Magic, BinaryFormat.Version, BinaryFormat.Header.size,
+                                         data_bits, address_bits, len(words), len(sections)))
+        f.write(padded(words.tobytes()))
+        f.write(padded(values.tobytes()))
+        for tag, payload in sections:
+            f.write(BinaryFormat.Section.pack(tag, len(payload)))
+            f.write(padded(payload))
+
+
+
+# A class to load a .f80bin file through `mmap`
+# The control and value words are exposed as zero-copy views of the mapped file
+# `close()` releases every view it handed out and unmaps the file, which can't be rebuilt on Windows while it is mapped
+class BinaryImage:
+    def __init__(self, file_in):
+        # Every memoryview of the map, which all have to be released before it can be closed
+        self.views = list()
+        self.source_lines = None
+        with open(file_in, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.parse(file_in)
+        except Exception:
+            self.close()
+            raise
+    
+    
+    # Reads the header, and makes views of the words and sections
+    def parse(self, file_in):
+        if len(self.map) < BinaryFormat.Header.size:
+            raise Exception("\"{}\" is too short to be a .f80bin file!".format(file_in))
+        magic, version, header_size, self.data_bits, self.address_bits, self.count, section_count = BinaryFormat.Header.unpack_from(self.map, 0)
+        if magic != BinaryFormat.Magic:
+            raise Exception("\"{}\" is not a .f80bin file!".format(file_in))
+        if version != BinaryFormat.Version:
+            raise Exception("\"{}\" uses .f80bin version {}, only version {} is supported!".format(file_in, version, BinaryFormat.Version))
+        
+        offset = BinaryFormat.aligned(header_size)
+        self.words = self.word_view(self.slice(offset, offset + 2 * self.count), "H")
+        offset += BinaryFormat.aligned(2 * self.count)
+        self.values = self.word_view(self.slice(offset, offset + 2 * self.count), "H")
+        offset += BinaryFormat.aligned(2 * self.count)
+        
+        self.sections = dict()
+        for _ in range(section_count):
+            tag, size = BinaryFormat.Section.unpack_from(self.map, offset)
+            offset += BinaryFormat.Section.size
+            self.sections[tag] = self.slice(offset, offset + size)
+            offset += BinaryFormat.aligned(size)
+    
+    
+    # Returns a view of part of the mapped file
+    def slice(self, start, end):
+        view = memoryview(self.map)[start:end]
+        self.views.append(view)
+        return view
+    
+    
+    # Returns a view of little-endian words, which is only a copy on big-endian machines
+    def word_view(self, view, typecode):
+        if sys.byteorder == "little":
+            words = view.cast(typecode)
+            self.views.append(words)
+            return words
+        words = array(typecode, view.tobytes())
+        words.byteswap()
+        return words
+    
+    
+    # Releases every view of the file and unmaps it, after which nothing can be read from the image
+    def close(self):
+        if self.map is None:
+            return
+        for view in reversed(self.views):
+            view.release()
+        self.views = list()
+        self.map.close()
+        self.map = None
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    
+    # Returns the instruction object at an address
+    def instruction(self, address):
+        return MachineCode.decode(self.words[address], self.values[address], address)
+    
+    
+    # Returns every instruction object in the program
+    def instructions(self):
+        return [self.instruction(address) for address in range(self.count)]
+    
+    
+    # Returns the symbol table as a {name : value} dict, or None if the file has none
+    def symbols(self):
+        if BinaryFormat.SymbolsTag not in self.sections:
+            return None
+        payload = self.sections[BinaryFormat.SymbolsTag]
+        symbols = dict()
+        offset = 0
+        while offset < len(payload):
+            value, length = BinaryFormat.Symbol.unpack_from(payload, offset)
+            offset += BinaryFormat.Symbol.size
+            symbols[bytes(payload[offset:offset + length]).decode("utf-8")] = value
+            offset += length
+        return symbols
+    
+    
+    # Returns the source line number of each instruction, or None if the file has no source map
+    def source_map(self):
+        if BinaryFormat.SourceMapTag not in self.sections:
+            return None
+        if self.source_lines is None:
+            self.source_lines = self.word_view(self.sections[BinaryFormat.SourceMapTag], "I")
+        return self.source_lines
+
+
+
+# The first words of each instruction type
+InstructionTypeWords = { "MOV"  : AsmCodes.InstructionType.T_INSTRUCTION,
+                         "MEM"  : AsmCodes.InstructionType.M_INSTRUCTION,
+                         "ADD"  : AsmCodes.InstructionType.C_INSTRUCTION,
+                         "NAND" : AsmCodes.InstructionType.C_INSTRUCTION,
+                         "JMP"  : AsmCodes.InstructionType.J_INSTRUCTION,
+                         "JC"   : AsmCodes.InstructionType.J_INSTRUCTION,
+                         "JNC"  : AsmCodes.InstructionType.J_INSTRUCTION,
+                         "JEQZ" : AsmCodes.InstructionType.J_INSTRUCTION,
+                         "JNEZ" : AsmCodes.InstructionType.J_INSTRUCTION,
+                         "JGTZ" : AsmCodes.InstructionType.J_INSTRUCTION,
+                         "JLTZ" : AsmCodes.InstructionType.J_INSTRUCTION,
+                         "JGEZ" : AsmCodes.InstructionType.J_INSTRUCTION,
+                         "JLEZ" : AsmCodes.InstructionType.J_INSTRUCTION,
+                         "NOP"  : AsmCodes.InstructionType.D_INSTRUCTION }
+
+
+# A single lexed line of assembly, the IR that every assembler pass works on
+# `symbol` is set for M, J and L instructions, `dest` and `src` for T and C instructions
+# A line that failed to lex keeps its error message, which is raised when the first pass reaches it
+class AsmLine:
+    __slots__ = ["text", "source_line", "type", "opcode", "symbol", "dest", "src", "error"]
+    
+    def __init__(self, text, source_line):
+        self.text = text
+        self.source_line = source_line
+        self.type = None
+        self.opcode = None
+        self.symbol = None
+        self.dest = None
+        self.src = None
+        self.error = None
+    
+    
+    # Raises the lexing error of the line, if it has one
+    def check(self):
+        if self.error is not None:
+            raise Exception(self.error)
+
+
+# Strips newlines, whitespace and comments from a line of source, returning an empty string if nothing is left
+def strip_line(text):
+    stripped_line = text.replace("\n", "").replace("\r", "")
+    stripped_line = stripped_line.replace("\t", " ").strip()
+    
+    comment_index = stripped_line.find("#")
+    if comment_index != -1:
+        # Remove comment from index onwards
+        return stripped_line[:comment_index].strip()
+    # No comments to remove
+    return stripped_line
+
+
+# Lexes a single stripped line into an `AsmLine`
+# Types:
+# T_INSTRUCTION for a `MOV` command
+# M_INSTRUCTION for a `MEM` command
+# C_INSTRUCTION for an `ADD` or `NAND` command
+# J_INSTRUCTION for a jump command (`JMP`, `JC`, `JNC`, `JEQZ`, `JNEZ`, `JGTZ`, `JLTZ`, `JGEZ`, `JLEZ`)
+# D_INSTRUCTION for a `NOP` command
+# L_INSTRUCTION for `(xxx)`, where xxx is a symbol
+def lex_line(text, source_line=None):
+    line = AsmLine(text, source_line)
+    
+    if text[0] == "(":
+        # Remove ( and ) in (xxx)
+        line.type = AsmCodes.InstructionType.L_INSTRUCTION
+        line.symbol = text.replace("(", "").replace(")", "")
+        return line
+    
+    words = [word for word in text.split(" ") if word]
+    line.opcode = words[0].upper()
+    line.type = InstructionTypeWords.get(text.split(" ")[0].upper())
+    if line.type is None:
+        line.error = "Current command isn't a known instruction type, no symbol to extract!"
+    elif line.type in [AsmCodes.InstructionType.M_INSTRUCTION, AsmCodes.InstructionType.J_INSTRUCTION]:
+        # Will always be in the format `OP xxx`
+        if len(words) != 2:
+            line.error = "This instruction requires exactly 1 argument: \"{}\"".format(text)
+        else:
+            line.symbol = words[1]
+    elif line.type in [AsmCodes.InstructionType.T_INSTRUCTION, AsmCodes.InstructionType.C_INSTRUCTION]:
+        # Will always be in the format `OP dest, src`
+        parts = list()
+        for word in words:
+            parts += [part for part in word.split(",") if part]
+        if len(parts) != 3:
+            line.error = "This instruction requires exactly 2 arguments: \"{}\"".format(text)
+        else:
+            line.dest = parts[1]
+            line.src = parts[2]
+    
+    return line
+
+
 # Define parser class to parse assembly files into a usable format
+# Every line is lexed exactly once into an `AsmLine`, and the cursor functions just read those records
 class AsmParser:
     # Opens the input file / stream and gets ready to parse it
     def __init__(self, file_in):
@@ -118,25 +465,22 @@ class AsmParser:
         self.current_address = -1
     
     
-    # Helper to set the stripped source text of the parser (list of strings)
+    # Helper to set the source text of the parser (list of strings), lexing it into `lines`
     def set_source(self, source_text):
         self.source = source_text
-        # Strip source of newlines, whitespace, and comments
-        self.stripped = []
-        for x in self.source:
-            stripped_line = x.replace("\n", "").replace("\r", "")
-            stripped_line = stripped_line.replace("\t", " ").strip()
-            
-            comment_index = stripped_line.find("#")
-            if comment_index != -1:
-                # Remove comment from index onwards
-                final_line = stripped_line[:comment_index].strip()
-            else:
-                # No comments to remove
-                final_line = stripped_line
-            
-            if len(final_line) > 0:
-                self.stripped.append(final_line)
+        self.lines = list()
+        for i, text in enumerate(self.source):
+            stripped_line = strip_line(text)
+            if len(stripped_line) > 0:
+                self.lines.append(lex_line(stripped_line, i + 1))
+        self.stripped = [line.text for line in self.lines]
+    
+    
+    # Helper to set the lexed lines of the parser directly
+    def set_lines(self, lines):
+        self.lines = lines
+        self.stripped = [line.text for line in self.lines]
+    
     
     # Helper function to "reset" the parser
     def reset(self):
@@ -146,23 +490,13 @@ class AsmParser:
     
     # Are there more lines in the input?
     def hasMoreLines(self):
-        if self.current_line_idx == -1:
-            # If not advanced to first instruction
-            return True
-        elif self.current_line_idx < len(self.stripped)-1:
-            # If our current index is less than the last possible
-            return True
-        else:
-            return False
+        return self.current_line_idx < len(self.lines)-1
     
     
-    # Skips over white space and comments if necessary.
     # Reads the next instruction from the input, and makes it the current instruction.
     # This routine should be called only if hasMoreLines is true.
     # Initially, there is no current instruction.
     def advance(self):
-        # All white space and comments were pre-skipped during __init__
-        # The "current instruction" is just an index to a list of stripped lines
         if self.hasMoreLines():
             self.current_line_idx += 1
             # Also increment the address counter ONLY if it is not a loop instruction
@@ -172,12 +506,22 @@ class AsmParser:
             raise Exception("No more lines left in program!")
     
     
+    # A helper function to get the current lexed line
+    def line(self):
+        if  self.current_line_idx == -1:
+            raise Exception("No advance() command issued yet!")
+        
+        line = self.lines[self.current_line_idx]
+        line.check()
+        return line
+    
+    
     # A helper function to get the current instruction
     def instruction(self):
         if  self.current_line_idx == -1:
             raise Exception("No advance() command issued yet!")
-            
-        return self.stripped[self.current_line_idx]
+        
+        return self.lines[self.current_line_idx].text
     
     
     # Helper function to get the current instruction address
@@ -185,98 +529,40 @@ class AsmParser:
         return self.current_address
     
     
-    # Returns the type of the current instruction:
-    # T_INSTRUCTION for a `MOV` command
-    # M_INSTRUCTION for a `MEM` command
-    # C_INSTRUCTION for an `ADD` or `NAND` command
-    # J_INSTRUCTION for a jump command (`JMP`, `JC`, `JNC`, `JEQZ`, `JNEZ`, `JGTZ`, `JLTZ`, `JGEZ`, `JLEZ`)
-    # D_INSTRUCTION for a `NOP` command
-    # L_INSTRUCTION for `(xxx)`, where xxx is a symbol
+    # Returns the type of the current instruction (see `lex_line`)
     def instructionType(self):
-        first_char = self.instruction()[0]
-        first_word = self.instruction().split(" ")[0].upper()
-        if first_char == "(":
-            return AsmCodes.InstructionType.L_INSTRUCTION
-        elif first_word == "MOV":
-            return AsmCodes.InstructionType.T_INSTRUCTION
-        elif first_word == "MEM":
-            return AsmCodes.InstructionType.M_INSTRUCTION
-        elif first_word in ["ADD", "NAND"]:
-            return AsmCodes.InstructionType.C_INSTRUCTION
-        elif first_word in ["JMP", "JC", "JNC", "JEQZ", "JNEZ", "JGTZ", "JLTZ", "JGEZ", "JLEZ"]:
-            return AsmCodes.InstructionType.J_INSTRUCTION
-        elif first_word == "NOP":
-            return AsmCodes.InstructionType.D_INSTRUCTION
-        else:
-            raise Exception("Current command isn't a known instruction type, no symbol to extract!")
-    
-    
-    # Helper function to get the current instruction, split at the chosen delimiter
-    def instruction_split(self, text=None, delimiter=" "):
-        if text is None:
-            text = self.instruction()
-        
-        if type(text) == list:
-            final_list = []
-            for part in text:
-                final_list += list(filter(None, part.split(delimiter)))
-            return final_list
-        else:
-            return list(filter(None, text.split(delimiter)))
+        return self.line().type
     
     
     # If the current instruction is `(xxx)`, returns the symbol `xxx`.
     # If the current instruction is `JMP xxx` or `MEM xxx`, returns the symbol or decimal xxx (as a string).
     # Should be called only if instructionType is M_INSTRUCTION, J_INSTRUCTION, or L_INSTRUCTION
     def symbol(self):
-        current_instruction_type = self.instructionType()
-        if current_instruction_type in [AsmCodes.InstructionType.M_INSTRUCTION, AsmCodes.InstructionType.J_INSTRUCTION]:
-            # Will always be in the format `OP xxx`, can just take last portion
-            split_instruction = self.instruction_split()
-            if len(split_instruction) != 2:
-                raise Exception("This instruction requires exactly 1 argument: \"{}\"".format(self.instruction()))
-            return split_instruction[1]
-        elif current_instruction_type == AsmCodes.InstructionType.L_INSTRUCTION:
-            # Remove ( and ) in (xxx)
-            return self.instruction().replace("(", "").replace(")", "")
-        else:
+        if self.line().symbol is None:
             raise Exception("Current command isn't a valid instruction, no symbol to extract!")
+        return self.line().symbol
     
     
     # Returns the symbolic `src` part of the current instruction (3 possibilities or an int.)
     # Should only be called if instructionType is T_INSTRUCTION or C_INSTRUCTION
     def src(self):
-        if self.instructionType() in [AsmCodes.InstructionType.T_INSTRUCTION, AsmCodes.InstructionType.C_INSTRUCTION]:
-            # Will always be in the format `OP xxx, yyy`, can just take the last portion
-            split_instruction = self.instruction_split()
-            split_instruction = self.instruction_split(split_instruction, ",")
-            if len(split_instruction) != 3:
-                raise Exception("This instruction requires exactly 2 arguments: \"{}\"".format(self.instruction()))
-            return split_instruction[2]
-        else:
+        if self.line().src is None:
             raise Exception("Current command isn't a valid instruction, no symbol to extract!")
+        return self.line().src
     
     
     # Returns the symbolic `dest` part of the current instruction (3 possibilities)
     # Should only be called if instructionType is T_INSTRUCTION or C_INSTRUCTION
     def dest(self):
-        if self.instructionType() in [AsmCodes.InstructionType.T_INSTRUCTION, AsmCodes.InstructionType.C_INSTRUCTION]:
-            # Will always be in the format `OP xxx, yyy`, can just take the middle part
-            split_instruction = self.instruction_split()
-            split_instruction = self.instruction_split(split_instruction, ",")
-            if len(split_instruction) != 3:
-                raise Exception("This instruction requires exactly 2 arguments: \"{}\"".format(self.instruction()))
-            return split_instruction[1]
-        else:
+        if self.line().dest is None:
             raise Exception("Current command isn't a valid instruction, no symbol to extract!")
+        return self.line().dest
     
     
     # Returns the symbolic `opcode` part of the current instruction
     # This can be called for any valid instruction
     def opcode(self):
-        # We just return the first part, always
-        split_instruction = self.instruction_split()
-        return split_instruction[0].upper()
+        return self.line().opcode
 
 
 
@@ -328,79 +614,95 @@ class Assembler:
         self.free_mem_loc = Fet80Params.FirstFreeMemLoc
         
         self.assembled_code_objects = None
+        self.source_lines = None
+    
+    
+    # Lexes a generated line of assembly, keeping the source line it came from
+    def generated_line(self, text, line):
+        return lex_line(strip_line(text), line.source_line)
     
     
-    # Preliminary pass to replace `@` indirect memory addressing with 2 commands
+    # Returns the `MEM` commands that leave the MAR pointing at an address expression like `x`, `@x` or `@@x`
+    # Each leading `@` adds one more `MEM M` after the `MEM` of the base symbol
+    def memory_chain(self, expression, line):
+        base = expression.lstrip("@")
+        levels = len(expression) - len(base)
+        chain = [self.generated_line("MEM {}".format(base), line)]
+        for _ in range(levels):
+            chain.append(self.generated_line("MEM M", line))
+        return chain
+    
+    
+    # Preliminary pass to replace `@` indirect memory addressing with `MEM` commands
+    # Every level of nesting is expanded at once, so this is a single linear pass
     def resolve_indirect_memory(self):
         fixed_indirect_memory = False
-        new_source = list()
-        while(self.asm.hasMoreLines()):
-            self.asm.advance()
+        new_lines = list()
+        for line in self.asm.lines:
+            line.check()
             
             # We need to check T, M, and C instructions for using `@` (valid)
             # We also should check for J instructions illegally using it here
             # Ignore NOP I guess
             
-            if self.asm.instructionType() in [AsmCodes.InstructionType.T_INSTRUCTION, AsmCodes.InstructionType.C_INSTRUCTION]:
-                src_indirect = ( self.asm.src()[0] == "@" )
-                dest_indirect = ( self.asm.dest()[0] == "@" )
+            if line.type in [AsmCodes.InstructionType.T_INSTRUCTION, AsmCodes.InstructionType.C_INSTRUCTION]:
+                src_indirect = ( line.src[0] == "@" )
+                dest_indirect = ( line.dest[0] == "@" )
                 if src_indirect and dest_indirect:
                     raise Exception("Only one memory location can be used per command!")
                 if src_indirect:
-                    new_source.append("MEM {}".format(self.asm.src()[1:]))
-                    new_source.append("{} {}, M".format(self.asm.opcode(), self.asm.dest()))
+                    new_lines += self.memory_chain(line.src[1:], line)
+                    new_lines.append(self.generated_line("{} {}, M".format(line.opcode, line.dest), line))
                     fixed_indirect_memory = True
                 elif dest_indirect:
-                    new_source.append("MEM {}".format(self.asm.dest()[1:]))
-                    new_source.append("{} M, {}".format(self.asm.opcode(), self.asm.src()))
+                    new_lines += self.memory_chain(line.dest[1:], line)
+                    new_lines.append(self.generated_line("{} M, {}".format(line.opcode, line.src), line))
                     fixed_indirect_memory = True
                 else:
-                    new_source.append(self.asm.instruction())
-            elif self.asm.instructionType() == AsmCodes.InstructionType.M_INSTRUCTION:
-                symbol_indirect = ( self.asm.symbol()[0] == "@" )
-                if symbol_indirect:
-                    new_source.append("MEM {}".format(self.asm.symbol()[1:]))
-                    new_source.append("MEM M")
+                    new_lines.append(line)
+            elif line.type == AsmCodes.InstructionType.M_INSTRUCTION:
+                if line.symbol[0] == "@":
+                    new_lines += self.memory_chain(line.symbol, line)
                     fixed_indirect_memory = True
                 else:
-                    new_source.append(self.asm.instruction())
-            elif self.asm.instructionType() == AsmCodes.InstructionType.J_INSTRUCTION:
-                if self.asm.symbol()[0] == "@":
-                    raise Exception("Cannot use `@` in a jump instruction: \"{}\"".format(self.asm.instruction()))
-                new_source.append(self.asm.instruction())
+                    new_lines.append(line)
+            elif line.type == AsmCodes.InstructionType.J_INSTRUCTION:
+                if line.symbol[0] == "@":
+                    raise Exception("Cannot use `@` in a jump instruction: \"{}\"".format(line.text))
+                new_lines.append(line)
             else:
-                new_source.append(self.asm.instruction())
+                new_lines.append(line)
+        
+        # Generated lines are checked after every written line, like the old one-level-per-pass expansion did
+        for line in new_lines:
+            line.check()
         
-        self.asm.set_source(new_source)
+        self.asm.set_lines(new_lines)
         self.asm.reset()
         
         return fixed_indirect_memory
     
     
-    # Performs multiple levels of resolving indirect memory until it is all flat
+    # Resolves every level of indirect memory until it is all flat
     def resolve_all_indirect_memory(self):
-        more_indirect_memory = True
-        while more_indirect_memory:
-            more_indirect_memory = self.resolve_indirect_memory()
+        self.resolve_indirect_memory()
     
     
     # Prunes redundant M instructions that have the same direct value
     def prune_redundant_m_direct(self):
         # Just do a pass where we keep track of the value of the last MEM command
         # If it was direct, and if the next MEM command that comes up has the same direct value, just do not copy that command.
-        new_source = list()
+        new_lines = list()
         last_mem_value = False
-        while(self.asm.hasMoreLines()):
-            self.asm.advance()
-            
+        for line in self.asm.lines:
             append_instruction = True
             # Check to see if we should not copy it
-            if self.asm.instructionType() == AsmCodes.InstructionType.M_INSTRUCTION:
+            if line.type == AsmCodes.InstructionType.M_INSTRUCTION:
                 # We will need to determine IF the value will be resolved into a direct value
                 # This can either be inherent or because it will be in the symbol table and therefore replaced
                 # The only non-direct options are registers (A or B) or RAM (M)
                 # So we really just need to test if it's in ["A", "B", "M"]
-                current_mem_value = self.asm.symbol()
+                current_mem_value = line.symbol
                 # Set to False whenever it is not a direct value
                 if current_mem_value in ["A", "B", "M"]:
                     current_mem_value = False
@@ -413,33 +715,46 @@ class Assembler:
                 last_mem_value = current_mem_value
                 
             if append_instruction:
-                new_source.append(self.asm.instruction())
+                new_lines.append(line)
         
-        self.asm.set_source(new_source)
+        self.asm.set_lines(new_lines)
         self.asm.reset()
     
     
     # Pre-assemble pass, add all L-instructions to the symbol table
     def resolve_loops(self):
-        while(self.asm.hasMoreLines()):
-            self.asm.advance()
-            if self.asm.instructionType() == AsmCodes.InstructionType.L_INSTRUCTION:
-                if self.asm.symbol()[0] == "@" or self.asm.symbol() in ["A", "B", "M"]:
-                    raise Exception("\"{}\" is not a valid symbol name!".format(self.asm.symbol()))
+        address = -1
+        for line in self.asm.lines:
+            if line.type == AsmCodes.InstructionType.L_INSTRUCTION:
+                if line.symbol == "" or line.symbol[0] == "@" or line.symbol in ["A", "B", "M"]:
+                    raise Exception("\"{}\" is not a valid symbol name!".format(line.symbol))
                 # If it's an L-instruction, make a new symbol that is the index of the next line in the program
-                self.asmtable.addEntry(self.asm.symbol(), self.asm.address()+1)
+                self.asmtable.addEntry(line.symbol, address+1)
+            else:
+                address += 1
         self.asm.reset()
     
     
     # Assembles the objects for the final codes
     def assemble_objects(self):
+        registers_src = { "A" : AsmCodes.Src.A,
+                          "B" : AsmCodes.Src.B,
+                          "M" : AsmCodes.Src.M }
+        registers_dest = { "A" : AsmCodes.Dest.A,
+                           "B" : AsmCodes.Dest.B,
+                           "M" : AsmCodes.Dest.M }
+        
         self.assembled_code_objects = list()
-        while(self.asm.hasMoreLines()):
-            self.asm.advance()
+        self.source_lines = list()
+        address = -1
+        for line in self.asm.lines:
+            if line.type == AsmCodes.InstructionType.L_INSTRUCTION:
+                continue
+            address += 1
             
             # Init the instruction output dict
-            instruction = { "type" : self.asm.instructionType(),
-                            "address" : self.asm.address(),
+            instruction = { "type" : line.type,
+                            "address" : address,
                             "opcode" : None,
                             "value" : None,
                             "src" : None,
@@ -449,114 +764,69 @@ class Assembler:
                 # Always a `MOV`, `ADD`, or `NAND` instruction
                 # Format: `MOV dest, src`
                 # `src` can be a direct value
+                instruction["opcode"] = AsmCodes.Opcode[line.opcode]
                 
-                if self.asm.opcode() == "MOV":
-                    instruction["opcode"] = AsmCodes.Opcode.MOV
-                elif self.asm.opcode() == "ADD":
-                    instruction["opcode"] = AsmCodes.Opcode.ADD
-                elif self.asm.opcode() == "NAND":
-                    instruction["opcode"] = AsmCodes.Opcode.NAND
-                
-                if self.asm.dest() == "A":
-                    instruction["dest"] = AsmCodes.Dest.A
-                elif self.asm.dest() == "B":
-                    instruction["dest"] = AsmCodes.Dest.B
-                elif self.asm.dest() == "M":
-                    instruction["dest"] = AsmCodes.Dest.M
+                if line.dest in registers_dest:
+                    instruction["dest"] = registers_dest[line.dest]
                 else:
                     # Not a valid option
-                    raise Exception("{} is not a valid destination!".format(self.asm.dest()))
+                    raise Exception("{} is not a valid destination!".format(line.dest))
                 
-                if self.asm.src() == "A":
-                    instruction["src"] = AsmCodes.Src.A
-                elif self.asm.src() == "B":
-                    instruction["src"] = AsmCodes.Src.B
-                elif self.asm.src() == "M":
-                    instruction["src"] = AsmCodes.Src.M
-                elif self.asmtable.contains(self.asm.src()):
+                if line.src in registers_src:
+                    instruction["src"] = registers_src[line.src]
+                elif self.asmtable.contains(line.src):
                     # It's a symbol
-                    instruction["value"] = self.asmtable.getAddress(self.asm.src())
+                    instruction["value"] = self.asmtable.getAddress(line.src)
                     instruction["src"] = AsmCodes.Src.DV
                 else:
                     # It may be a direct value
-                    value = self.dec_data.int_from_formatted(self.asm.src())
+                    value = self.dec_data.int_from_formatted(line.src)
                     if type(value) == bool:
-                         raise Exception("\"{}\" from \"{}\"is not a valid destination or integer!".format(self.asm.src(), self.asm.instruction()))
+                         raise Exception("\"{}\" from \"{}\"is not a valid destination or integer!".format(line.src, line.text))
                     instruction["value"] = value
                     instruction["src"] = AsmCodes.Src.DV
-                    
-                self.assembled_code_objects.append(instruction)
             elif instruction["type"] in [AsmCodes.InstructionType.M_INSTRUCTION, AsmCodes.InstructionType.J_INSTRUCTION]:
                 # Always either a `MEM` or a type of `JMP` instruction
                 # Format: `MEM symbol`
                 # We must resolve either the symbol or direct value
                 # Additionally, `MEM` can have a non-direct `src`, like `A` or even `M`
                 # Hex and binary values are allowed with 0x and 0b
-                
-                if self.asm.opcode() == "MEM":
-                    instruction["opcode"] = AsmCodes.Opcode.MEM
-                elif self.asm.opcode() == "JMP":
-                    instruction["opcode"] = AsmCodes.Opcode.JMP
-                elif self.asm.opcode() == "JC":
-                    instruction["opcode"] = AsmCodes.Opcode.JC
-                elif self.asm.opcode() == "JNC":
-                    instruction["opcode"] = AsmCodes.Opcode.JNC
-                elif self.asm.opcode() == "JEQZ":
-                    instruction["opcode"] = AsmCodes.Opcode.JEQZ
-                elif self.asm.opcode() == "JNEZ":
-                    instruction["opcode"] = AsmCodes.Opcode.JNEZ
-                elif self.asm.opcode() == "JGTZ":
-                    instruction["opcode"] = AsmCodes.Opcode.JGTZ
-                elif self.asm.opcode() == "JGTZ":
-                    instruction["opcode"] = AsmCodes.Opcode.JGTZ
-                elif self.asm.opcode() == "JLTZ":
-                    instruction["opcode"] = AsmCodes.Opcode.JLTZ
-                elif self.asm.opcode() == "JGEZ":
-                    instruction["opcode"] = AsmCodes.Opcode.JGEZ
-                elif self.asm.opcode() == "JLEZ":
-                    instruction["opcode"] = AsmCodes.Opcode.JLEZ
+                instruction["opcode"] = AsmCodes.Opcode[line.opcode]
                 
                 # Now we need to set the value
                 # Before anything, if it's `MEM`, check for non-direct values
                 # First, we will check to see if it is already in the symbol table
                 # If not, we will then check to see if it is a direct value,
                 # Finally, if it is a valid symbol name, add a new symbol to the table
-                
-                symbol_value = self.dec_address.int_from_formatted(self.asm.symbol())
-                
-                # If it's MEM and also a valid non-direct symbol, just pass `src`
-                if instruction["type"] == AsmCodes.InstructionType.M_INSTRUCTION:
-                    if self.asm.symbol() in ["A", "B", "M"]:
-                        if self.asm.symbol() == "A":
-                            instruction["src"] = AsmCodes.Src.A
-                        elif self.asm.symbol() == "B":
-                            instruction["src"] = AsmCodes.Src.B
-                        elif self.asm.symbol() == "M":
-                            instruction["src"] = AsmCodes.Src.M
-                        self.assembled_code_objects.append(instruction)
-                        continue
-                # If not skipped, it's a direct value
-                instruction["src"] = AsmCodes.Src.DV
-                
-                # Check the symbol table first
-                if self.asmtable.contains(self.asm.symbol()):
-                    # Use the symbol value
-                    instruction["value"] = self.asmtable.getAddress(self.asm.symbol())
-                # Check if it's a direct value then
-                elif type(symbol_value) != bool:
-                    instruction["value"] = symbol_value
-                # Finally, just add it to the symbol table if it is valid
+                if instruction["type"] == AsmCodes.InstructionType.M_INSTRUCTION and line.symbol in registers_src:
+                    # If it's MEM and also a valid non-direct symbol, just pass `src`
+                    instruction["src"] = registers_src[line.symbol]
                 else:
-                    if (self.asm.symbol() in ["A", "B", "M"]) or self.asm.symbol()[0] =="@":
-                        raise Exception("\"{}\" is not a valid symbol name!".format(self.asm.symbol()))
-                    self.asmtable.addEntry(self.asm.symbol(), self.free_mem_loc)
-                    self.free_mem_loc += 1
-                    instruction["value"] = self.asmtable.getAddress(self.asm.symbol())
-                self.assembled_code_objects.append(instruction)
+                    # Otherwise, it's a direct value
+                    instruction["src"] = AsmCodes.Src.DV
+                    
+                    # Check the symbol table first
+                    if self.asmtable.contains(line.symbol):
+                        # Use the symbol value
+                        instruction["value"] = self.asmtable.getAddress(line.symbol)
+                    else:
+                        # Check if it's a direct value then
+                        symbol_value = self.dec_address.int_from_formatted(line.symbol)
+                        if type(symbol_value) != bool:
+                            instruction["value"] = symbol_value
+                        # Finally, just add it to the symbol table if it is valid
+                        else:
+                            if (line.symbol in ["A", "B", "M"]) or line.symbol[0] =="@":
+                                raise Exception("\"{}\" is not a valid symbol name!".format(line.symbol))
+                            self.asmtable.addEntry(line.symbol, self.free_mem_loc)
+                            self.free_mem_loc += 1
+                            instruction["value"] = self.asmtable.getAddress(line.symbol)
             elif instruction["type"] == AsmCodes.InstructionType.D_INSTRUCTION:
                 # It is a `NOP`
                 instruction["opcode"] = AsmCodes.Opcode.NOP
-                self.assembled_code_objects.append(instruction)
+            
+            self.assembled_code_objects.append(instruction)
+            self.source_lines.append(line.source_line)
         self.asm.reset()
     
     
@@ -577,69 +847,60 @@ class Assembler:
     
     # A helper function to return the processed assembly in it's human-readable symbolic form
     def processed_assembly(self):
-        processed_asm = list()
-        for line in self.assembled_objects():
-            if line["opcode"] == AsmCodes.Opcode.NOP:
-                opcode_text = "NOP"
-            elif line["opcode"] == AsmCodes.Opcode.MOV:
-                opcode_text = "MOV"
-            elif line["opcode"] == AsmCodes.Opcode.MEM:
-                opcode_text = "MEM"
-            elif line["opcode"] == AsmCodes.Opcode.ADD:
-                opcode_text = "ADD"
-            elif line["opcode"] == AsmCodes.Opcode.NAND:
-                opcode_text = "NAND"
-            elif line["opcode"] == AsmCodes.Opcode.JMP:
-                opcode_text = "JMP"
-            elif line["opcode"] == AsmCodes.Opcode.JC:
-                opcode_text = "JC"
-            elif line["opcode"] == AsmCodes.Opcode.JNC:
-                opcode_text = "JNC"
-            elif line["opcode"] == AsmCodes.Opcode.JEQZ:
-                opcode_text = "JEQZ"
-            elif line["opcode"] == AsmCodes.Opcode.JNEZ:
-                opcode_text = "JNEZ"
-            elif line["opcode"] == AsmCodes.Opcode.JGTZ:
-                opcode_text = "JGTZ"
-            elif line["opcode"] == AsmCodes.Opcode.JLTZ:
-                opcode_text = "JLTZ"
-            elif line["opcode"] == AsmCodes.Opcode.JGEZ:
-                opcode_text = "JGEZ"
-            elif line["opcode"] == AsmCodes.Opcode.JLEZ:
-                opcode_text = "JLEZ"
-            
-            if line["src"] == AsmCodes.Src.DV:
-                source_text = str(line["value"])
-            elif line["src"] == AsmCodes.Src.A:
-                source_text = "A"
-            elif line["src"] == AsmCodes.Src.B:
-                source_text = "B"
-            elif line["src"] == AsmCodes.Src.M:
-                source_text = "M"
-            
-            if line["dest"] == AsmCodes.Dest.A:
-                dest_text = "A"
-            elif line["dest"] == AsmCodes.Dest.B:
-                dest_text = "B"
-            elif line["dest"] == AsmCodes.Dest.M:
-                dest_text = "M"
-            
-            if line["type"] == AsmCodes.InstructionType.D_INSTRUCTION:
-                line_text = "{}".format(opcode_text)
-            elif line["type"] in [AsmCodes.InstructionType.T_INSTRUCTION, AsmCodes.InstructionType.C_INSTRUCTION]:
-                line_text = "{} {}, {}".format(opcode_text, dest_text, source_text)
-            elif line["type"] in [AsmCodes.InstructionType.M_INSTRUCTION, AsmCodes.InstructionType.J_INSTRUCTION]:
-                line_text = "{} {}".format(opcode_text, source_text)
-                
-            processed_asm.append(line_text)
-        return processed_asm
+        return disassemble(self.assembled_objects())
+    
+    
+    # A helper to get the symbol table as a {name : value} dict
+    def symbols(self):
+        return dict(self.asmtable.table)
+    
+    
+    # A helper to get the source file line number of each assembled object
+    def source_map(self):
+        if self.source_lines is None:
+            raise Exception("Assembler hasn't been run yet!")
+        return self.source_lines
+    
+    
+    # Writes the assembled program to a .f80bin file
+    def write_binary(self, file_out):
+        write_binary(file_out, self.assembled_objects(), symbols=self.symbols(), source_map=self.source_map())
+
+
+
+# The text of each opcode, source and destination, for disassembly
+OpcodeText = {opcode : opcode.name for opcode in AsmCodes.Opcode}
+SrcText = {src : src.name for src in AsmCodes.Src if src != AsmCodes.Src.DV}
+DestText = {dest : dest.name for dest in AsmCodes.Dest}
+
 
+# Returns a single instruction object in its human-readable symbolic form
+def disassemble_instruction(line):
+    opcode_text = OpcodeText[line["opcode"]]
+    instruction_type = line["type"]
+    if instruction_type == AsmCodes.InstructionType.D_INSTRUCTION:
+        return opcode_text
+    
+    source_text = str(line["value"]) if line["src"] == AsmCodes.Src.DV else SrcText[line["src"]]
+    if instruction_type == AsmCodes.InstructionType.T_INSTRUCTION or instruction_type == AsmCodes.InstructionType.C_INSTRUCTION:
+        return "{} {}, {}".format(opcode_text, DestText[line["dest"]], source_text)
+    return "{} {}".format(opcode_text, source_text)
 
 
-def main(asm_file):
+# Returns a list of instruction objects in their human-readable symbolic form
+def disassemble(instructions):
+    return [disassemble_instruction(line) for line in instructions]
+
+
+
+def main(asm_file, bin_file=None, listing=False):
     # Get .fet80 filename
     asm_file = os.path.realpath(asm_file)
     asm_file_nopath = os.path.split(asm_file)[1]
+    
+    # Default to a .f80bin file next to the source
+    if bin_file is None:
+        bin_file = os.path.splitext(asm_file)[0] + ".f80bin"
 
     # Make assembler
     asm = Assembler(asm_file)
@@ -647,11 +908,15 @@ def main(asm_file):
     # Run assembly
     asm.run()
     
-    # Print processed assembly for debugging
-    #TODO: something useful
-    print("~~~~~~~~ Processed Assembly for \"{}\" ~~~~~~~~".format(asm_file_nopath))
-    for i, line in enumerate(asm.processed_assembly()):
-        print("{}:\t{}".format(i, line))
+    # Print processed assembly if asked
+    if listing:
+        print("~~~~~~~~ Processed Assembly for \"{}\" ~~~~~~~~".format(asm_file_nopath))
+        for i, line in enumerate(asm.processed_assembly()):
+            print("{}:\t{}".format(i, line))
+    
+    # Write the machine code
+    asm.write_binary(bin_file)
+    print("Assembled \"{}\" into \"{}\" ({} instructions)".format(asm_file_nopath, bin_file, len(asm.assembled_objects())))
     
     return 0
     
@@ -663,8 +928,12 @@ if __name__ == '__main__':
     )
     argparser.add_argument("-f", "--file", type=helpers.file_path, required=True,
         help="the .f80asm file to assemble")
+    argparser.add_argument("-o", "--output", default=None,
+        help="the .f80bin file to write (defaults to the input file with a .f80bin extension)")
+    argparser.add_argument("-l", "--listing", action="store_true",
+        help="print the processed assembly")
     args = vars(argparser.parse_args())
     
     # Run main
-    exit_code = main(args["file"])
-    sys.exit(exit_code)
\ No newline at end of file
+    exit_code = main(args["file"], args["output"], args["listing"])
+    sys.exit(exit_code)
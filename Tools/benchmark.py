@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+
+import os
+import gc
+import sys
+import json
+import math
+import time
+import random
+import platform
+import tempfile
+import argparse
+import statistics
+import tracemalloc
+
+import helpers
+import assembler
+import asmcache
+from emulator import Emulator, ProgramROM
+
+
+# The version of the results file format
+ResultsVersion = 1
+
+# The folder of example programs that make up the fixed part of the corpus
+CodeDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Code")
+
+# Every sample is made of enough calls to take at least this long, so the timer resolution doesn't matter
+MinSampleTime = 0.05
+
+DefaultRepeats = 5
+DefaultSteps = 20000
+DefaultRunCycles = 200000
+DefaultHugeLines = 20000
+# A metric is a regression when it gets worse than its baseline by more than this fraction
+DefaultThreshold = 0.10
+
+# The assembler passes, in the order `Assembler.run()` does them
+AssemblerPasses = [ ("indirect", "resolve_all_indirect_memory"),
+                    ("prune",    "prune_redundant_m_direct"),
+                    ("loops",    "resolve_loops"),
+                    ("objects",  "assemble_objects") ]
+
+
+# ~~~~~~~~ Begin Corpus Definition ~~~~~~~~
+# A tight loop that only uses the registers and the ALU
+AluLoopSource = """# A tight ALU loop, with no memory access at all
+MOV A, 0
+MOV B, 1
+(LOOP)
+ADD A, B
+NAND B, A
+ADD B, 3
+NAND A, A
+JNEZ LOOP
+JMP LOOP
+"""
+
+# A loop that spends most of its instructions moving the MAR and reading and writing RAM
+MemLoopSource = """# A MEM heavy loop, alternating between two RAM words
+MOV A, 1
+MOV @x, 0
+MOV @y, 0
+(LOOP)
+MEM x
+ADD M, A
+MEM y
+MOV M, A
+MEM x
+MOV B, M
+MEM y
+ADD M, B
+JMP LOOP
+"""
+
+# A loop that walks a pointer through RAM, writing and reading through it
+PointerLoopSource = """# A pointer heavy loop, walking a pointer up from the screen
+MOV @p, SCREEN
+MOV A, 1
+(LOOP)
+MOV @@p, A
+ADD A, A
+MOV B, @@p
+ADD @p, 1
+JMP LOOP
+"""
+
+
+# Generates a huge program of about `lines` lines, which never faults when run
+# It writes every variable before the main loop, so every later read is of a word that has been set
+def huge_source(lines=DefaultHugeLines, seed=0, variables=64):
+    rng = random.Random(seed)
+    out = ["# A huge generated program, {} lines from seed {}".format(lines, seed),
+           "MOV A, 1",
+           "MOV B, 2"]
+    for v in range(variables):
+        out.append("MOV @v{}, {}".format(v, v))
+    
+    templates = [ "MOV @v{v}, A",
+                  "ADD A, @v{v}",
+                  "NAND B, @v{v}",
+                  "MEM v{v}",
+                  "ADD A, B",
+                  "NAND A, B",
+                  "MOV B, {n}",
+                  "JNEZ B{next}" ]
+    block = 0
+    while len(out) < lines:
+        if len(out) % 8 == 0:
+            out.append("(B{})".format(block))
+            block += 1
+            continue
+        out.append(rng.choice(templates).format(v=rng.randrange(variables), n=rng.randrange(2 ** assembler.Fet80Params.DataWidth), next=block))
+    out.append("(B{})".format(block))
+    out.append("JMP B0")
+    return "\n".join(out) + "\n"
+
+
+# Returns the generated programs as {name : source}
+def generated_sources(huge_lines=DefaultHugeLines):
+    return { "alu_loop"     : AluLoopSource,
+             "mem_loop"     : MemLoopSource,
+             "pointer_loop" : PointerLoopSource,
+             "huge"         : huge_source(huge_lines) }
+
+
+# Returns the benchmark corpus as a list of (name, path)
+# The programs from the Code folder are used as they are, and the generated ones are written to `directory`
+def corpus(directory, huge_lines=DefaultHugeLines):
+    programs = list()
+    for file_name in sorted(os.listdir(CodeDirectory)):
+        if file_name.endswith(".f80asm"):
+            programs.append( (os.path.splitext(file_name)[0], os.path.join(CodeDirectory, file_name)) )
+    for name, source in generated_sources(huge_lines).items():
+        path = os.path.join(directory, name + ".f80asm")
+        with open(path, "w") as f:
+            f.write(source)
+        programs.append( (name, path) )
+    return programs
+# ~~~~~~~~ End Corpus Definition ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Measurement ~~~~~~~~
+# Returns how many calls make up one sample, from the time of a single call
+def calls_per_sample(seconds_per_call):
+    return max(1, math.ceil(MinSampleTime / max(seconds_per_call, 1e-9)))
+
+
+# Calls `function()` with the garbage collector off, like `timeit` does, so collections don't land in random samples
+def without_gc(function):
+    enabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+    try:
+        return function()
+    finally:
+        if enabled:
+            gc.enable()
+
+
+# Summarizes the samples of a metric
+# `better` is "lower" for times and sizes, and "higher" for rates
+def metric(samples, unit, better="lower"):
+    return { "unit"    : unit,
+             "better"  : better,
+             "best"    : min(samples) if better == "lower" else max(samples),
+             "median"  : statistics.median(samples),
+             "samples" : samples }
+
+
+# Times the parse and every pass of `Assembler`, in seconds per assembly
+def bench_assembler(path, repeats):
+    start = time.perf_counter()
+    assembler.Assembler(path).run()
+    number = calls_per_sample(time.perf_counter() - start)
+    
+    samples = { name : list() for name in ["parse"] + [name for name, _ in AssemblerPasses] + ["run"] }
+    def sample():
+        start = time.perf_counter()
+        assemblers = [assembler.Assembler(path) for _ in range(number)]
+        samples["parse"].append((time.perf_counter() - start) / number)
+        for name, method in AssemblerPasses:
+            start = time.perf_counter()
+            for asm in assemblers:
+                getattr(asm, method)()
+            samples[name].append((time.perf_counter() - start) / number)
+        
+        # The whole of `run()` too, on fresh assemblers
+        assemblers = [assembler.Assembler(path) for _ in range(number)]
+        start = time.perf_counter()
+        for asm in assemblers:
+            asm.run()
+        samples["run"].append((time.perf_counter() - start) / number)
+    
+    for _ in range(repeats):
+        without_gc(sample)
+    return { "assemble." + name : metric(times, "s") for name, times in samples.items() }
+
+
+# Times `ProgramROM.program()`, in seconds per load
+# A cold load assembles the program with an empty assembly cache, and a cached load finds it in the cache
+def bench_load(path, repeats):
+    rom = ProgramROM(assembler.Fet80Params.DataWidth, assembler.Fet80Params.AddressWidth, cache=asmcache.AssemblyCache())
+    start = time.perf_counter()
+    rom.program(path)
+    number = calls_per_sample(time.perf_counter() - start)
+    
+    def cold():
+        start = time.perf_counter()
+        for _ in range(number):
+            rom.cache.clear()
+            rom.program(path)
+        return (time.perf_counter() - start) / number
+    
+    def cached():
+        start = time.perf_counter()
+        for _ in range(number):
+            rom.program(path)
+        return (time.perf_counter() - start) / number
+    
+    return { "load.cold"   : metric([without_gc(cold) for _ in range(repeats)], "s"),
+             "load.cached" : metric([without_gc(cached) for _ in range(repeats)], "s") }
+
+
+# Runs `count` instructions of a loaded emulator with `execute(emu, remaining)`, restoring it from `blank` whenever it faults
+# `execute` returns the number of instructions it completed, and the time spent restoring isn't counted
+# Returns the instructions per second
+def instruction_rate(emu, blank, count, execute):
+    done = 0
+    seconds = 0.0
+    while done < count:
+        emu.restore(blank)
+        start = time.perf_counter()
+        completed = execute(emu, count - done)
+        seconds += time.perf_counter() - start
+        if completed == 0:
+            raise Exception("The program faults before it runs a single instruction!")
+        done += completed
+    return done / seconds
+
+
+# Steps an emulator until it has completed `count` instructions or faulted, returning the number completed
+def step_instructions(emu, count):
+    step = emu.step
+    completed = 0
+    try:
+        for _ in range(count):
+            step()
+            completed += 1
+    except Exception:
+        pass
+    return completed
+
+
+# Runs an emulator on its engine until it has completed `count` instructions or faulted, returning the number completed
+def run_instructions(emu, count):
+    try:
+        emu.run(count)
+    except Exception:
+        pass
+    return emu.executed
+
+
+# Measures the instructions per second of `Emulator.step()`, and of `Emulator.run()` on the default engine
+def bench_execution(path, repeats, steps, run_cycles):
+    emu = Emulator()
+    emu.load_program(path)
+    blank = emu.snapshot()
+    
+    # Warm up, so the engine links the program before anything is timed
+    instruction_rate(emu, blank, 1, run_instructions)
+    
+    step_rates = [without_gc(lambda: instruction_rate(emu, blank, steps, step_instructions)) for _ in range(repeats)]
+    run_rates = [without_gc(lambda: instruction_rate(emu, blank, run_cycles, run_instructions)) for _ in range(repeats)]
+    return { "step.ips" : metric(step_rates, "ips", "higher"),
+             "run.ips"  : metric(run_rates, "ips", "higher") }
+
+
+# Measures the construction time of `Emulator()` in seconds, and the memory it holds on to and peaks at in bytes
+def bench_emulator(repeats):
+    start = time.perf_counter()
+    Emulator()
+    number = calls_per_sample(time.perf_counter() - start)
+    
+    def construct():
+        start = time.perf_counter()
+        for _ in range(number):
+            Emulator()
+        return (time.perf_counter() - start) / number
+    times = [without_gc(construct) for _ in range(repeats)]
+    
+    # Memory use doesn't change between runs, so it is only measured once
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        emu = Emulator()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del emu
+    
+    return { "construct"   : metric(times, "s"),
+             "memory"      : metric([current - before], "bytes"),
+             "memory_peak" : metric([peak - before], "bytes") }
+# ~~~~~~~~ End Measurement ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Benchmark Suite ~~~~~~~~
+# Runs every benchmark, returning the results as a JSON ready dict
+# Each result is keyed by "<program>/<metric>", with the `Emulator()` results under "emulator/<metric>"
+# `programs` is a list of (name, path), and `only` limits the programs to those names
+def run_suite(programs, repeats=DefaultRepeats, steps=DefaultSteps, run_cycles=DefaultRunCycles, only=None, progress=None):
+    results = dict()
+    def add(prefix, metrics):
+        for name, value in metrics.items():
+            results["{}/{}".format(prefix, name)] = value
+            if progress is not None:
+                progress("{}/{}".format(prefix, name), value)
+    
+    add("emulator", bench_emulator(repeats))
+    for name, path in programs:
+        if only is not None and name not in only:
+            continue
+        add(name, bench_assembler(path, repeats))
+        add(name, bench_load(path, repeats))
+        add(name, bench_execution(path, repeats, steps, run_cycles))
+    
+    return { "version"  : ResultsVersion,
+             "python"   : platform.python_version(),
+             "platform" : platform.platform(),
+             "created"  : time.strftime("%Y-%m-%dT%H:%M:%S"),
+             "settings" : { "repeats" : repeats, "steps" : steps, "run_cycles" : run_cycles },
+             "results"  : results }
+
+
+# Loads a saved results file
+def load_results(file_in):
+    with open(file_in, "r") as f:
+        results = json.load(f)
+    if results.get("version") != ResultsVersion:
+        raise Exception("\"{}\" is not a version {} benchmark results file!".format(file_in, ResultsVersion))
+    return results
+
+
+# Compares results against a baseline, returning a list of rows for every metric they share
+# Each row is (name, baseline best, current best, change, regressed), where `change` is the fraction it got worse by (negative when it got better)
+def compare(baseline, current, threshold=DefaultThreshold):
+    rows = list()
+    for name, now in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before = baseline["results"][name]
+        if before["best"] == 0 or now["best"] == 0:
+            change = 0.0
+        elif now["better"] == "lower":
+            change = now["best"] / before["best"] - 1
+        else:
+            change = before["best"] / now["best"] - 1
+        rows.append( (name, before["best"], now["best"], change, change > threshold) )
+    return rows
+
+
+# Formats a metric value with its unit
+def format_value(value, unit):
+    if unit == "s":
+        for scale, suffix in [(1, "s"), (1e-3, "ms"), (1e-6, "us")]:
+            if value >= scale:
+                return "{:.3f} {}".format(value / scale, suffix)
+        return "{:.1f} ns".format(value * 1e9)
+    if unit == "bytes":
+        return "{:.1f} KiB".format(value / 1024)
+    return "{:,.0f} {}".format(value, unit)
+
+
+# Formats a metric as a line of text
+def format_metric(name, value):
+    return "{:<40} {:>16}  (median {})".format(name, format_value(value["best"], value["unit"]), format_value(value["median"], value["unit"]))
+# ~~~~~~~~ End Benchmark Suite ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Main Program ~~~~~~~~
+def main(files=None, repeats=DefaultRepeats, steps=DefaultSteps, run_cycles=DefaultRunCycles, huge_lines=DefaultHugeLines, only=None, output=None, baseline=None, current=None, threshold=DefaultThreshold):
+    if current is not None:
+        results = load_results(current)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            programs = corpus(directory, huge_lines)
+            for path in files or []:
+                programs.append( (os.path.splitext(os.path.basename(path))[0], path) )
+            results = run_suite(programs, repeats, steps, run_cycles, only, progress=lambda name, value: print(format_metric(name, value)))
+    
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    
+    if baseline is None:
+        return 0
+    
+    base = load_results(baseline)
+    units = {name : value["unit"] for name, value in results["results"].items()}
+    rows = compare(base, results, threshold)
+    regressions = 0
+    print()
+    print("{:<40} {:>16} {:>16} {:>8}".format("metric", "baseline", "current", "change"))
+    for name, before, now, change, regressed in rows:
+        print("{:<40} {:>16} {:>16} {:>+7.1f}%{}".format(name, format_value(before, units[name]), format_value(now, units[name]), change * 100, "  REGRESSION" if regressed else ""))
+        if regressed:
+            regressions += 1
+    print("{} of {} metrics regressed by more than {:.0f}%".format(regressions, len(rows), threshold * 100))
+    return 1 if regressions > 0 else 0
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        description="Benchmarks the FET-80 assembler and emulator over a corpus of programs, saving the results as JSON or comparing them against a baseline",
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    argparser.add_argument("files", nargs="*", type=helpers.file_path,
+        help="extra .f80asm files to add to the corpus")
+    argparser.add_argument("-r", "--repeats", type=int, default=DefaultRepeats,
+        help="the number of samples of every metric (default: {})".format(DefaultRepeats))
+    argparser.add_argument("-n", "--steps", type=int, default=DefaultSteps,
+        help="the instructions to run with step() per sample (default: {})".format(DefaultSteps))
+    argparser.add_argument("-c", "--run-cycles", type=int, default=DefaultRunCycles,
+        help="the instructions to run with run() per sample (default: {})".format(DefaultRunCycles))
+    argparser.add_argument("-l", "--huge-lines", type=int, default=DefaultHugeLines,
+        help="the length of the huge generated program (default: {})".format(DefaultHugeLines))
+    argparser.add_argument("-p", "--program", action="append", default=None,
+        help="only benchmark this program of the corpus, by name (e.g. Pointers, huge), may be repeated")
+    argparser.add_argument("-o", "--output", default=None,
+        help="the JSON file to save the results to")
+    argparser.add_argument("-b", "--baseline", type=helpers.file_path, default=None,
+        help="a saved results file to compare against, exiting with 1 if anything regressed")
+    argparser.add_argument("-i", "--input", type=helpers.file_path, default=None,
+        help="a saved results file to compare instead of running the benchmarks")
+    argparser.add_argument("-t", "--threshold", type=float, default=DefaultThreshold,
+        help="the fraction a metric can get worse by before it counts as a regression (default: {})".format(DefaultThreshold))
+    args = vars(argparser.parse_args())
+    
+    # Run main
+    exit_code = main( args["files"],
+                      repeats    = args["repeats"],
+                      steps      = args["steps"],
+                      run_cycles = args["run_cycles"],
+                      huge_lines = args["huge_lines"],
+                      only       = args["program"],
+                      output     = args["output"],
+                      baseline   = args["baseline"],
+                      current    = args["input"],
+                      threshold  = args["threshold"] )
+    sys.exit(exit_code)
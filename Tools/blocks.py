@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+
+import sys
+
+import assembler
+import engine
+
+
+# ~~~~~~~~ Begin Block Analysis ~~~~~~~~
+# The longest run of instructions compiled into a single block
+MaxBlockLength = 256
+
+
+# Finds the block leaders of a decoded program: the start, every static jump target, and every instruction after a jump
+def find_leaders(decoded):
+    leaders = {0}
+    for address in decoded.addresses:
+        op, value = decoded[address]
+        if op == engine.EmptyOp:
+            continue
+        instruction_type, opcode, src, dest = engine.Kinds[op]
+        if instruction_type == assembler.AsmCodes.InstructionType.J_INSTRUCTION:
+            if src == assembler.AsmCodes.Src.DV:
+                leaders.add(value)
+            leaders.add((address + 1) % len(decoded))
+    return leaders
+
+
+# Returns the static successors of the instruction at `address`, or None if its successor is only known at run time
+def successors(decoded, address):
+    op, value = decoded[address]
+    instruction_type, opcode, src, dest = engine.Kinds[op]
+    fall = (address + 1) % len(decoded)
+    if instruction_type == assembler.AsmCodes.InstructionType.J_INSTRUCTION:
+        if src != assembler.AsmCodes.Src.DV:
+            return None
+        if opcode == assembler.AsmCodes.Opcode.JMP:
+            return [value]
+        return [value, fall]
+    if instruction_type == assembler.AsmCodes.InstructionType.D_INSTRUCTION:
+        return [address]
+    return [fall]
+
+
+# Returns the addresses in the block starting at `start`, following unconditional jumps
+# The block stops after a branch or `NOP`, before the next leader or an empty word, or at `limit` instructions
+# It never carries on into an address in `breaks`, so the engine can stop there
+def block_addresses(decoded, leaders, start, limit, breaks=frozenset()):
+    addresses = list()
+    address = start
+    while len(addresses) < limit:
+        op, value = decoded[address]
+        if op == engine.EmptyOp:
+            break
+        addresses.append(address)
+        following = successors(decoded, address)
+        if following is None or len(following) != 1:
+            break
+        if engine.Kinds[op][0] == assembler.AsmCodes.InstructionType.J_INSTRUCTION:
+            # Carry straight on into the target of a `JMP`, unless it is already part of this block
+            address = following[0]
+            if address in addresses or address in breaks:
+                break
+        else:
+            address = following[0]
+            if address in leaders or address in addresses or address in breaks:
+                break
+    return addresses
+# ~~~~~~~~ End Block Analysis ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Block Code Generation ~~~~~~~~
+# Raised from inside a compiled block when an instruction faults
+# It carries the faulting address and the number of instructions completed before it
+class BlockFault(Exception):
+    def __init__(self, pc, executed, message):
+        super().__init__(message)
+        self.pc = pc
+        self.executed = executed
+        self.message = message
+
+
+# Called by a compiled block to store its locals and report a fault
+def fault(st, a, b, mar, acc, cout, pc, executed, message):
+    st[:] = [a, b, mar, acc, cout]
+    raise BlockFault(pc, executed, message)
+
+
+# Generates python source for a single block, with registers held in locals
+class BlockWriter:
+    def __init__(self, decoded, addresses, data_bits, address_bits, breaks=frozenset()):
+        self.decoded = decoded
+        self.addresses = addresses
+        self.breaks = breaks
+        self.start = addresses[0]
+        self.length = len(addresses)
+        
+        self.dmask = 2 ** data_bits - 1
+        self.amask = 2 ** address_bits - 1
+        self.half = 2 ** (data_bits - 1)
+        
+        # Names of locals known to be set at the current point (`m` means the word at `mar` has been written)
+        self.known = set()
+        # The (carry, accumulator) lines of the last C-instruction, while nothing has observed its flags
+        self.pending = None
+        self.lines = list()
+        self.ind = ""
+    
+    
+    # Adds a line at the current indent, returning its index
+    def emit(self, line):
+        self.lines.append(self.ind + line)
+        return len(self.lines) - 1
+    
+    
+    # Adds the guards for a list of checks, skipping the ones already known to pass
+    def guard(self, checks, message_name, address, index):
+        known_checks = { "a is None"        : "a",
+                         "b is None"        : "b",
+                         "mar is None"      : "mar",
+                         "not written[mar]" : "m",
+                         "acc is None"      : "acc" }
+        for check in checks:
+            if known_checks[check] in self.known:
+                continue
+            self.emit("if {}: fault(st, a, b, mar, acc, cout, {}, n + {}, {})".format(check, address, index, message_name))
+            self.known.add(known_checks[check])
+            # A fault exposes the flags of the last C-instruction
+            self.pending = None
+    
+    
+    # Returns the read checks and expression for a source operand
+    def operand(self, src, value):
+        if src == assembler.AsmCodes.Src.DV:
+            return [], str(value)
+        return engine.SourceReads[src]
+    
+    
+    # Writes the statements to store a value in a destination, returning the index of the line that stores it
+    def store(self, dest, x, address, index):
+        checks, writes = engine.DestWrites[dest]
+        self.guard(checks, "UnsetRegisterError", address, index)
+        line = self.emit(writes[0].format(x))
+        # Skip marking a word as written if it is already known to be
+        if dest == assembler.AsmCodes.Dest.M and "m" not in self.known:
+            self.emit(writes[1])
+        if dest == assembler.AsmCodes.Dest.A:
+            self.known.add("a")
+        elif dest == assembler.AsmCodes.Dest.B:
+            self.known.add("b")
+        else:
+            self.known.add("m")
+        return line
+    
+    
+    # Writes a single instruction, returning the address that follows it, or None if it sets `nxt` itself
+    def instruction(self, address, index):
+        op, value = self.decoded[address]
+        instruction_type, opcode, src, dest = engine.Kinds[op]
+        fall = (address + 1) & self.amask
+        
+        if instruction_type == assembler.AsmCodes.InstructionType.T_INSTRUCTION:
+            checks, x = self.operand(src, value)
+            self.guard(checks, "UnsetRegisterError", address, index)
+            self.store(dest, x, address, index)
+            return fall
+        elif instruction_type == assembler.AsmCodes.InstructionType.M_INSTRUCTION:
+            checks, x = self.operand(src, value)
+            self.guard(checks, "UnsetRegisterError", address, index)
+            if src == assembler.AsmCodes.Src.DV:
+                self.emit("mar = {}".format(x))
+            else:
+                self.emit("mar = {} & {}".format(x, self.amask))
+            self.known.add("mar")
+            self.known.discard("m")
+            return fall
+        elif instruction_type == assembler.AsmCodes.InstructionType.C_INSTRUCTION:
+            checks, x = engine.DestReads[dest]
+            self.guard(checks, "UnsetRegisterError", address, index)
+            if dest == assembler.AsmCodes.Dest.M:
+                self.emit("x = {}".format(x))
+                x = "x"
+            checks, y = self.operand(src, value)
+            self.guard(checks, "UnsetRegisterError", address, index)
+            if src == assembler.AsmCodes.Src.M:
+                if dest == assembler.AsmCodes.Dest.M:
+                    # Both operands are the same word
+                    y = x
+                else:
+                    self.emit("y = {}".format(y))
+                    y = "y"
+            
+            # The carry always comes from the adder, even for a NAND
+            cout_line = self.emit("cout = {} + {} > {}".format(x, y, self.dmask))
+            if opcode == assembler.AsmCodes.Opcode.ADD:
+                result = "({} + {}) & {}".format(x, y, self.dmask)
+            elif x == y:
+                result = "~{} & {}".format(x, self.dmask)
+            else:
+                result = "~({} & {}) & {}".format(x, y, self.dmask)
+            
+            # This instruction's flags are dead if another C-instruction replaces them before anything can observe them
+            if self.pending is not None:
+                dead_cout_line, dead_acc_line = self.pending
+                self.lines[dead_cout_line] = None
+                self.lines[dead_acc_line] = self.lines[dead_acc_line].replace("acc = ", "", 1)
+            self.known.add("acc")
+            acc_line = self.store(dest, "acc = " + result, address, index)
+            self.pending = (cout_line, acc_line)
+            return fall
+        elif instruction_type == assembler.AsmCodes.InstructionType.J_INSTRUCTION:
+            condition = engine.JumpConditions[opcode]
+            checks, x = self.operand(src, value)
+            if condition is None:
+                self.guard(checks, "UnsetRegisterError", address, index)
+                if src == assembler.AsmCodes.Src.DV:
+                    return value
+                self.emit("nxt = {} & {}".format(x, self.amask))
+            else:
+                if src == assembler.AsmCodes.Src.DV:
+                    target = str(value)
+                else:
+                    target = "{} & {}".format(x, self.amask)
+                self.guard(["acc is None"], "UnsetFlagsError", address, index)
+                self.emit("if {}:".format(condition.replace("half", str(self.half))))
+                self.ind += "    "
+                known = set(self.known)
+                self.guard(checks, "UnsetRegisterError", address, index)
+                self.known = known
+                self.emit("nxt = {}".format(target))
+                self.ind = self.ind[:-4]
+                self.emit("else:")
+                self.emit("    nxt = {}".format(fall))
+            return None
+        elif instruction_type == assembler.AsmCodes.InstructionType.D_INSTRUCTION:
+            # A `NOP` leaves the PC where it is, just like `Emulator.run_D`
+            return address
+    
+    
+    # Can the block jump straight back to its own start? (a block starting at a break always returns to the engine)
+    def loops(self):
+        if self.start in self.breaks:
+            return False
+        following = successors(self.decoded, self.addresses[-1])
+        return following is not None and self.start in following
+    
+    
+    # Writes the full block function
+    # A block that jumps back to its own start keeps looping locally while the cycle budget allows another full pass
+    def source(self):
+        self.emit("def block(st, data, written, budget):")
+        self.ind = "    "
+        self.emit("a, b, mar, acc, cout = st")
+        self.emit("n = 0")
+        
+        loops = self.loops()
+        if loops:
+            self.emit("while True:")
+            self.ind = "        "
+        
+        fall = None
+        for index, address in enumerate(self.addresses):
+            self.emit("# {}".format(address))
+            fall = self.instruction(address, index)
+        if fall is not None:
+            self.emit("nxt = {}".format(fall))
+        self.emit("n += {}".format(self.length))
+        
+        if loops:
+            self.emit("if nxt != {} or n + {} > budget:".format(self.start, self.length))
+            self.emit("    break")
+            self.ind = "    "
+        
+        self.emit("st[:] = [a, b, mar, acc, cout]")
+        self.emit("return nxt, n")
+        return "\n".join(line for line in self.lines if line is not None) + "\n"
+    
+    
+    # Compiles the block into a python function
+    def compile(self):
+        body = self.source()
+        namespace = { "fault"              : fault,
+                      "UnsetRegisterError" : engine.UnsetRegisterError,
+                      "UnsetFlagsError"    : engine.UnsetFlagsError }
+        exec(compile(body, "<fet80 block {}>".format(self.start), "exec"), namespace)
+        return namespace["block"]
+# ~~~~~~~~ End Block Code Generation ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Block Engine Definition ~~~~~~~~
+# An execution engine for a `Fet80` that compiles the program into python functions, one per basic block
+# Blocks are compiled lazily the first time they are entered, and cached until the ROM is reprogrammed
+class BlockEngine:
+    def __init__(self, fet80):
+        self.fet80 = fet80
+        
+        self.data_bits = self.fet80.bits()["data"]
+        self.address_bits = self.fet80.bits()["address"]
+        
+        self.program = None
+        self.leaders = None
+        self.blocks = dict()
+        self.full = dict()
+        self.stopping = dict()
+        self.leader_stop_sets = dict()
+        self.executed = 0
+        
+        # The fast engine that runs the program while devices are mapped into RAM, and the cycles left over when a block doesn't fit the budget
+        self.fast_engine = None
+    
+    
+    # Forgets every compiled block, and analyses the currently loaded program
+    def reset(self):
+        self.program = self.fet80.rom.decoded
+        self.leaders = find_leaders(self.program)
+        self.blocks = dict()
+        self.full = dict()
+        self.stopping = dict()
+        self.leader_stop_sets = dict()
+    
+    
+    # Returns the (length, function) of the block starting at `start`, limited to `limit` instructions
+    # Blocks compiled for a set of stop addresses end before any of them
+    def block(self, start, limit=MaxBlockLength, stops=frozenset()):
+        key = (start, limit, stops)
+        if key not in self.blocks:
+            addresses = block_addresses(self.program, self.leaders, start, limit, stops)
+            if len(addresses) == 0:
+                raise Exception("No instruction at the current ROM address!")
+            writer = BlockWriter(self.program, addresses, self.data_bits, self.address_bits, stops)
+            self.blocks[key] = (len(addresses), writer.compile())
+        return self.blocks[key]
+    
+    
+    # Returns the addresses the fast engine stops at, to hand back to the blocks: every leader, and every address in `stops`
+    def leader_stops(self, stops):
+        if stops not in self.leader_stop_sets:
+            self.leader_stop_sets[stops] = frozenset(self.leaders) | stops
+        return self.leader_stop_sets[stops]
+    
+    
+    # Returns the fast engine, making it the first time it is needed
+    def tail_engine(self):
+        if self.fast_engine is None:
+            self.fast_engine = engine.FastEngine(self.fet80)
+        return self.fast_engine
+    
+    
+    # Runs up to `cycles` instructions, returning the number actually executed
+    # If `stops` is a set of ROM addresses, it also stops as soon as the PC reaches one of them
+    # If an instruction faults, the machine is left at the faulting instruction and the error is re-raised
+    def run(self, cycles=1, stops=None):
+        if self.fet80.rom.decoded is None:
+            raise Exception("No program has been loaded into the ROM yet!")
+        
+        # Blocks read and write RAM inline, so while devices are mapped the program runs on the fast engine's mapped core instead
+        if self.fet80.ram.bus.mapped:
+            try:
+                return self.tail_engine().run(cycles, stops)
+            finally:
+                self.executed = self.fast_engine.executed
+        
+        if self.program is not self.fet80.rom.decoded:
+            self.reset()
+        
+        if stops is None:
+            stops = frozenset()
+            full = self.full
+        else:
+            stops = frozenset(stops)
+            full = self.stopping.setdefault(stops, dict())
+        
+        data = self.fet80.ram.data
+        written = self.fet80.ram.written
+        a, b, mar, acc, cout, pc = engine.read_state(self.fet80)
+        st = [a, b, mar, acc, cout]
+        
+        executed = 0
+        try:
+            while executed < cycles:
+                remaining = cycles - executed
+                entry = full.get(pc)
+                if entry is None and pc in self.leaders:
+                    entry = full[pc] = self.block(pc, MaxBlockLength, stops)
+                if entry is None or entry[0] > remaining:
+                    # Between leaders, or when only part of the block fits in the budget, the fast engine runs up to the next leader
+                    # Blocks are only ever compiled whole and at leaders, so small or uneven budgets never compile anything new
+                    engine.write_state(self.fet80, st + [pc])
+                    fast_engine = self.tail_engine()
+                    try:
+                        fast_engine.run(remaining, self.leader_stops(stops))
+                    finally:
+                        executed += fast_engine.executed
+                        state = engine.read_state(self.fet80)
+                        st[:] = state[:5]
+                        pc = state[5]
+                    if pc in stops:
+                        break
+                    continue
+                pc, n = entry[1](st, data, written, remaining)
+                executed += n
+                if pc in stops:
+                    break
+        except BlockFault as f:
+            pc = f.pc
+            executed += f.executed
+            raise Exception(f.message) from None
+        finally:
+            self.executed = executed
+            engine.write_state(self.fet80, st + [pc])
+        return self.executed
+# ~~~~~~~~ End Block Engine Definition ~~~~~~~~
+
+
+if __name__ == '__main__':
+    print("This module is not meant to be run on it's own!")
+    sys.exit()
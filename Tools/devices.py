@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import threading
+
+import assembler
+
+
+# ~~~~~~~~ Begin Device Bus Definition ~~~~~~~~
+# Devices are mapped into RAM a page at a time, with each page split into words
+# An address on a page with no devices takes the plain RAM path after one look-up in the page table
+PageBits = 4
+PageWords = 2 ** PageBits
+PageMask = PageWords - 1
+
+# The error raised when a device has no value for a word, kept identical to reading an unset RAM word
+UnsetWordError = "The register has not been set yet, no value to get!"
+
+
+# Returns the value of an assembler constant like `SCREEN` or `IO0`
+def constant(name):
+    for s in assembler.Fet80Params.AsmConstants:
+        if s["name"] == name:
+            return s["value"]
+    raise Exception("\"{}\" is not an assembler constant!".format(name))
+
+
+# A peripheral mapped into RAM
+# Every word a device maps is still stored in RAM as normal, and the device is told about each access to it
+# `ranges` is a list of (start, end) address ranges it maps, with `end` exclusive
+class Device:
+    def __init__(self, ranges):
+        self.ranges = ranges
+        self.bus = None
+    
+    
+    # Returns every address the device maps
+    def addresses(self):
+        for start, end in self.ranges:
+            for address in range(start, end):
+                yield address
+    
+    
+    # Called when the CPU reads a mapped word, with the word stored in RAM (or None if it is unset)
+    # Returns the word the CPU sees (None faults, like an unset word)
+    def read(self, address, value):
+        return value
+    
+    
+    # Called after the CPU has stored a word at a mapped address
+    def write(self, address, value):
+        pass
+    
+    
+    # Called after the host has changed a mapped word without the CPU (a poke, a restore or an undo)
+    # `value` is the new word, or None if it is now unset
+    def changed(self, address, value):
+        pass
+
+
+# Routes the RAM accesses of mapped addresses to their devices
+# `pages` has an entry for every RAM page: None when no device maps any of its words, otherwise a list of the device at each word
+# It is only ever changed in place, as the engines keep a reference to it
+class DeviceBus:
+    def __init__(self, ram):
+        self.ram = ram
+        self.pages = [None] * ((ram.words + PageWords - 1) // PageWords)
+        self.devices = list()
+        self.mapped = False
+    
+    
+    # Returns the device mapped at an address, or None
+    def device_at(self, address):
+        page = self.pages[address >> PageBits]
+        if page is None:
+            return None
+        return page[address & PageMask]
+    
+    
+    # Maps a device into RAM, at every address in its ranges
+    def attach(self, device):
+        if device.bus is not None:
+            raise Exception("This device is already attached to a bus!")
+        for address in device.addresses():
+            if address < 0 or address >= self.ram.words:
+                raise Exception("Address {} is outside of the RAM!".format(address))
+            if self.device_at(address) is not None:
+                raise Exception("Address {} is already mapped to a {}!".format(address, type(self.device_at(address)).__name__))
+        
+        for address in device.addresses():
+            index = address >> PageBits
+            if self.pages[index] is None:
+                self.pages[index] = [None] * PageWords
+            self.pages[index][address & PageMask] = device
+        self.devices.append(device)
+        self.mapped = True
+        device.bus = self
+    
+    
+    # Unmaps a device, dropping the pages that no longer map anything
+    def detach(self, device):
+        if device not in self.devices:
+            raise Exception("This device is not attached to this bus!")
+        for address in device.addresses():
+            index = address >> PageBits
+            page = self.pages[index]
+            page[address & PageMask] = None
+            if all(d is None for d in page):
+                self.pages[index] = None
+        self.devices.remove(device)
+        self.mapped = len(self.devices) > 0
+        device.bus = None
+    
+    
+    # Reads a word on a mapped page for the CPU, returning the word it sees
+    def read(self, address):
+        ram = self.ram
+        value = ram.data[address] if ram.written[address] else None
+        device = self.pages[address >> PageBits][address & PageMask]
+        if device is not None:
+            value = device.read(address, value)
+        if value is None:
+            raise Exception(UnsetWordError)
+        return value % (2 ** ram.data_bits)
+    
+    
+    # Tells the device at an address on a mapped page that the CPU has stored a word there
+    def write(self, address, value):
+        device = self.pages[address >> PageBits][address & PageMask]
+        if device is not None:
+            device.write(address, value)
+    
+    
+    # Tells the device at an address (if any) that the host has changed the word there
+    def changed(self, address):
+        device = self.device_at(address)
+        if device is not None:
+            device.changed(address, self.ram.data[address] if self.ram.written[address] else None)
+    
+    
+    # Tells every device that the host has changed all of RAM at once
+    def changed_all(self):
+        for device in self.devices:
+            for address in device.addresses():
+                self.changed(address)
+# ~~~~~~~~ End Device Bus Definition ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Peripheral Definitions ~~~~~~~~
+# The screen, a 1 bit framebuffer stored at `SCREEN`
+# Each word holds 8 pixels, most significant bit on the left
+# The words are stored a column of words at a time: the first `height` words are the left 8 pixels of every row, top to bottom, and so on
+class Screen(Device):
+    PixelsPerWord = 8
+    
+    def __init__(self, start=None, width=assembler.Fet80Params.ScreenSize["x"], height=assembler.Fet80Params.ScreenSize["y"]):
+        if start is None:
+            start = constant("SCREEN")
+        self.start = start
+        self.width = width
+        self.height = height
+        self.columns = (width + Screen.PixelsPerWord - 1) // Screen.PixelsPerWord
+        super().__init__([(start, start + self.columns * height)])
+        
+        # The rows that have changed since `take_dirty()` was last called
+        # The emulation thread adds to it while the GUI takes it, so both only touch it under the lock
+        self.dirty = set(range(height))
+        self.lock = threading.Lock()
+    
+    
+    # Returns the screen row a mapped address is part of
+    def row_of(self, address):
+        return (address - self.start) % self.height
+    
+    
+    # Returns the pixels of a row, as a list of 0s and 1s from left to right
+    def row(self, y):
+        ram = self.bus.ram
+        pixels = list()
+        for column in range(self.columns):
+            address = self.start + column * self.height + y
+            word = ram.data[address] if ram.written[address] else 0
+            for bit in range(Screen.PixelsPerWord - 1, -1, -1):
+                pixels.append((word >> bit) & 1)
+        return pixels[:self.width]
+    
+    
+    # Returns a single pixel (0 or 1)
+    def pixel(self, x, y):
+        return self.row(y)[x]
+    
+    
+    # Returns the sorted rows that changed since the last call, and forgets them
+    # The set is swapped under the lock, so a row marked by an emulation thread at the same time lands in one set or the other
+    def take_dirty(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+        return sorted(dirty)
+    
+    
+    # Marks the row of a mapped address as changed
+    def mark(self, address):
+        with self.lock:
+            self.dirty.add(self.row_of(address))
+    
+    
+    def write(self, address, value):
+        self.mark(address)
+    
+    
+    def changed(self, address, value):
+        self.mark(address)
+
+
+# Input ports, whose words are set by the host
+# A read sees the value the host last set, or the word stored in RAM if the host never set one
+class InputPorts(Device):
+    def __init__(self, start=None, count=8):
+        if start is None:
+            start = constant("IO0")
+        self.start = start
+        self.values = [None] * count
+        super().__init__([(start, start + count)])
+    
+    
+    # Sets the value of an input port, by its number
+    def set(self, port, value):
+        self.values[port] = value
+    
+    
+    def read(self, address, value):
+        port = self.values[address - self.start]
+        return value if port is None else port
+
+
+# A free running timer, counting `rate` ticks per second of wall clock time
+# A read sees the tick count (wrapping around), and a write sets it
+class Timer(Device):
+    def __init__(self, address=None, rate=1000):
+        if address is None:
+            address = constant("IO14")
+        self.rate = rate
+        self.base = time.perf_counter()
+        super().__init__([(address, address + 1)])
+    
+    
+    # Returns the current tick count
+    def ticks(self):
+        return int((time.perf_counter() - self.base) * self.rate)
+    
+    
+    def read(self, address, value):
+        return self.ticks()
+    
+    
+    def write(self, address, value):
+        self.base = time.perf_counter() - value / self.rate
+
+
+# A character console
+# A write prints the character with the low byte as its code, and a read takes the next character typed in (0 if there is none)
+class Console(Device):
+    def __init__(self, address=None, out=None):
+        if address is None:
+            address = constant("IO15")
+        self.out = out
+        # Every character written so far, and the characters waiting to be read
+        self.output = list()
+        self.input = list()
+        super().__init__([(address, address + 1)])
+    
+    
+    # Queues text to be read by the program
+    def feed(self, text):
+        self.input += [ord(c) for c in text]
+    
+    
+    # Returns everything written so far as a string
+    def text(self):
+        return "".join(self.output)
+    
+    
+    def read(self, address, value):
+        if len(self.input) == 0:
+            return 0
+        return self.input.pop(0)
+    
+    
+    def write(self, address, value):
+        c = chr(value & 0xFF)
+        self.output.append(c)
+        if self.out is not None:
+            self.out.write(c)
+            self.out.flush()
+# ~~~~~~~~ End Peripheral Definitions ~~~~~~~~
+
+
+if __name__ == '__main__':
+    print("This module is not meant to be run on it's own!")
+    sys.exit()
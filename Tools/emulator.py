@@ -1,16 +1,30 @@
 #!/usr/bin/env python3
 
-import os
+import sys
+from array import array
 from enum import Enum
-import tkinter as tk
-from tkinter import scrolledtext
-from tkinter import filedialog
 
 import helpers
 import assembler
+import engine
+import blocks
+import halts
+import asmcache
+import profiler
+import timing
+import tracer
+import devices
 
 
 # ~~~~~~~~ Begin Hardware Definition ~~~~~~~~
+# A helper to pick the smallest unsigned array typecode that can hold a word
+def array_typecode(bits):
+    for typecode in ["B", "H", "I", "L", "Q"]:
+        if array(typecode).itemsize * 8 >= bits:
+            return typecode
+    raise Exception("No array type is wide enough for {} bits!".format(bits))
+
+
 # A class to implement a simple register
 class Register:
     def __init__(self, bits):
@@ -44,20 +58,37 @@ class Register:
 
 
 
+# The ALU flags are packed into one small integer: bit 0 is the carry out, bit 1 is "equal to zero", and bit 2 is "less than zero"
+# Every flag can be decoded from those three bits, so this table holds the full flag set for each packed value
+def flag_table():
+    table = list()
+    for packed in range(8):
+        cout = bool(packed & 1)
+        eqz = bool(packed & 2)
+        ltz = bool(packed & 4)
+        table.append({"cout" : cout,
+                      "eqz"  : eqz,
+                      "nez"  : not eqz,
+                      "ltz"  : ltz,
+                      "gtz"  : not (ltz or eqz),
+                      "lez"  : ltz or eqz,
+                      "gez"  : not ltz})
+    return table
+
+FlagTable = flag_table()
+
+
 # A class to implement an ALU object, with flags and an accumulator
+# Results are computed with mask arithmetic, and the flags are kept packed until something reads them
 class ALU:
     def __init__(self, bits):
         # Bit width
         self.bits = bits
+        self.mask = 2 ** self.bits - 1
+        self.sign = 2 ** (self.bits - 1)
         
-        # Flag bits out
-        self.cout = None
-        self.eqz = None
-        self.nez = None
-        self.ltz = None
-        self.gtz = None
-        self.lez = None
-        self.gez = None
+        # Packed flag bits out (see `FlagTable`)
+        self.packed = None
         
         # Accumulator
         self.acc = Register(self.bits)
@@ -73,57 +104,28 @@ class ALU:
     
     
     def invert(self, X):
-        # Overflow inputs if needed
-        X %= 2 ** self.bits
-        
-        # Get binary string
-        binstring = "{0:b}".format(X)
-        
-        # Invert each bit
-        out = ""
-        for bit in binstring:
-            if bit == "0":
-                out += "1"
-            else:
-                out += "0"
-        
-        # Pad with 1's to fill the zeros that were missing at the start
-        out = out.rjust(self.bits, "1")
-        
-        # Convert back to an integer
-        out = int(out, 2)
-        
-        return out
+        # Overflow inputs if needed, then flip every bit
+        return (X & self.mask) ^ self.mask
     
     
     def add(self, A, B, cin):
         # Overflow inputs if needed
-        A %= 2 ** self.bits
-        B %= 2 ** self.bits
+        A &= self.mask
+        B &= self.mask
         
-        # Take the sum
+        # Take the sum, with the carry in
         sum = A + B
-        
-        # Add the carry in
         if cin:
             sum += 1
         
-        # Test if we have a carry out
-        if sum >= 2 ** self.bits:
-            cout = True
-        else:
-            cout = False
-        
-        # Overflow the output
-        sum %= 2 ** self.bits
-        
-        return sum, cout
+        # Test if we have a carry out, then overflow the output
+        return sum & self.mask, sum > self.mask
     
     
     def calc(self, f, X, Y, cin=False):
         # Overflow inputs if needed
-        X %= 2 ** self.bits
-        Y %= 2 ** self.bits
+        X &= self.mask
+        Y &= self.mask
         
         
         # Convert `f` to bool if needed
@@ -136,29 +138,26 @@ class ALU:
             else:
                 raise Exception("\"{}\" is not a valid ALU command!".format(command))
         
-        # Add to get the carry no matter what
-        sum, cout = self.add(X, Y, cin)
+        # The carry always comes from the adder, even for a NAND
+        sum = X + Y
+        if cin:
+            sum += 1
         
         # Select output
         if f:
             # Add
-            out = sum
+            out = sum & self.mask
         else:
             # NAND
-            out = self.invert(X & Y)
-        
-        # Set flags
-        self.cout = cout
-        
-        self.eqz = (out == 0)
-        self.nez = (not self.eqz)
-        
-        self.ltz = (out >= (2** (self.bits - 1) ))
-        self.gez = (not self.ltz)
-        
+            out = (X & Y) ^ self.mask
         
-        self.lez = (self.ltz or self.eqz)
-        self.gtz = (not self.lez)
+        self.load(out, sum > self.mask)
+    
+    
+    # Loads an output and carry into the ALU, setting the accumulator and flags
+    def load(self, out, cout):
+        # Pack the flags
+        self.packed = (1 if cout else 0) | (2 if out == 0 else 0) | (4 if out >= self.sign else 0)
         
         if self.unset:
             self.unset = False
@@ -171,16 +170,53 @@ class ALU:
         return self.bits
     
     
+    # Reads a single flag by name
+    def flag(self, name):
+        if self.unset:
+            raise Exception("ALU has not had any calculations run yet, no flags available!")
+        return FlagTable[self.packed][name]
+    
+    
     def flags(self):
         if self.unset:
             raise Exception("ALU has not had any calculations run yet, no flags available!")
-        return {"cout" : self.cout,
-                "eqz"  : self.eqz,
-                "nez"  : self.nez,
-                "ltz"  : self.ltz,
-                "gtz"  : self.gtz,
-                "lez"  : self.lez,
-                "gez"  : self.gez}
+        return dict(FlagTable[self.packed])
+    
+    
+    # The individual flags, decoded from the packed bits when read (None before any calculation)
+    @property
+    def cout(self):
+        return None if self.unset else FlagTable[self.packed]["cout"]
+    
+    
+    @property
+    def eqz(self):
+        return None if self.unset else FlagTable[self.packed]["eqz"]
+    
+    
+    @property
+    def nez(self):
+        return None if self.unset else FlagTable[self.packed]["nez"]
+    
+    
+    @property
+    def ltz(self):
+        return None if self.unset else FlagTable[self.packed]["ltz"]
+    
+    
+    @property
+    def gtz(self):
+        return None if self.unset else FlagTable[self.packed]["gtz"]
+    
+    
+    @property
+    def lez(self):
+        return None if self.unset else FlagTable[self.packed]["lez"]
+    
+    
+    @property
+    def gez(self):
+        return None if self.unset else FlagTable[self.packed]["gez"]
     
     
     def get_ACC(self):
@@ -189,15 +225,24 @@ class ALU:
 
 
 # A class to implement a RAM, with an internal MAR
+# The words are kept in a typed array, with a separate bitmap recording which words have been written
+# Peripherals are mapped in through `bus`, and only accesses to a page with a device on it go through the bus
 class RAM:
+    # The number of words in each snapshot page
+    PageWords = 512
+    
     def __init__(self, data_bits, address_bits):
         self.data_bits = data_bits
         self.address_bits = address_bits
         
         self.words = 2**self.address_bits
-        self.registers = [Register(self.data_bits) for _ in range(self.words)]
+        self.data = array(array_typecode(self.data_bits), [0]) * self.words
+        self.written = bytearray(self.words)
         
         self.address = Register(self.address_bits)
+        
+        self.bus = devices.DeviceBus(self)
+    
     
     def set_address(self, address):
         # Overflow inputs if needed
@@ -210,20 +255,117 @@ class RAM:
         # Overflow inputs if needed
         value %= 2 ** self.data_bits
         
-        self.registers[self.address.get()].set(value)
+        address = self.address.get()
+        self.data[address] = value
+        self.written[address] = 1
+        if self.bus.pages[address >> devices.PageBits] is not None:
+            self.bus.write(address, value)
+    
+    
+    # Writes a word at an address, without touching the MAR
+    # A device mapped there is told the host changed it, rather than that the CPU wrote it
+    def poke(self, address, value):
+        # Overflow inputs if needed
+        address %= 2 ** self.address_bits
+        value %= 2 ** self.data_bits
+        
+        self.data[address] = value
+        self.written[address] = 1
+        if self.bus.pages[address >> devices.PageBits] is not None:
+            self.bus.changed(address)
+    
     
     def read(self):
-        return self.registers[self.address.get()].get()
+        address = self.address.get()
+        if self.bus.pages[address >> devices.PageBits] is not None:
+            return self.bus.read(address)
+        if not self.written[address]:
+            raise Exception("The register has not been set yet, no value to get!")
+        
+        return self.data[address]
+    
+    
+    # Returns a zero-copy view of the RAM words (unset words read as 0)
+    def view(self):
+        return memoryview(self.data)
+    
+    
+    # Returns a zero-copy view of the RAM words, with unset words replaced by `unset`
+    def int_view(self, unset=None):
+        return RAMView(self, unset)
+    
+    
+    # Returns the RAM contents as a list of (data, written) pages of bytes
+    # Pages that are the same as in `previous` reuse its objects, so a list of snapshots only stores each change once
+    def pages(self, previous=None):
+        page_bytes = RAM.PageWords * self.data.itemsize
+        data = self.data.tobytes()
+        written = bytes(self.written)
+        pages = list()
+        for i in range(0, (self.words + RAM.PageWords - 1) // RAM.PageWords):
+            page = ( data[i * page_bytes : (i + 1) * page_bytes],
+                     written[i * RAM.PageWords : (i + 1) * RAM.PageWords] )
+            if previous is not None and page == previous[i]:
+                page = previous[i]
+            pages.append(page)
+        return pages
+    
+    
+    # Loads the RAM contents back from a list of pages, in place (the engines keep references to the arrays)
+    def load_pages(self, pages):
+        memoryview(self.data).cast("B")[:] = b"".join(page[0] for page in pages)
+        self.written[:] = b"".join(page[1] for page in pages)
+        if self.bus.mapped:
+            self.bus.changed_all()
+
+
+
+
+# A read-only sequence over a RAM, which reads unset words as a placeholder value
+class RAMView:
+    def __init__(self, ram, unset=None):
+        self.ram = ram
+        self.unset = unset
+    
+    
+    def __len__(self):
+        return self.ram.words
+    
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.ram.words))]
+        
+        if self.ram.written[index]:
+            return self.ram.data[index]
+        return self.unset
+    
+    
+    def __iter__(self):
+        unset = self.unset
+        for value, written in zip(self.ram.data, self.ram.written):
+            yield value if written else unset
+    
+    
+    # Copies the view out into a plain list
+    def tolist(self):
+        return list(self)
 
 
 
 # A class to implement the program ROM, with an integrated program counter register
 class ProgramROM:
-    def __init__(self, data_bits, address_bits):
+    def __init__(self, data_bits, address_bits, cache=None):
         self.data_bits = data_bits
         self.address_bits = address_bits
         
+        # The assembly cache used to skip re-assembling unchanged sources
+        if cache is None:
+            cache = asmcache.default_cache
+        self.cache = cache
+        
         self.words = 2**self.address_bits
+        self.image = None
         self.clear()
         
         self.pc = Register(self.address_bits)
@@ -234,23 +376,63 @@ class ProgramROM:
     
     # Clear ROM
     def clear(self):
-        self.instructions = [None for _ in range(self.words)]
+        self.instructions = [None] * self.words
+        self.decoded = None
+        # Unmap the last binary, so reloading programs never leaks a mapping or keeps the file locked
+        if self.image is not None:
+            self.image.close()
+        self.image = None
+        # The disassembly of the loaded program, made the first time it is asked for
+        self.disassembly = None
     
     
-    # Parse a text file into instructions
+    # Load a program into the ROM, from either a .f80asm source file or a .f80bin binary
     def program(self, file_in):
+        if assembler.BinaryFormat.is_binary(file_in):
+            self.program_binary(file_in)
+        else:
+            self.program_assembly(file_in)
+    
+    
+    # Parse a text file into instructions
+    def program_assembly(self, file_in):
         # Erase
         self.clear()
         
-        # Make assembler for file
-        self.asm = assembler.Assembler(file_in)
-        
-        # Run assembly
-        self.asm.run()
+        # Assemble the file, or reuse the assembly of an identical source
+        self.asm = self.cache.assemble(file_in)
         
         # Program commands into ROM
         for instruction in self.asm.assembled_objects():
             self.instructions[instruction["address"]] = instruction
+        
+        # Decode the program once, into the compact form used by the fast engine
+        self.decoded = engine.decode_program(self.asm.assembled_objects(), self.data_bits, self.address_bits)
+    
+    
+    # Load assembled instruction objects straight into the ROM, for programs that were never written to a file
+    def program_objects(self, instructions):
+        # Erase
+        self.clear()
+        self.asm = None
+        
+        for instruction in instructions:
+            self.instructions[instruction["address"]] = instruction
+        self.decoded = engine.decode_program(instructions, self.data_bits, self.address_bits)
+    
+    
+    # Map a .f80bin file into the ROM
+    # The control words are used as-is by the fast engine, and instruction objects are only built when `read()` needs them
+    def program_binary(self, file_in):
+        # Erase
+        self.clear()
+        self.asm = None
+        
+        self.image = assembler.BinaryImage(file_in)
+        if self.image.data_bits != self.data_bits or self.image.address_bits != self.address_bits:
+            raise Exception("\"{}\" was built for {} bit data and {} bit addresses!".format(file_in, self.image.data_bits, self.image.address_bits))
+        
+        self.decoded = engine.decode_image(self.image, self.address_bits)
     
     
     def set_address(self, address):
@@ -265,16 +447,54 @@ class ProgramROM:
     
     
     def read(self):
-        return self.instructions[self.pc.get()]
+        address = self.pc.get()
+        instruction = self.instructions[address]
+        if instruction is None and self.image is not None and address < self.image.count:
+            instruction = self.instructions[address] = self.image.instruction(address)
+        return instruction
     
     
     def address(self):
         return self.pc.get()
     
     
+    # Return the instruction objects of the loaded program
+    def objects(self):
+        if self.image is not None:
+            return self.image.instructions()
+        if self.asm is None:
+            raise Exception("No program has been loaded into the ROM yet!")
+        return self.asm.assembled_objects()
+    
+    
+    # Return the symbol table of the loaded program as a {name : value} dict (None if a binary has no symbols)
+    def symbols(self):
+        if self.image is not None:
+            return self.image.symbols()
+        if self.asm is None:
+            raise Exception("No program has been loaded into the ROM yet!")
+        return self.asm.symbols()
+    
+    
+    # Return the source line of each instruction of the loaded program (None where it isn't known)
+    # This returns None if a binary was built without a source map
+    def source_map(self):
+        if self.image is not None:
+            lines = self.image.source_map()
+            if lines is None:
+                return None
+            return [None if line == 0 else line for line in lines]
+        if self.asm is None:
+            raise Exception("No program has been loaded into the ROM yet!")
+        return self.asm.source_map()
+    
+    
     # Return the processed assembly in it's human-readable symbolic form
+    # It is only disassembled once per program, so the list returned is shared and shouldn't be changed
     def processed_assembly(self):
-        return self.asm.processed_assembly()
+        if self.disassembly is None:
+            self.disassembly = assembler.disassemble(self.objects())
+        return self.disassembly
     
     
     # Return the current instruction in human readable form
@@ -283,6 +503,23 @@ class ProgramROM:
 
 
 
+# A saved copy of the full machine state: PC, A, B, MAR, the ALU, and the RAM pages
+# Registers are stored as (value, is set) pairs, and the ALU as (is unset, packed flags, accumulator)
+class Snapshot:
+    def __init__(self, registers, alu, pages):
+        self.registers = registers
+        self.alu = alu
+        self.pages = pages
+    
+    
+    # The number of RAM pages in this snapshot that aren't shared with `other`
+    def unshared_pages(self, other=None):
+        if other is None:
+            return len(self.pages)
+        return sum(1 for mine, theirs in zip(self.pages, other.pages) if mine is not theirs)
+
+
+
 # A class to represent the complete FET-80 hardware system
 class Fet80:
     def __init__(self):
@@ -302,12 +539,14 @@ class Fet80:
 
         # Make the ROM
         self.rom = ProgramROM(data_bits=self.data_bits, address_bits=self.address_bits)
+        
+        # The last snapshot taken or restored, whose unchanged RAM pages are shared with the next one
+        self.last_snapshot = None
     
     
     #  A function to program the ROM with an assembly file
     def program(self, file_in):
         self.rom.program(file_in)
-        self.rom.program(file_in)
     
     
     # A helper function to get the bit widths used in the system
@@ -397,9 +636,45 @@ class Fet80:
         return self.alu.flags()
     
     
-    # Returns the RAM register array
+    # Reads a single flag from the ALU
+    def flag(self, name):
+        return self.alu.flag(name)
+    
+    
+    # Returns a zero-copy view of the RAM words
     def get_RAM(self):
-        return self.ram.registers
+        return self.ram.view()
+    
+    
+    # Returns a zero-copy view of the RAM words, with unset words replaced by `unset`
+    def get_RAM_int(self, unset=None):
+        return self.ram.int_view(unset)
+    
+    
+    # Writes a word straight into RAM
+    def set_RAM(self, address, value):
+        self.ram.poke(address, value)
+    
+    
+    # Takes a snapshot of the machine state (the ROM isn't included)
+    def snapshot(self):
+        registers = dict()
+        for name, register in [("A", self.registers["A"]), ("B", self.registers["B"]), ("MAR", self.ram.address), ("PC", self.rom.pc)]:
+            registers[name] = (register.value, register.is_set())
+        alu = (self.alu.unset, self.alu.packed, self.alu.acc.value)
+        previous = None if self.last_snapshot is None else self.last_snapshot.pages
+        self.last_snapshot = Snapshot(registers, alu, self.ram.pages(previous))
+        return self.last_snapshot
+    
+    
+    # Puts the machine back into the state of a snapshot
+    def restore(self, snapshot):
+        for name, register in [("A", self.registers["A"]), ("B", self.registers["B"]), ("MAR", self.ram.address), ("PC", self.rom.pc)]:
+            register.value, register.set_flag = snapshot.registers[name]
+        self.alu.unset, self.alu.packed, self.alu.acc.value = snapshot.alu
+        self.alu.acc.set_flag = not self.alu.unset
+        self.ram.load_pages(snapshot.pages)
+        self.last_snapshot = snapshot
     
     
     # Return the processed assembly in it's human-readable symbolic form
@@ -409,14 +684,19 @@ class Fet80:
     
     # Return the current instruction in human readable form
     def instruction_asm(self):
-        return self.processed_assembly()[self.get_PC()]
+        return self.rom.instruction_asm()
 # ~~~~~~~~ End Hardware Definition ~~~~~~~~
 
 
 # ~~~~~~~~ Begin Emulator Definition ~~~~~~~~
+# The execution engines that can drive `Emulator.run()`
+Engines = { "fast"   : engine.FastEngine,
+            "blocks" : blocks.BlockEngine }
+
+
 # The main emulator class
 class Emulator:
-    def __init__(self):
+    def __init__(self, engine_name="fast"):
         # Make the FET-80 hardware system
         self.fet80 = Fet80()
         
@@ -426,12 +706,34 @@ class Emulator:
         # Make helpful decimal converters for printing and such
         self.dec_data = helpers.Dec2(self.fet80.bits()["data"])
         self.dec_address = helpers.Dec2(self.fet80.bits()["address"])
+        
+        # Make the execution engine used by `run()`, sharing the same hardware
+        if engine_name not in Engines:
+            raise Exception("\"{}\" is not a known engine! Options are: {}".format(engine_name, ", ".join(Engines.keys())))
+        self.engine = Engines[engine_name](self.fet80)
+        
+        # The number of instructions the last `run()` completed, and the PC where it found the program halted (or None)
+        self.executed = 0
+        self.halted = None
+        # The halt candidates of the loaded program, found the first time they are needed
+        self.halt_program = None
+        self.halt_addresses = None
+        
+        # The profiler and tracer are off until `enable_profiling()` and `enable_tracing()`, so the normal engine runs with no extra work at all
+        # While either is on, the engine that was picked is kept in `picked_engine`
+        self.profile = None
+        self.trace = None
+        self.picked_engine = None
     
     
     # load a program
     def load_program(self, file_in):
         self.current_program = file_in
         self.fet80.program(self.current_program)
+        # The counts of the last program mean nothing for this one, so profiling starts again from zero
+        # The profile is zeroed in place, so the engine and anyone holding it from `enable_profiling()` keep counting into it
+        if self.profile is not None:
+            self.profile.reset()
     
     
     # Returns the source code text of the current program
@@ -579,21 +881,21 @@ class Emulator:
             # Always
             jump = True
         elif instruction["opcode"] == assembler.AsmCodes.Opcode.JC:
-            jump = self.flags()["cout"]
+            jump = self.fet80.flag("cout")
         elif instruction["opcode"] == assembler.AsmCodes.Opcode.JNC:
-            jump = not self.flags()["cout"]
+            jump = not self.fet80.flag("cout")
         elif instruction["opcode"] == assembler.AsmCodes.Opcode.JEQZ:
-            jump = self.flags()["eqz"]
+            jump = self.fet80.flag("eqz")
         elif instruction["opcode"] == assembler.AsmCodes.Opcode.JNEZ:
-            jump = self.flags()["nez"]
+            jump = self.fet80.flag("nez")
         elif instruction["opcode"] == assembler.AsmCodes.Opcode.JGTZ:
-            jump = self.flags()["gtz"]
+            jump = self.fet80.flag("gtz")
         elif instruction["opcode"] == assembler.AsmCodes.Opcode.JLTZ:
-            jump = self.flags()["ltz"]
+            jump = self.fet80.flag("ltz")
         elif instruction["opcode"] == assembler.AsmCodes.Opcode.JGEZ:
-            jump = self.flags()["gez"]
+            jump = self.fet80.flag("gez")
         elif instruction["opcode"] == assembler.AsmCodes.Opcode.JLEZ:
-            jump = self.flags()["lez"]
+            jump = self.fet80.flag("lez")
         else:
             raise Exception("Invalid opcode for a J instruction! (address: {})".format(instruction["address"]))
         
@@ -629,199 +931,199 @@ class Emulator:
             raise Exception("Invalid instruction type! (address: {})".format(instruction["address"]))
     
     
-    # Returns the RAM register array
+    # Run up to `cycles` full instruction cycles on the execution engine, returning the number executed
+    # This gives the same results as calling `step()` that many times
+    # If `stops` is given, it stops early as soon as the PC reaches one of those ROM addresses
+    # If `detect_halts` is set, it also stops as soon as the program reaches a loop that can never change the machine state,
+    # setting `halted` to the PC instead of spinning there for the rest of the cycles
+    # `executed` is left at the number of instructions completed, even if one of them faulted
+    def run(self, cycles=1, stops=None, detect_halts=False):
+        self.halted = None
+        self.executed = 0
+        if stops is not None:
+            stops = frozenset(stops)
+        if not detect_halts:
+            try:
+                self.engine.run(cycles, stops)
+            finally:
+                self.executed = self.engine.executed
+            return self.executed
+        
+        candidates = self.halt_candidates()
+        user_stops = stops if stops is not None else frozenset()
+        run_stops = candidates | user_stops
+        while True:
+            pc = self.get_PC()
+            if pc in candidates and self.is_halted():
+                self.halted = pc
+                break
+            if self.executed >= cycles or (self.executed > 0 and pc in user_stops):
+                break
+            try:
+                self.engine.run(cycles - self.executed, run_stops)
+            finally:
+                self.executed += self.engine.executed
+        return self.executed
+    
+    
+    # Uses the instrumented fast engine while the profiler or tracer is on, and the engine that was picked otherwise
+    def update_engine(self):
+        if self.profile is None and self.trace is None:
+            if self.picked_engine is not None:
+                self.engine = self.picked_engine
+                self.picked_engine = None
+        else:
+            if self.picked_engine is None:
+                self.picked_engine = self.engine
+            self.engine = engine.FastEngine(self.fet80, profile=self.profile, trace=self.trace)
+    
+    
+    # Turns on the profiler, returning its `profiler.Profile`
+    # While it is on, `run()` uses the profiled fast engine, whichever engine was picked
+    def enable_profiling(self):
+        if self.profile is None:
+            self.profile = profiler.Profile(self.fet80.rom.words, self.fet80.ram.words)
+            self.update_engine()
+        return self.profile
+    
+    
+    # Turns off the profiler, going back to the engine that was picked (the counts are dropped)
+    def disable_profiling(self):
+        if self.profile is not None:
+            self.profile = None
+            self.update_engine()
+    
+    
+    # Starts streaming a trace of every executed instruction to `file_out`, returning its `tracer.TraceWriter`
+    # While it is on, `run()` uses the traced fast engine, whichever engine was picked
+    # `start_cycle` is the cycle number given to the first instruction traced
+    def enable_tracing(self, file_out, compression="none", batch=tracer.DefaultBatch, start_cycle=0):
+        self.disable_tracing()
+        self.trace = tracer.TraceWriter( file_out,
+                                         data_bits   = self.fet80.bits()["data"],
+                                         word_size   = array(array_typecode(max(self.fet80.bits().values()))).itemsize,
+                                         compression = compression,
+                                         batch       = batch,
+                                         start_cycle = start_cycle )
+        self.update_engine()
+        return self.trace
+    
+    
+    # Stops tracing and closes the trace file
+    def disable_tracing(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+            self.update_engine()
+    
+    
+    # Returns the source lines of the current program, or None if it was loaded from a binary
+    def source_lines(self):
+        if self.current_program is None or self.fet80.rom.image is not None:
+            return None
+        return self.source_code().splitlines()
+    
+    
+    # Returns everything the profiler counted as a JSON-ready dict, mapped back to the source lines
+    def profile_dump(self):
+        if self.profile is None:
+            raise Exception("The profiler is not enabled!")
+        return self.profile.dump(self.fet80.rom.source_map(), self.source_lines(), self.processed_assembly())
+    
+    
+    # Returns the profiler's hotspot report as text, sorted by one of `profiler.SortKeys`
+    def profile_report(self, sort_by="count", limit=20):
+        if self.profile is None:
+            raise Exception("The profiler is not enabled!")
+        return profiler.hotspot_report(self.profile, self.fet80.rom.source_map(), self.source_lines(), self.processed_assembly(), sort_by, limit)
+    
+    
+    # Returns a `timing.Estimate` of how long the profiled instructions would take on the real hardware
+    # It is worked out from the profiler's counts, so profiling has to be enabled while the program runs
+    def estimate_time(self, table=None, clock=timing.DefaultClock):
+        if self.profile is None:
+            raise Exception("The profiler is not enabled!")
+        return timing.Estimate(self.profile, self.fet80.rom.decoded, table, clock)
+    
+    
+    # Returns the addresses where the loaded program could halt (see `halts.halt_candidates`)
+    def halt_candidates(self):
+        if self.fet80.rom.decoded is None:
+            raise Exception("No program has been loaded into the ROM yet!")
+        if self.halt_program is not self.fet80.rom.decoded:
+            self.halt_addresses = halts.halt_candidates(self.fet80.rom.decoded)
+            self.halt_program = self.fet80.rom.decoded
+        return self.halt_addresses
+    
+    
+    # Is the program stuck at the current PC, in a loop that can never change the machine state?
+    def is_halted(self):
+        alu = self.fet80.alu
+        return halts.is_halted( self.fet80.rom.decoded,
+                                self.get_PC(),
+                                None if alu.unset else alu.get_ACC(),
+                                bool(alu.cout),
+                                alu.sign )
+    
+    
+    # Returns a zero-copy view of the RAM words (unset words read as 0)
     def get_RAM(self):
         return self.fet80.get_RAM()
     
     
-    # Returns the RAM as an integer array
+    # Returns the RAM as an integer sequence, with unset words replaced by `unset`
     def get_RAM_int(self, unset=None):
-        out = list()
-        for r in self.get_RAM():
-            if r.is_set():
-                out.append(r.get())
-            else:
-                out.append(unset)
-        
-        return out
-    
-    
-    # Return the processed assembly in it's human-readable symbolic form
-    def processed_assembly(self):
-        return self.fet80.processed_assembly()
-    
-    
-    # Return the current instruction in human readable form
-    def instruction_asm(self):
-        return self.processed_assembly()[self.get_PC()]
-# ~~~~~~~~ End Emulator Definition ~~~~~~~~
-
-
-# ~~~~~~~~ Begin GUI Definition ~~~~~~~~
-# The main window
-class MainWindow:
-    def __init__(self):
-        self.root = None
-        self.emu = Emulator()
-        self.padding = 6
-        self.last_load_dir = "."
-    
-    
-    # Load a program into the emulator
-    def load_program(self, file_in):
-        self.emu.load_program(file_in)
-        # Update the UI
-        self.set_textbox_text_numbered(self.source_text, self.source_code(), line_start=1)
-        self.set_textbox_text_numbered(self.code_text, self.program_code(), line_start=0)
-    
-    
-    # Get the current program source code
-    def source_code(self):
-        return self.emu.source_code()
-    
-    
-    # Get the current program code as a symbolic string
-    def program_code(self):
-        out = ""
-        for line in self.emu.processed_assembly():
-            out += line + "\n"
-        return out
-    
-    
-    # Open the GUI to load a file
-    def load_file_gui(self):
-        filetypes  = ( ("FET-80 assembly files", "*.f80asm" ),
-                       ("All files"     , "*.*") )
-        filename = filedialog.askopenfilename( title      = "Open a FET-80 Assembly File...",
-                                               initialdir = self.last_load_dir ,
-                                               filetypes  = filetypes )
-        self.last_load_dir = os.path.split(os.path.realpath(filename))[0]
-        self.load_program(filename)  
-    
-    
-    # Returns the frame of the navbar
-    def make_navbar(self):
-        self.navbar = tk.Button( self.root, 
-                                 text = "Load File...",
-                                 bd = 2,
-                                 command = self.load_file_gui )
-        return self.navbar
+        return self.fet80.get_RAM_int(unset)
     
     
-    # Returns the frame of the source code area
-    def make_source_area(self):
-        self.source_text = scrolledtext.ScrolledText( self.root, 
-                                                      wrap   = tk.NONE, 
-                                                      width  = 45, 
-                                                      height = 40, 
-                                                      font   = ("Courier New", 10),
-                                                      state  = tk.DISABLED )
-        return self.source_text
+    # Writes a word straight into RAM, without touching the memory address register
+    def set_RAM(self, address, value):
+        self.fet80.set_RAM(address, value)
     
     
-    # Sets a textbox's text
-    def set_textbox_text(self, text_object, text_in):
-        text_object.configure(state="normal")
-        text_object.delete(1.0, "end")
-        text_object.insert(1.0, text_in)
-        text_object.configure(state="disabled")
-    
-    
-    # Sets a textbox's text with numbered lines
-    def set_textbox_text_numbered(self, text_object, text_in, line_start=0, delimiter=". "):
-        text_lines = text_in.splitlines()
-        # Get the biggest number length
-        number_length = len(str(len(text_lines)))
-        text_processed = ""
-        for i, line in enumerate(text_lines):
-            new_line = str(line_start+i)
-            new_line = new_line.rjust(number_length)
-            new_line += delimiter + line + "\n"
-            text_processed += new_line
-        
-        self.set_textbox_text(text_object, text_processed)
+    # Maps a peripheral (a `devices.Device`) into RAM, returning it
+    # The engines switch to their device aware code while anything is attached
+    def attach_device(self, device):
+        self.fet80.ram.bus.attach(device)
+        return device
     
     
-    # Returns the frame of the program code area
-    def make_code_area(self):
-        self.code_text = scrolledtext.ScrolledText( self.root, 
-                                                    wrap   = tk.NONE, 
-                                                    width  = 45, 
-                                                    height = 20, 
-                                                    font   = ("Courier New", 10),
-                                                    state  = tk.DISABLED )
-        return self.code_text
+    # Unmaps a peripheral from RAM
+    def detach_device(self, device):
+        self.fet80.ram.bus.detach(device)
     
     
-    # Returns the frame of the RAM area
-    def make_RAM_area(self):
-        return tk.Label(self.root, text="I'll be RAM contents one day.", font="helvetica 12")
+    # Takes a snapshot of the machine state, which `restore()` can go back to
+    # RAM pages that haven't changed since the last snapshot are shared with it, so frequent snapshots stay small
+    def snapshot(self):
+        return self.fet80.snapshot()
     
     
-    # Returns the frame of the screen area
-    def make_screen_area(self):
-        return tk.Label(self.root, text="I'll be the screen one day.", font="helvetica 12")
+    # Puts the machine back into the state of a snapshot, keeping the loaded program
+    def restore(self, snapshot):
+        self.fet80.restore(snapshot)
+        self.halted = None
     
     
-    # Returns the frame of the info area
-    def make_info_area(self):
-        return tk.Label(self.root, text="I'll be status info one day.", font="helvetica 12")
+    # Return the processed assembly in it's human-readable symbolic form
+    def processed_assembly(self):
+        return self.fet80.processed_assembly()
     
     
-    # Main call
-    def run(self):
-        # Make window
-        self.root = tk.Tk()
-        
-        # Make navbar area
-        self.navbar = self.make_navbar()
-        self.navbar.grid(row=0, column=0, columnspan=3, padx=self.padding, pady=self.padding)
-        
-        # Make source text area
-        self.source_label = tk.Label(self.root, text="Source Assembly", font="helvetica 12")
-        self.source_label.grid(row=1, column=0, padx=self.padding, pady=self.padding)
-        self.source_area = self.make_source_area()
-        self.source_area.grid(row=2, column=0, rowspan=3, padx=self.padding, pady=self.padding)
-        
-        # Make program code area
-        self.source_label = tk.Label(self.root, text="Program Code", font="helvetica 12")
-        self.source_label.grid(row=1, column=1, padx=self.padding, pady=self.padding)
-        self.code_area = self.make_code_area()
-        self.code_area.grid(row=2, column=1, padx=self.padding, pady=self.padding)
-        
-        # Make screen area
-        self.screen_area = self.make_screen_area()
-        self.screen_area.grid(row=2, column=2, padx=self.padding, pady=self.padding)
-        
-        # Make RAM area
-        self.memory_area = self.make_RAM_area()
-        self.memory_area.grid(row=4, column=1, padx=self.padding, pady=self.padding)
-        
-        # Make info area
-        self.info_area = self.make_info_area()
-        self.info_area.grid(row=4, column=2, padx=self.padding, pady=self.padding)
-        
-        # Start main event loop
-        self.root.mainloop()
-# ~~~~~~~~ End GUI Definition ~~~~~~~~
+    # Return the current instruction in human readable form
+    def instruction_asm(self):
+        return self.fet80.instruction_asm()
+# ~~~~~~~~ End Emulator Definition ~~~~~~~~
 
 
 # ~~~~~~~~ Begin Main Program ~~~~~~~~
-# Make the main window
-main_window = MainWindow()
-
-# Run the main window loop
-main_window.run()
+# The GUI lives in its own module, so importing the emulator never needs tkinter or a display
+def main():
+    import gui
+    return gui.main()
 
-# Load the test code #TODO remove
-#main_window.load_program("../Code/XOR.f80asm")  
 
-'''
-def main():
-    return 0
-    
 if __name__ == '__main__':
     # Run main
     exit_code = main()
     sys.exit(exit_code)
-'''
\ No newline at end of file
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import queue
+import threading
+from array import array
+
+import engine
+
+
+# ~~~~~~~~ Begin State Tracking ~~~~~~~~
+# The clock settings, besides a number of instructions per second
+Unthrottled = None
+SingleStep = 0
+
+# The most instructions run in one slice, between two looks at the command queue
+MaxBatch = 1000000
+
+
+# Works out what changed in an `Emulator` since the last time it was asked
+class StateTracker:
+    def __init__(self, emu, max_ram_words=4096):
+        self.emu = emu
+        self.max_ram_words = max_ram_words
+        self.reset()
+    
+    
+    # Forgets the last state, so the next delta holds every register and asks for the whole RAM to be re-read
+    def reset(self):
+        self.registers = None
+        self.data = None
+        self.written = None
+    
+    
+    # Returns the registers as a {name : value} dict, with None for unset ones
+    def read_registers(self):
+        a, b, mar, acc, cout, pc = engine.read_state(self.emu.fet80)
+        return { "A"     : a,
+                 "B"     : b,
+                 "MAR"   : mar,
+                 "ACC"   : acc,
+                 "carry" : cout,
+                 "PC"    : pc }
+    
+    
+    # Returns the (registers, ram) that changed since the last call
+    # `registers` only holds the registers that changed, and `ram` is {address : value} with None for unset words,
+    # or None if more than `max_ram_words` words changed (or this is the first call) and the whole RAM should be re-read
+    def delta(self):
+        registers = self.read_registers()
+        if self.registers is None:
+            changed = registers
+        else:
+            changed = {name : value for name, value in registers.items() if self.registers[name] != value}
+        self.registers = registers
+        
+        # RAM is compared a page at a time, and only the pages that differ are compared word by word
+        ram = self.emu.fet80.ram
+        data = ram.data.tobytes()
+        written = bytes(ram.written)
+        words = None
+        if self.data is not None:
+            words = dict()
+            size = ram.data.itemsize
+            for start in range(0, ram.words, ram.PageWords):
+                end = start + ram.PageWords
+                if data[start * size : end * size] == self.data[start * size : end * size] and written[start:end] == self.written[start:end]:
+                    continue
+                new = array(ram.data.typecode, data[start * size : end * size])
+                old = array(ram.data.typecode, self.data[start * size : end * size])
+                for i in range(len(new)):
+                    if new[i] != old[i] or written[start + i] != self.written[start + i]:
+                        words[start + i] = new[i] if written[start + i] else None
+                if len(words) > self.max_ram_words:
+                    words = None
+                    break
+        self.data = data
+        self.written = written
+        return changed, words
+# ~~~~~~~~ End State Tracking ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Emulation Thread Definition ~~~~~~~~
+# Runs an `Emulator` on a worker thread, so the GUI never waits on it and it never waits on the GUI
+# Every change to the machine goes through the command methods, which queue the work for the worker
+# The worker publishes what changed to `updates` at most `publish_rate` times a second, and only once the last update has been taken,
+# so however fast the machine runs, the GUI handles one update (of at most `max_ram_words` words) per poll
+# `clock` is the target instructions per second, `Unthrottled`, or `SingleStep` to only ever run on `step()`
+# With a `timetravel.TimeTravel`, free running isn't recorded, but single steps are, and its cycle count is kept up to date
+class EmulationThread(threading.Thread):
+    def __init__(self, emu, time_travel=None, clock=Unthrottled, publish_rate=60, slice_time=0.02, max_ram_words=4096):
+        super().__init__(daemon=True)
+        self.emu = emu
+        self.time_travel = time_travel
+        self.publish_interval = 1 / publish_rate
+        self.slice_time = slice_time
+        self.tracker = StateTracker(emu, max_ram_words)
+        
+        self.commands = queue.Queue()
+        self.updates = queue.Queue()
+        
+        self.alive = True
+        self.running = False
+        self.status = "paused"
+        self.message = None
+        self.cycle = 0
+        # Is there anything the GUI hasn't been told about yet?
+        self.dirty = True
+        self.last_publish = 0.0
+        # The most instructions run per slice, sized to take about `slice_time`
+        self.batch = 1000
+        self.set_clock(clock)
+    
+    
+    # Starts running freely at the clock rate
+    def resume(self):
+        self.commands.put( ("resume",) )
+    
+    
+    # Stops running freely
+    def pause(self):
+        self.commands.put( ("pause",) )
+    
+    
+    # Pauses, and runs `cycles` instructions
+    def step(self, cycles=1):
+        self.commands.put( ("step", cycles) )
+    
+    
+    # Changes the clock
+    def change_clock(self, clock):
+        if clock is not None and clock < 0:
+            raise Exception("The clock can't be negative!")
+        self.commands.put( ("clock", clock) )
+    
+    
+    # Pauses, and calls `function()` on the worker thread (for stepping back, changing RAM and so on)
+    def call(self, function):
+        self.commands.put( ("call", function) )
+    
+    
+    # Stops the worker thread, waiting for it to finish
+    def shutdown(self):
+        self.commands.put( ("stop",) )
+        if self.is_alive():
+            self.join()
+    
+    
+    # Returns the newest update, or None if there isn't one
+    # An update is a dict of the cycle, the status ("running", "paused", "halted" or "fault"), the last fault message,
+    # and the registers and RAM words that changed since the update before (see `StateTracker.delta()`)
+    def take_update(self):
+        try:
+            return self.updates.get_nowait()
+        except queue.Empty:
+            return None
+    
+    
+    # The current cycle
+    def current_cycle(self):
+        if self.time_travel is not None:
+            return self.time_travel.cycle
+        return self.cycle
+    
+    
+    # Sets the clock, restarting the throttle
+    def set_clock(self, clock):
+        self.clock = clock
+        self.clock_start = time.perf_counter()
+        self.clock_cycles = 0
+        if self.clock == SingleStep:
+            self.running = False
+    
+    
+    # Runs up to `cycles` instructions, returning the number run
+    def execute(self, cycles, record):
+        if self.time_travel is not None:
+            start = self.time_travel.cycle
+            try:
+                self.time_travel.run(cycles, record=record)
+            finally:
+                done = self.time_travel.cycle - start
+        else:
+            try:
+                self.emu.run(cycles, detect_halts=True)
+            finally:
+                done = self.emu.executed
+                self.cycle += done
+        return done
+    
+    
+    # Runs `function()`, stopping and reporting a fault if it raises
+    def guarded(self, function):
+        try:
+            function()
+            return True
+        except Exception as e:
+            self.running = False
+            self.status = "fault"
+            self.message = str(e)
+            return False
+        finally:
+            self.dirty = True
+    
+    
+    # Handles a single command
+    def handle(self, command):
+        name = command[0]
+        if name == "resume":
+            if self.clock != SingleStep and self.status != "fault":
+                self.running = True
+                self.status = "running"
+                self.clock_start = time.perf_counter()
+                self.clock_cycles = 0
+        elif name == "pause":
+            self.running = False
+            self.status = "paused"
+        elif name == "step":
+            self.running = False
+            self.status = "paused"
+            self.message = None
+            self.guarded(lambda: self.execute(command[1], True))
+        elif name == "clock":
+            self.set_clock(command[1])
+        elif name == "call":
+            self.running = False
+            self.status = "paused"
+            self.message = None
+            self.guarded(command[1])
+        elif name == "stop":
+            self.alive = False
+        self.dirty = True
+    
+    
+    # Runs one slice of free running, keeping to the clock
+    # Returns how long to wait before the next slice is due
+    def run_slice(self):
+        if self.clock is Unthrottled:
+            cycles = self.batch
+        else:
+            due = int((time.perf_counter() - self.clock_start) * self.clock) - self.clock_cycles
+            if due <= 0:
+                return (1 - due) / self.clock
+            cycles = min(due, self.batch)
+        
+        start = time.perf_counter()
+        done = [0]
+        def run_cycles():
+            done[0] = self.execute(cycles, False)
+        if self.guarded(run_cycles):
+            if self.emu.get_PC() in self.emu.halt_candidates() and self.emu.is_halted():
+                self.running = False
+                self.status = "halted"
+        self.clock_cycles += done[0]
+        
+        # Size the batch from the last full one, so a slice takes about `slice_time`
+        if done[0] == self.batch:
+            elapsed = max(time.perf_counter() - start, 1e-6)
+            self.batch = max(1, min(MaxBatch, int(cycles * self.slice_time / elapsed)))
+        return 0
+    
+    
+    # Puts an update on the queue, if there is news, the GUI took the last one, and it is time
+    # Returns how long until it could publish next
+    def publish(self):
+        wait = self.last_publish + self.publish_interval - time.perf_counter()
+        if not self.dirty or wait > 0 or not self.updates.empty():
+            return max(wait, 0) if self.dirty else None
+        registers, ram = self.tracker.delta()
+        self.updates.put({ "cycle"     : self.current_cycle(),
+                           "status"    : self.status,
+                           "message"   : self.message,
+                           "registers" : registers,
+                           "ram"       : ram })
+        self.dirty = False
+        self.last_publish = time.perf_counter()
+        return None
+    
+    
+    # The worker loop
+    def run(self):
+        while self.alive:
+            wait = 0
+            if self.running:
+                wait = self.run_slice()
+            publish_wait = self.publish()
+            if not self.running:
+                # Check back at the publish rate while there is news the GUI hasn't taken yet
+                wait = self.publish_interval if publish_wait is not None or self.dirty else None
+            
+            # Wait for a command, but only as long as the next slice or update can wait
+            try:
+                command = self.commands.get(timeout=wait) if wait != 0 else self.commands.get_nowait()
+            except queue.Empty:
+                continue
+            self.handle(command)
+            while True:
+                try:
+                    self.handle(self.commands.get_nowait())
+                except queue.Empty:
+                    break
+# ~~~~~~~~ End Emulation Thread Definition ~~~~~~~~
+
+
+if __name__ == '__main__':
+    print("This module is not meant to be run on it's own!")
+    sys.exit()
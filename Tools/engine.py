@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+
+import sys
+
+import assembler
+import devices
+
+
+# ~~~~~~~~ Begin Instruction Decoding ~~~~~~~~
+# The error messages raised by the hardware, kept identical to the reference `Emulator.step()` path
+UnsetRegisterError = "The register has not been set yet, no value to get!"
+UnsetFlagsError = "ALU has not had any calculations run yet, no flags available!"
+
+
+# The python expressions used to read each source, and the checks that must pass first
+SourceReads = { assembler.AsmCodes.Src.A  : ( ["a is None"], "a" ),
+                assembler.AsmCodes.Src.B  : ( ["b is None"], "b" ),
+                assembler.AsmCodes.Src.M  : ( ["mar is None", "not written[mar]"], "data[mar]" ),
+                assembler.AsmCodes.Src.DV : ( [], "v" ) }
+
+# The python expressions used to read each destination (for C-instructions)
+DestReads = { assembler.AsmCodes.Dest.A : ( ["a is None"], "a" ),
+              assembler.AsmCodes.Dest.B : ( ["b is None"], "b" ),
+              assembler.AsmCodes.Dest.M : ( ["mar is None", "not written[mar]"], "data[mar]" ) }
+
+# The python statements used to write each destination, and the checks that must pass first
+DestWrites = { assembler.AsmCodes.Dest.A : ( [], ["a = {}"] ),
+               assembler.AsmCodes.Dest.B : ( [], ["b = {}"] ),
+               assembler.AsmCodes.Dest.M : ( ["mar is None"], ["data[mar] = {}", "written[mar] = 1"] ) }
+
+# The same RAM reads and writes for a core built to run with devices mapped into RAM
+# A word on a page with no devices still takes the plain path, after one look-up in the page table
+MappedCheck = "pages[mar >> {}] is None".format(devices.PageBits)
+MappedSourceReads = dict(SourceReads)
+MappedSourceReads[assembler.AsmCodes.Src.M] = ( ["mar is None", MappedCheck + " and not written[mar]"], "(data[mar] if {} else bus_read(mar))".format(MappedCheck) )
+MappedDestReads = dict(DestReads)
+MappedDestReads[assembler.AsmCodes.Dest.M] = MappedSourceReads[assembler.AsmCodes.Src.M]
+MappedDestWrites = dict(DestWrites)
+MappedDestWrites[assembler.AsmCodes.Dest.M] = ( ["mar is None"], ["data[mar] = {}", "written[mar] = 1", "if not " + MappedCheck + ": bus_write(mar, data[mar])"] )
+
+
+# Returns the (source reads, destination reads, destination writes) tables, for a plain core or one built for mapped devices
+def ram_tables(mapped=False):
+    if mapped:
+        return MappedSourceReads, MappedDestReads, MappedDestWrites
+    return SourceReads, DestReads, DestWrites
+
+
+# The python expressions used to test each jump condition (`acc` is the last ALU output)
+JumpConditions = { assembler.AsmCodes.Opcode.JMP  : None,
+                   assembler.AsmCodes.Opcode.JC   : "cout",
+                   assembler.AsmCodes.Opcode.JNC  : "not cout",
+                   assembler.AsmCodes.Opcode.JEQZ : "acc == 0",
+                   assembler.AsmCodes.Opcode.JNEZ : "acc != 0",
+                   assembler.AsmCodes.Opcode.JGTZ : "0 < acc < half",
+                   assembler.AsmCodes.Opcode.JLTZ : "acc >= half",
+                   assembler.AsmCodes.Opcode.JGEZ : "acc < half",
+                   assembler.AsmCodes.Opcode.JLEZ : "acc == 0 or acc >= half" }
+
+
+# What a single instruction can overwrite, besides the PC and the ALU
+NoTarget = 0
+TargetA = 1
+TargetB = 2
+TargetMAR = 3
+TargetRAM = 4
+
+
+# Returns what an instruction kind overwrites
+def kind_target(kind):
+    instruction_type, opcode, src, dest = kind
+    if instruction_type in [assembler.AsmCodes.InstructionType.T_INSTRUCTION, assembler.AsmCodes.InstructionType.C_INSTRUCTION]:
+        return { assembler.AsmCodes.Dest.A : TargetA,
+                 assembler.AsmCodes.Dest.B : TargetB,
+                 assembler.AsmCodes.Dest.M : TargetRAM }[dest]
+    if instruction_type == assembler.AsmCodes.InstructionType.M_INSTRUCTION:
+        return TargetMAR
+    return NoTarget
+
+
+# The python expressions that read back what each target holds after it was written, and the address it was written at
+TargetReads = { NoTarget  : ("0", "0"),
+                TargetA   : ("a", "0"),
+                TargetB   : ("b", "0"),
+                TargetMAR : ("mar", "0"),
+                TargetRAM : ("data[mar]", "mar") }
+
+# The fields of a trace record, in the order the traced core writes them
+# `alu` is the carry out (0 or 1) after the instruction, or 2 while the ALU is still unset
+TraceFields = ["pc", "op", "operand", "target", "address", "value", "acc", "alu"]
+
+
+# A helper to build the guard lines that raise the hardware errors
+def guard_lines(checks, message_name, indent):
+    lines = list()
+    for check in checks:
+        lines.append("{}if {}: raise Exception({})".format(indent, check, message_name))
+    return lines
+
+
+# Builds the profiling counter updates for an instruction that has passed all of its guards
+# `reads` and `writes` are the number of RAM reads and writes it does at `mar`
+def profile_lines(reads, writes, indent, jump=None):
+    lines = [indent + "counts[pc] += 1"]
+    if reads > 0:
+        lines.append(indent + "reads[mar] += {}".format(reads))
+    if writes > 0:
+        lines.append(indent + "writes[mar] += {}".format(writes))
+    if jump is not None:
+        lines.append(indent + "{}[pc] += 1".format(jump))
+    return lines
+
+
+# Builds the trace record append for an instruction that has completed (`tv` is its operand, bound when it is linked)
+def trace_lines(kind, indent):
+    value, address = TargetReads[kind_target(kind)]
+    op = assembler.MachineCode.encode_kind(*kind)
+    return [indent + "trace(pack(pc, {}, tv, {}, {}, {}, 0 if acc is None else acc, 2 if acc is None else cout))".format(op, kind_target(kind), address, value)]
+
+
+# Builds the body of the handler for one kind of instruction (`pc`, `v` and `nxt` are bound when it is linked)
+# Every handler reads all of its operands before it changes any state, so a failed read leaves the machine untouched
+# With `profile` set, the handler also counts its executions, jumps and RAM accesses
+# With `trace` set, it appends a record of what it did to the trace buffer once it has completed
+# With `mapped` set, its RAM accesses on pages with devices go through the device bus
+def handler_lines(kind, profile=False, trace=False, mapped=False):
+    instruction_type, opcode, src, dest = kind
+    source_reads, dest_reads, dest_writes = ram_tables(mapped)
+    ind = "            "
+    lines = list()
+    M = assembler.AsmCodes.Src.M
+    traced = trace_lines(kind, ind) if trace else []
+    
+    if instruction_type == assembler.AsmCodes.InstructionType.T_INSTRUCTION:
+        checks, x = source_reads[src]
+        lines += guard_lines(checks, "UnsetRegisterError", ind)
+        checks, writes = dest_writes[dest]
+        lines += guard_lines(checks, "UnsetRegisterError", ind)
+        if profile:
+            lines += profile_lines(int(src == M), int(dest == assembler.AsmCodes.Dest.M), ind)
+        lines += [ind + w.format(x) for w in writes]
+        lines += traced
+        lines.append(ind + "return nxt")
+    elif instruction_type == assembler.AsmCodes.InstructionType.M_INSTRUCTION:
+        checks, x = source_reads[src]
+        lines += guard_lines(checks, "UnsetRegisterError", ind)
+        if profile:
+            lines += profile_lines(int(src == M), 0, ind)
+        lines.append(ind + "mar = {} & amask".format(x))
+        lines += traced
+        lines.append(ind + "return nxt")
+    elif instruction_type == assembler.AsmCodes.InstructionType.C_INSTRUCTION:
+        checks, x = dest_reads[dest]
+        lines += guard_lines(checks, "UnsetRegisterError", ind)
+        lines.append(ind + "x = {}".format(x))
+        checks, y = source_reads[src]
+        lines += guard_lines(checks, "UnsetRegisterError", ind)
+        lines.append(ind + "y = {}".format(y))
+        checks, writes = dest_writes[dest]
+        lines += guard_lines(checks, "UnsetRegisterError", ind)
+        if profile:
+            dest_m = int(dest == assembler.AsmCodes.Dest.M)
+            lines += profile_lines(dest_m + int(src == M), dest_m, ind)
+        # The carry always comes from the adder, even for a NAND
+        lines.append(ind + "cout = x + y > dmask")
+        if opcode == assembler.AsmCodes.Opcode.ADD:
+            lines.append(ind + "acc = (x + y) & dmask")
+        else:
+            lines.append(ind + "acc = ~(x & y) & dmask")
+        lines += [ind + w.format("acc") for w in writes]
+        lines += traced
+        lines.append(ind + "return nxt")
+    elif instruction_type == assembler.AsmCodes.InstructionType.J_INSTRUCTION:
+        condition = JumpConditions[opcode]
+        checks, x = source_reads[src]
+        if condition is None:
+            lines += guard_lines(checks, "UnsetRegisterError", ind)
+            if profile:
+                lines += profile_lines(int(src == M), 0, ind, "taken")
+            lines += traced
+            lines.append(ind + "return {} & amask".format(x))
+        else:
+            lines += guard_lines(["acc is None"], "UnsetFlagsError", ind)
+            lines.append(ind + "if {}:".format(condition))
+            lines += guard_lines(checks, "UnsetRegisterError", ind + "    ")
+            if profile:
+                lines += profile_lines(int(src == M), 0, ind + "    ", "taken")
+            lines += ["    " + line for line in traced]
+            lines.append(ind + "    return {} & amask".format(x))
+            if profile:
+                lines += profile_lines(0, 0, ind, "not_taken")
+            lines += traced
+            lines.append(ind + "return nxt")
+    elif instruction_type == assembler.AsmCodes.InstructionType.D_INSTRUCTION:
+        # A `NOP` leaves the PC where it is, just like `Emulator.run_D`
+        if profile:
+            lines += profile_lines(0, 0, ind)
+        lines += traced
+        lines.append(ind + "return pc")
+    
+    return lines
+
+
+# Lists every (type, opcode, src, dest) combination the hardware can execute
+def instruction_kinds():
+    codes = assembler.AsmCodes
+    kinds = list()
+    for dest in codes.Dest:
+        for src in codes.Src:
+            kinds.append( (codes.InstructionType.T_INSTRUCTION, codes.Opcode.MOV, src, dest) )
+    for src in codes.Src:
+        kinds.append( (codes.InstructionType.M_INSTRUCTION, codes.Opcode.MEM, src, None) )
+    for opcode in [codes.Opcode.ADD, codes.Opcode.NAND]:
+        for dest in codes.Dest:
+            for src in codes.Src:
+                kinds.append( (codes.InstructionType.C_INSTRUCTION, opcode, src, dest) )
+    for opcode in JumpConditions.keys():
+        for src in codes.Src:
+            kinds.append( (codes.InstructionType.J_INSTRUCTION, opcode, src, None) )
+    kinds.append( (codes.InstructionType.D_INSTRUCTION, codes.Opcode.NOP, None, None) )
+    return kinds
+
+
+# Every executable instruction kind, keyed by its machine code control word (which doubles as its handler index)
+Kinds = {assembler.MachineCode.encode_kind(*kind) : kind for kind in instruction_kinds()}
+
+# The handler index used for ROM words that were never programmed
+EmptyOp = assembler.MachineCode.EmptyWord
+
+# The size of the handler table, big enough for any control word
+TableSize = 2 ** 13
+
+
+# Decodes a single assembled instruction object into a compact (op, value) tuple
+def decode(instruction, data_bits, address_bits):
+    op, value = assembler.MachineCode.encode(instruction, data_bits, address_bits)
+    if op not in Kinds:
+        raise Exception("Invalid instruction! (address: {})".format(instruction["address"]))
+    return (op, value)
+
+
+# A full ROM image of (op, value) tuples, indexed by address
+# It also keeps the sorted list of its programmed addresses, so linking and analysing a program never has to scan the empty words
+class DecodedROM(list):
+    def __init__(self, words, addresses):
+        super().__init__(words)
+        self.addresses = addresses
+
+
+# Decodes a list of assembled instruction objects into a full ROM image of (op, value) tuples
+def decode_program(instructions, data_bits, address_bits):
+    empty = (EmptyOp, None)
+    decoded = DecodedROM([empty] * (2 ** address_bits), sorted({instruction["address"] for instruction in instructions}))
+    for instruction in instructions:
+        decoded[instruction["address"]] = decode(instruction, data_bits, address_bits)
+    return decoded
+
+
+# Builds a full ROM image of (op, value) tuples straight from the control and value words of a .f80bin image
+def decode_image(image, address_bits):
+    for op in set(image.words):
+        if op not in Kinds:
+            raise Exception("Invalid instruction control word: {}".format(op))
+    words = list(zip(image.words, image.values))
+    words += [(EmptyOp, None)] * (2 ** address_bits - len(words))
+    return DecodedROM(words, [address for address, op in enumerate(image.words) if op != EmptyOp])
+# ~~~~~~~~ End Instruction Decoding ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Core Generation ~~~~~~~~
+# Generates the source of the core factory
+# The machine state lives in closure cells shared by every handler
+# Each programmed ROM address is linked to its own handler, so the run loop does one indexed call per instruction
+# The profiled core takes the counter arrays of a `profiler.Profile` too, and every handler updates them
+# The traced core takes the record packer and the append of the record buffer of a `tracer.TraceWriter`, and every handler appends to it
+# The mapped core takes the page table and the read and write of a `devices.DeviceBus`, and sends the RAM accesses of mapped pages to it
+def core_source(profile=False, trace=False, mapped=False):
+    arguments = ["data", "written", "dmask", "amask", "half"]
+    if profile:
+        arguments += ["counts", "taken", "not_taken", "reads", "writes"]
+    if trace:
+        arguments += ["trace", "pack"]
+    if mapped:
+        arguments += ["pages", "bus_read", "bus_write"]
+    lines = [ "def make_core({}):".format(", ".join(arguments)),
+              "    a = b = mar = acc = None",
+              "    cout = False",
+              "    pc = 0",
+              "    executed = 0",
+              "    linked = None",
+              "" ]
+    
+    for op, kind in Kinds.items():
+        lines.append("    def op_{}(pc, v):".format(op))
+        lines.append("        nxt = (pc + 1) & amask")
+        if trace:
+            lines.append("        tv = 0 if v is None else v")
+        lines.append("        def handler():")
+        lines.append("            nonlocal a, b, mar, acc, cout")
+        lines += handler_lines(kind, profile, trace, mapped)
+        lines.append("        return handler")
+        lines.append("")
+    
+    lines += [ "    def empty():",
+               "        raise Exception(\"No instruction at the current ROM address!\")",
+               "",
+               "    factories = [None] * {}".format(TableSize) ]
+    for op in Kinds.keys():
+        lines.append("    factories[{}] = op_{}".format(op, op))
+    lines += [ "",
+               "    def link(code):",
+               "        nonlocal linked",
+               "        linked = [empty] * len(code)",
+               "        for address in code.addresses:",
+               "            op, v = code[address]",
+               "            linked[address] = factories[op](address, v)",
+               "",
+               "    def load(state):",
+               "        nonlocal a, b, mar, acc, cout, pc",
+               "        a, b, mar, acc, cout, pc = state",
+               "",
+               "    def save():",
+               "        return a, b, mar, acc, cout, pc",
+               "",
+               "    def run(cycles, stops=None):",
+               "        nonlocal pc, executed",
+               "        code = linked",
+               "        p = pc",
+               "        n = 0",
+               "        try:",
+               "            if stops is None:",
+               "                for n in range(cycles):",
+               "                    p = code[p]()",
+               "                n = cycles",
+               "            else:",
+               "                for n in range(cycles):",
+               "                    p = code[p]()",
+               "                    if p in stops:",
+               "                        n += 1",
+               "                        break",
+               "                else:",
+               "                    n = cycles",
+               "        finally:",
+               "            pc = p",
+               "            executed = n",
+               "        return n",
+               "",
+               "    def count():",
+               "        return executed",
+               "",
+               "    return link, load, save, run, count" ]
+    
+    return "\n".join(lines) + "\n"
+
+
+# Compiles a core factory, once per kind of core
+core_factories = dict()
+def core_factory(profile=False, trace=False, mapped=False):
+    if (profile, trace, mapped) not in core_factories:
+        namespace = { "UnsetRegisterError" : UnsetRegisterError,
+                      "UnsetFlagsError"    : UnsetFlagsError }
+        name = "<fet80{}{}{} core>".format(" profiled" if profile else "", " traced" if trace else "", " mapped" if mapped else "")
+        exec(compile(core_source(profile, trace, mapped), name, "exec"), namespace)
+        core_factories[(profile, trace, mapped)] = namespace["make_core"]
+    return core_factories[(profile, trace, mapped)]
+
+
+# The plain core is compiled at import time, and the other cores only when they are first used
+make_core = core_factory()
+# ~~~~~~~~ End Core Generation ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Fast Engine Definition ~~~~~~~~
+# Reads the hardware state of a `Fet80` as an (A, B, MAR, ACC, carry, PC) tuple, with `None` for unset registers
+def read_state(fet80):
+    a = fet80.registers["A"]
+    b = fet80.registers["B"]
+    mar = fet80.ram.address
+    return ( a.value if a.is_set() else None,
+             b.value if b.is_set() else None,
+             mar.value if mar.is_set() else None,
+             None if fet80.alu.unset else fet80.alu.get_ACC(),
+             bool(fet80.alu.cout),
+             fet80.get_PC() )
+
+
+# Writes an (A, B, MAR, ACC, carry, PC) tuple back into the hardware of a `Fet80`
+def write_state(fet80, state):
+    a, b, mar, acc, cout, pc = state
+    if a is not None:
+        fet80.set_A(a)
+    if b is not None:
+        fet80.set_B(b)
+    if mar is not None:
+        fet80.set_M_address(mar)
+    if acc is not None:
+        fet80.alu.load(acc, cout)
+    fet80.set_PC(pc)
+
+
+# A fast execution engine for a `Fet80`, running the decoded ROM with table dispatch
+# Given a `profiler.Profile`, it runs the profiled core instead, which counts into it
+# Given a `tracer.TraceWriter`, it runs the traced core, flushing the writer every `batch` instructions
+# While any device is attached to the RAM's bus, it runs the mapped core
+class FastEngine:
+    def __init__(self, fet80, profile=None, trace=None):
+        self.fet80 = fet80
+        self.profile = profile
+        self.trace = trace
+        self.completed = 0
+        self.build_core()
+    
+    
+    # Makes a new core for the current device mapping, which has to be linked again before it runs
+    def build_core(self):
+        data_bits = self.fet80.bits()["data"]
+        address_bits = self.fet80.bits()["address"]
+        bus = self.fet80.ram.bus
+        self.linked = None
+        self.mapped = bus.mapped
+        parameters = { "data"    : self.fet80.ram.data,
+                       "written" : self.fet80.ram.written,
+                       "dmask"   : 2 ** data_bits - 1,
+                       "amask"   : 2 ** address_bits - 1,
+                       "half"    : 2 ** (data_bits - 1) }
+        if self.profile is not None:
+            parameters.update(self.profile.counters())
+        if self.trace is not None:
+            parameters["trace"] = self.trace.records.extend
+            parameters["pack"] = self.trace.pack
+        if self.mapped:
+            parameters["pages"] = bus.pages
+            parameters["bus_read"] = bus.read
+            parameters["bus_write"] = bus.write
+        factory = core_factory(self.profile is not None, self.trace is not None, self.mapped)
+        self.link, self.load, self.save, self.core_run, self.count = factory(**parameters)
+    
+    
+    # The number of instructions completed by the last run, even if it faulted
+    @property
+    def executed(self):
+        return self.completed
+    
+    
+    # Copies the hardware state into the core
+    def sync_in(self):
+        self.load(read_state(self.fet80))
+    
+    
+    # Copies the core state back into the hardware
+    def sync_out(self):
+        write_state(self.fet80, self.save())
+    
+    
+    # Runs up to `cycles` instructions, returning the number actually executed
+    # If `stops` is a set of ROM addresses, it also stops as soon as the PC reaches one of them
+    # If an instruction faults, the machine is left at the faulting instruction and the error is re-raised
+    def run(self, cycles=1, stops=None):
+        if self.fet80.rom.decoded is None:
+            raise Exception("No program has been loaded into the ROM yet!")
+        if self.mapped != self.fet80.ram.bus.mapped:
+            self.build_core()
+        
+        # Link handlers to the ROM addresses once per loaded program
+        if self.linked is not self.fet80.rom.decoded:
+            self.link(self.fet80.rom.decoded)
+            self.linked = self.fet80.rom.decoded
+        
+        # A traced run goes in batches, so the trace buffer never holds more than one batch of records
+        batch = cycles if self.trace is None else self.trace.batch
+        self.completed = 0
+        self.sync_in()
+        try:
+            while True:
+                chunk = min(cycles - self.completed, batch)
+                try:
+                    self.core_run(chunk, stops)
+                finally:
+                    self.completed += self.count()
+                    if self.trace is not None:
+                        self.trace.flush()
+                # A stop on the last instruction of a chunk still ends the run, like it would in one long chunk
+                if self.count() < chunk or self.completed >= cycles or (stops is not None and self.save()[5] in stops):
+                    break
+        finally:
+            self.sync_out()
+        return self.completed
+# ~~~~~~~~ End Fast Engine Definition ~~~~~~~~
+
+
+if __name__ == '__main__':
+    print("This module is not meant to be run on it's own!")
+    sys.exit()
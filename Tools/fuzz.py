@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import helpers
+import assembler
+import engine
+import blocks
+import profiler
+from emulator import Emulator
+
+
+# ~~~~~~~~ Begin Program Generation ~~~~~~~~
+# Every instruction kind the hardware can execute, and how often the generator picks each type
+AllKinds = list(engine.Kinds.values())
+TypeWeights = { assembler.AsmCodes.InstructionType.T_INSTRUCTION : 4,
+                assembler.AsmCodes.InstructionType.M_INSTRUCTION : 2,
+                assembler.AsmCodes.InstructionType.C_INSTRUCTION : 4,
+                assembler.AsmCodes.InstructionType.J_INSTRUCTION : 3,
+                assembler.AsmCodes.InstructionType.D_INSTRUCTION : 0.1 }
+
+# The RAM addresses the generated programs and states use, kept small so reads often hit written words
+FuzzRAMWords = 32
+
+
+# Returns a data value that is often at an edge of the data width, and sometimes outside it (to test the overflow)
+def random_data(rng, bits):
+    mask = 2 ** bits - 1
+    half = 2 ** (bits - 1)
+    return rng.choice([ 0, 1, 2, half - 1, half, half + 1, mask - 1, mask, mask + 1, -1,
+                        rng.randrange(-mask, 2 * mask),
+                        rng.randrange(mask + 1),
+                        rng.randrange(mask + 1) ])
+
+
+# Returns a random program of `length` instructions, as assembled instruction objects
+# Jumps mostly land inside the program and MEM mostly points at the first few RAM words, but both sometimes go past the end
+def random_program(rng, length, data_bits=assembler.Fet80Params.DataWidth, address_bits=assembler.Fet80Params.AddressWidth):
+    kinds = [kind for kind in AllKinds if TypeWeights[kind[0]] > 0]
+    weights = [TypeWeights[kind[0]] for kind in kinds]
+    instructions = list()
+    for address in range(length):
+        instruction_type, opcode, src, dest = rng.choices(kinds, weights)[0]
+        value = None
+        if src == assembler.AsmCodes.Src.DV:
+            if instruction_type == assembler.AsmCodes.InstructionType.J_INSTRUCTION:
+                value = rng.randrange(length + 2) if rng.random() < 0.95 else rng.randrange(-2, 2 ** address_bits + 2)
+            elif instruction_type == assembler.AsmCodes.InstructionType.M_INSTRUCTION:
+                value = rng.randrange(FuzzRAMWords) if rng.random() < 0.9 else random_data(rng, address_bits)
+            else:
+                value = rng.randrange(FuzzRAMWords) if rng.random() < 0.3 else random_data(rng, data_bits)
+        instructions.append({ "type"    : instruction_type,
+                              "address" : address,
+                              "opcode"  : opcode,
+                              "value"   : value,
+                              "src"     : src,
+                              "dest"    : dest })
+    return instructions
+
+
+# Returns a random initial machine state, as a dict of register values (None is unset) and {address : value} RAM words
+def random_state(rng, data_bits=assembler.Fet80Params.DataWidth):
+    def register(bits):
+        return None if rng.random() < 0.3 else random_data(rng, bits)
+    return { "A"   : register(data_bits),
+             "B"   : register(data_bits),
+             "MAR" : None if rng.random() < 0.3 else rng.randrange(FuzzRAMWords),
+             "ram" : {address : random_data(rng, data_bits) for address in rng.sample(range(FuzzRAMWords), rng.randrange(FuzzRAMWords))} }
+
+
+# Returns the random case for a seed, as a (program, state) tuple
+def random_case(seed, max_length=40):
+    rng = random.Random(seed)
+    program = random_program(rng, rng.randrange(1, max_length + 1))
+    return program, random_state(rng)
+# ~~~~~~~~ End Program Generation ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Differential Testing ~~~~~~~~
+# The engines that can be tested against `Emulator.step()`, each made from a `Fet80`
+Candidates = { "fast"     : lambda fet80: engine.FastEngine(fet80),
+               "blocks"   : lambda fet80: blocks.BlockEngine(fet80),
+               "profiled" : lambda fet80: engine.FastEngine(fet80, profile=profiler.Profile(fet80.rom.words, fet80.ram.words)) }
+
+# The checks that compare an engine against itself rather than against `step()`, each made from its name
+SelfChecks = { "traced" : lambda name: BatchPair(name) }
+
+# The error raised for an empty ROM word, which `step()` trips over with a TypeError instead
+EmptyROMError = "No instruction at the current ROM address!"
+
+
+# Loads a case into an emulator, resetting it to `blank` first
+def load_case(emu, blank, program, state):
+    emu.restore(blank)
+    emu.fet80.rom.program_objects(program)
+    if state["A"] is not None:
+        emu.fet80.set_A(state["A"])
+    if state["B"] is not None:
+        emu.fet80.set_B(state["B"])
+    if state["MAR"] is not None:
+        emu.fet80.set_M_address(state["MAR"])
+    for address, value in state["ram"].items():
+        emu.set_RAM(address, value)
+
+
+# Returns everything that makes up the machine state of a `Fet80`, in a form that can be compared
+def machine_state(fet80):
+    return { "registers" : engine.read_state(fet80),
+             "alu"       : (fet80.alu.unset, fet80.alu.packed),
+             "ram"       : (fet80.ram.data.tobytes(), bytes(fet80.ram.written)) }
+
+
+# Returns the names of the parts of two machine states that differ
+def state_differences(reference, candidate):
+    differences = list()
+    for i, name in enumerate(["A", "B", "MAR", "ACC", "cout", "PC"]):
+        if reference["registers"][i] != candidate["registers"][i]:
+            differences.append(name)
+    if reference["alu"] != candidate["alu"]:
+        differences.append("flags")
+    if reference["ram"] != candidate["ram"]:
+        differences.append("RAM")
+    return differences
+
+
+# Runs up to `cycles` reference steps, returning (steps completed, error or None)
+def reference_run(emu, cycles):
+    for n in range(cycles):
+        if emu.fet80.instruction() is None:
+            return n, EmptyROMError
+        try:
+            emu.step()
+        except Exception as e:
+            return n, str(e)
+    return cycles, None
+
+
+# Runs up to `cycles` instructions on a candidate engine, returning (instructions completed, error or None)
+def candidate_run(candidate, cycles):
+    try:
+        candidate.run(cycles)
+    except Exception as e:
+        return candidate.executed, str(e)
+    return candidate.executed, None
+
+
+# A pair of emulators sharing nothing, one stepped with the reference `step()` and one run on a candidate engine
+class DiffPair:
+    def __init__(self, candidate_name):
+        if candidate_name not in Candidates:
+            raise Exception("\"{}\" is not a known candidate! Options are: {}".format(candidate_name, ", ".join(Candidates.keys())))
+        self.candidate_name = candidate_name
+        self.reference = Emulator()
+        self.reference_blank = self.reference.snapshot()
+        self.emu = Emulator()
+        self.emu_blank = self.emu.snapshot()
+        # Engines link each newly loaded program themselves, so one candidate serves every case
+        self.candidate = Candidates[candidate_name](self.emu.fet80)
+    
+    
+    # Runs a case on both sides, comparing them every `checkpoint` cycles
+    # Returns None if they agree, otherwise the first divergence as a dict
+    # When a checkpoint disagrees, the case is run again one cycle at a time to find the exact cycle it diverged at
+    def check(self, program, state, cycles, checkpoint=1):
+        load_case(self.reference, self.reference_blank, program, state)
+        load_case(self.emu, self.emu_blank, program, state)
+        
+        done = 0
+        while done < cycles:
+            chunk = min(checkpoint, cycles - done)
+            reference_done, reference_error = reference_run(self.reference, chunk)
+            candidate_done, candidate_error = candidate_run(self.candidate, chunk)
+            reference_state = machine_state(self.reference.fet80)
+            candidate_state = machine_state(self.emu.fet80)
+            
+            differences = state_differences(reference_state, candidate_state)
+            if reference_done != candidate_done:
+                differences.append("cycles")
+            if reference_error != candidate_error:
+                differences.append("error")
+            if len(differences) > 0:
+                if checkpoint > 1:
+                    return self.check(program, state, done + chunk, 1)
+                return { "cycle"       : done,
+                         "differences" : differences,
+                         "reference"   : describe_state(self.reference.fet80, reference_done, reference_error),
+                         "candidate"   : describe_state(self.emu.fet80, candidate_done, candidate_error) }
+            
+            done += chunk
+            if reference_error is not None:
+                break
+        return None
+
+
+# Checks that traced runs stop at the same cycle as an untraced run, whatever the trace batch size
+# Each case runs with halt detection and stops at every jump target, so stops land on every position within a batch
+class BatchPair:
+    Batches = range(1, 6)
+    
+    def __init__(self, candidate_name):
+        self.candidate_name = candidate_name
+        self.reference = Emulator()
+        self.reference_blank = self.reference.snapshot()
+        self.emu = Emulator()
+        self.emu_blank = self.emu.snapshot()
+    
+    
+    # Runs a case with halt detection and stops, returning (instructions completed, halted PC, error or None)
+    def run(self, emu, program, cycles):
+        stops = {instruction["value"] for instruction in program if instruction["type"] == assembler.AsmCodes.InstructionType.J_INSTRUCTION}
+        try:
+            emu.run(cycles, stops=stops, detect_halts=True)
+        except Exception as e:
+            return emu.executed, emu.halted, str(e)
+        return emu.executed, emu.halted, None
+    
+    
+    # Runs a case untraced and then traced with each batch size
+    # Returns None if they all agree, otherwise the first divergence as a dict
+    def check(self, program, state, cycles, checkpoint=1):
+        load_case(self.reference, self.reference_blank, program, state)
+        reference_done, reference_halted, reference_error = self.run(self.reference, program, cycles)
+        reference_state = machine_state(self.reference.fet80)
+        
+        for batch in BatchPair.Batches:
+            load_case(self.emu, self.emu_blank, program, state)
+            self.emu.enable_tracing(os.devnull, batch=batch)
+            try:
+                done, halted, error = self.run(self.emu, program, cycles)
+            finally:
+                self.emu.disable_tracing()
+            
+            differences = state_differences(reference_state, machine_state(self.emu.fet80))
+            if reference_done != done:
+                differences.append("cycles")
+            if reference_halted != halted:
+                differences.append("halted")
+            if reference_error != error:
+                differences.append("error")
+            if len(differences) > 0:
+                return { "cycle"       : min(reference_done, done),
+                         "batch"       : batch,
+                         "differences" : differences,
+                         "reference"   : describe_state(self.reference.fet80, reference_done, reference_error),
+                         "candidate"   : describe_state(self.emu.fet80, done, error) }
+        return None
+
+
+# Returns a JSON-ready description of the machine state of a `Fet80`, with only the RAM words that have been written
+def describe_state(fet80, completed, error):
+    a, b, mar, acc, cout, pc = engine.read_state(fet80)
+    ram = fet80.ram
+    return { "completed" : completed,
+             "error"     : error,
+             "registers" : {"A" : a, "B" : b, "MAR" : mar, "ACC" : acc, "cout" : cout, "PC" : pc},
+             "flags"     : fet80.alu.packed,
+             "ram"       : {address : ram.data[address] for address in range(ram.words) if ram.written[address]} }
+# ~~~~~~~~ End Differential Testing ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Shrinking ~~~~~~~~
+# Removes the instruction at `index`, moving everything after it back one address and fixing up the jumps past it
+def remove_instruction(program, index):
+    shrunk = list()
+    for instruction in program[:index] + program[index + 1:]:
+        instruction = dict(instruction)
+        instruction["address"] = len(shrunk)
+        if instruction["type"] == assembler.AsmCodes.InstructionType.J_INSTRUCTION and instruction["value"] is not None and instruction["value"] > index:
+            instruction["value"] -= 1
+        shrunk.append(instruction)
+    return shrunk
+
+
+# Yields smaller versions of a failing case, simplest changes first
+def shrink_candidates(program, state):
+    # Drop instructions, from the end (where they are least likely to matter)
+    for index in reversed(range(len(program))):
+        if len(program) > 1:
+            yield remove_instruction(program, index), state
+    # Drop initial RAM words and registers
+    for address in list(state["ram"].keys()):
+        smaller = dict(state, ram={a : v for a, v in state["ram"].items() if a != address})
+        yield program, smaller
+    for name in ["A", "B", "MAR"]:
+        if state[name] is not None:
+            yield program, dict(state, **{name : None})
+    # Make direct values and initial values simpler
+    for index, instruction in enumerate(program):
+        if instruction["value"] not in [None, 0] and instruction["type"] != assembler.AsmCodes.InstructionType.J_INSTRUCTION:
+            simpler = list(program)
+            simpler[index] = dict(instruction, value=0)
+            yield simpler, state
+    for name in ["A", "B", "MAR"]:
+        if state[name] not in [None, 0]:
+            yield program, dict(state, **{name : 0})
+
+
+# Shrinks a failing case until no single simplification still fails, returning the smallest (program, state, divergence)
+def shrink(pair, program, state, cycles, divergence, max_attempts=2000):
+    cycles = min(cycles, divergence["cycle"] + 1)
+    attempts = 0
+    improved = True
+    while improved and attempts < max_attempts:
+        improved = False
+        for smaller_program, smaller_state in shrink_candidates(program, state):
+            attempts += 1
+            result = pair.check(smaller_program, smaller_state, cycles)
+            if result is not None:
+                program, state, divergence = smaller_program, smaller_state, result
+                cycles = min(cycles, divergence["cycle"] + 1)
+                improved = True
+                break
+            if attempts >= max_attempts:
+                break
+    return program, state, cycles, divergence
+
+
+# Returns a readable listing of a case, with the initial state in comments
+# Not every program the generator makes can be written as .f80asm (jumps to a register can't be assembled), so this is only for reading,
+# and the case itself is kept as a .f80bin (see `write_case()`)
+# Direct values are shown already overflowed, which is how the registers treat them
+def case_listing(program, state, data_bits=assembler.Fet80Params.DataWidth, address_bits=assembler.Fet80Params.AddressWidth):
+    normalized = list()
+    for instruction in program:
+        instruction = dict(instruction)
+        if instruction["value"] is not None:
+            instruction["value"] = assembler.MachineCode.encode(instruction, data_bits, address_bits)[1]
+        normalized.append(instruction)
+    lines = [ "# Initial state: A={}, B={}, MAR={}".format(state["A"], state["B"], state["MAR"]),
+              "# Initial RAM: {}".format(json.dumps({str(a) : v for a, v in sorted(state["ram"].items())})) ]
+    lines += ["{}: {}".format(address, line) for address, line in enumerate(assembler.disassemble(normalized))]
+    return "\n".join(lines) + "\n"
+
+
+# Returns the `runner.py` arguments that set up the initial RAM of a case
+# The runner can't set registers, so a case with initial registers only reproduces exactly through `--replay`
+def runner_arguments(state, data_bits=assembler.Fet80Params.DataWidth):
+    arguments = list()
+    for address, value in sorted(state["ram"].items()):
+        arguments += ["-r", "{}={}".format(address, value % 2 ** data_bits)]
+    return arguments
+
+
+# Writes a failure as `name`.f80bin (the exact program), `name`.txt (its listing) and `name`.json (the state and divergence)
+def write_case(name, failure):
+    assembler.write_binary(name + ".f80bin", failure["program"])
+    with open(name + ".txt", "w") as f:
+        f.write(failure["listing"])
+    with open(name + ".json", "w") as f:
+        json.dump({key : value for key, value in failure.items() if key != "program"}, f, indent=2)
+
+
+# Loads a failure written by `write_case()` back, returning (candidate name, program, state, cycles)
+def read_case(json_file):
+    with open(json_file, "r") as f:
+        failure = json.load(f)
+    with assembler.BinaryImage(os.path.splitext(json_file)[0] + ".f80bin") as image:
+        program = image.instructions()
+    state = dict(failure["state"], ram={int(address) : value for address, value in failure["state"]["ram"].items()})
+    return failure["candidate"], program, state, failure["cycles"]
+# ~~~~~~~~ End Shrinking ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Fuzzing ~~~~~~~~
+# Each worker process keeps one pair of emulators per candidate
+worker_pairs = dict()
+
+
+# Returns the pair that checks a candidate
+def make_pair(candidate_name):
+    if candidate_name in SelfChecks:
+        return SelfChecks[candidate_name](candidate_name)
+    return DiffPair(candidate_name)
+
+
+# Fuzzes a range of seeds against a candidate, returning (cases run, shrunk failures)
+def fuzz_seeds(task):
+    candidate_name, seeds, cycles, checkpoint, max_length = task
+    if candidate_name not in worker_pairs:
+        worker_pairs[candidate_name] = make_pair(candidate_name)
+    pair = worker_pairs[candidate_name]
+    
+    failures = list()
+    for seed in seeds:
+        program, state = random_case(seed, max_length)
+        divergence = pair.check(program, state, cycles, checkpoint)
+        if divergence is None:
+            continue
+        program, state, shrunk_cycles, divergence = shrink(pair, program, state, cycles, divergence)
+        failures.append({ "seed"       : seed,
+                          "candidate"  : candidate_name,
+                          "cycles"     : shrunk_cycles,
+                          "state"      : {"A" : state["A"], "B" : state["B"], "MAR" : state["MAR"], "ram" : {str(a) : v for a, v in state["ram"].items()}},
+                          "runner"     : runner_arguments(state) + ["-c", str(shrunk_cycles)],
+                          "program"    : program,
+                          "listing"    : case_listing(program, state),
+                          "divergence" : divergence })
+    return len(seeds), failures
+
+
+# Fuzzes `count` seeds from `start` against each candidate across `processes` worker processes, yielding (cases run, failures) per batch
+def fuzz(candidate_names, start, count, cycles=200, checkpoint=16, max_length=40, processes=None, batch=500):
+    tasks = list()
+    for candidate_name in candidate_names:
+        if candidate_name not in Candidates and candidate_name not in SelfChecks:
+            raise Exception("\"{}\" is not a known candidate! Options are: {}".format(candidate_name, ", ".join(list(Candidates.keys()) + list(SelfChecks.keys()))))
+        for first in range(start, start + count, batch):
+            tasks.append( (candidate_name, range(first, min(first + batch, start + count)), cycles, checkpoint, max_length) )
+    
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes <= 1:
+        for task in tasks:
+            yield fuzz_seeds(task)
+        return
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for result in pool.map(fuzz_seeds, tasks):
+            yield result
+# ~~~~~~~~ End Fuzzing ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Main Program ~~~~~~~~
+# Runs a failure written by `write_case()` again, printing its divergence (if it still diverges)
+def replay(json_file):
+    candidate_name, program, state, cycles = read_case(json_file)
+    pair = make_pair(candidate_name)
+    divergence = pair.check(program, state, cycles)
+    if divergence is None:
+        print("\"{}\" no longer diverges".format(json_file), file=sys.stderr)
+        return 0
+    print(json.dumps(divergence))
+    return 1
+
+
+
+def main(candidate_names, start, count, cycles, checkpoint, max_length, processes=None, output_dir=None, max_failures=None):
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    
+    start_time = time.perf_counter()
+    cases = 0
+    failures = 0
+    for done, found in fuzz(candidate_names, start, count, cycles, checkpoint, max_length, processes):
+        cases += done
+        for failure in found:
+            failures += 1
+            print(json.dumps({key : failure[key] for key in ["seed", "candidate", "cycles", "divergence"]}))
+            if output_dir is not None:
+                write_case(os.path.join(output_dir, "{}_{}".format(failure["candidate"], failure["seed"])), failure)
+        if max_failures is not None and failures >= max_failures:
+            break
+    seconds = time.perf_counter() - start_time
+    print("{} cases, {} failures in {:.1f} s".format(cases, failures, seconds), file=sys.stderr)
+    return 1 if failures > 0 else 0
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        description="Fuzzes the fast execution engines against the reference Emulator.step() with random programs, and checks that traced runs stop where untraced ones do",
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    argparser.add_argument("-e", "--engine", choices=list(Candidates.keys()) + list(SelfChecks.keys()), action="append", default=None,
+        help="a candidate engine to test, may be repeated (default: all of them)")
+    argparser.add_argument("-s", "--start", type=int, default=0,
+        help="the first seed (default: 0)")
+    argparser.add_argument("-n", "--count", type=int, default=10000,
+        help="the number of seeds to run per engine (default: 10000)")
+    argparser.add_argument("-c", "--cycles", type=int, default=200,
+        help="the most instructions to run per case (default: 200)")
+    argparser.add_argument("-k", "--checkpoint", type=int, default=16,
+        help="compare the machines every this many cycles, 1 for lock-step (default: 16)")
+    argparser.add_argument("-l", "--max-length", type=int, default=40,
+        help="the longest program to generate (default: 40)")
+    argparser.add_argument("-j", "--jobs", type=int, default=None,
+        help="the number of worker processes (default: one per CPU)")
+    argparser.add_argument("-o", "--output", default=None,
+        help="a directory to write each shrunk failure to, as .f80bin, .txt and .json")
+    argparser.add_argument("-r", "--replay", type=helpers.file_path, default=None,
+        help="run a failure written to the output directory again, from its .json file")
+    argparser.add_argument("-m", "--max-failures", type=int, default=None,
+        help="stop after this many failures")
+    args = vars(argparser.parse_args())
+    
+    # Run main
+    if args["replay"] is not None:
+        sys.exit(replay(args["replay"]))
+    exit_code = main( args["engine"] or list(Candidates.keys()) + list(SelfChecks.keys()),
+                      args["start"],
+                      args["count"],
+                      args["cycles"],
+                      args["checkpoint"],
+                      args["max_length"],
+                      args["jobs"],
+                      args["output"],
+                      args["max_failures"] )
+    sys.exit(exit_code)
@@ -0,0 +1,605 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+import devices
+import emuthread
+from emulator import Emulator
+from timetravel import TimeTravel
+
+
+# tkinter is only imported when a window is made, so this module can be imported without a display
+tk = None
+scrolledtext = None
+filedialog = None
+
+
+# Imports tkinter the first time it is needed
+def load_tk():
+    global tk, scrolledtext, filedialog
+    if tk is None:
+        import tkinter
+        import tkinter.scrolledtext
+        import tkinter.filedialog
+        tk = tkinter
+        scrolledtext = tkinter.scrolledtext
+        filedialog = tkinter.filedialog
+
+
+# ~~~~~~~~ Begin Screen Widget Definition ~~~~~~~~
+# Draws a `devices.Screen` on a canvas, one rectangle per pixel
+# The screen device only marks the rows the program writes as dirty, and the widget redraws them on its own timer,
+# so a program writing the screen in a tight loop runs at full speed and the canvas updates at most `fps` times a second
+class ScreenWidget:
+    def __init__(self, parent, screen, scale=12, fps=30, on="#e0e0e0", off="#202020"):
+        self.screen = screen
+        self.scale = scale
+        self.interval = max(1, round(1000 / fps))
+        self.colors = (off, on)
+        self.canvas = tk.Canvas( parent,
+                                 width              = screen.width * scale,
+                                 height             = screen.height * scale,
+                                 background         = off,
+                                 highlightthickness = 0 )
+        
+        # The rectangle of every pixel, and the pixels as they were last drawn
+        self.pixels = list()
+        for y in range(screen.height):
+            row = list()
+            for x in range(screen.width):
+                row.append(self.canvas.create_rectangle( x * scale, y * scale, (x + 1) * scale, (y + 1) * scale,
+                                                         fill    = off,
+                                                         outline = "" ))
+            self.pixels.append(row)
+        self.drawn = [[0] * screen.width for _ in range(screen.height)]
+        self.timer = None
+    
+    
+    # Redraws the dirty rows, only touching the pixels that changed, and returns the number of pixels redrawn
+    def refresh(self):
+        redrawn = 0
+        for y in self.screen.take_dirty():
+            row = self.screen.row(y)
+            drawn = self.drawn[y]
+            for x, pixel in enumerate(row):
+                if pixel != drawn[x]:
+                    self.canvas.itemconfigure(self.pixels[y][x], fill=self.colors[pixel])
+                    drawn[x] = pixel
+                    redrawn += 1
+        return redrawn
+    
+    
+    # Starts redrawing on a timer
+    def start(self):
+        if self.timer is None:
+            self.tick()
+    
+    
+    # Stops the redraw timer
+    def stop(self):
+        if self.timer is not None:
+            self.canvas.after_cancel(self.timer)
+            self.timer = None
+    
+    
+    def tick(self):
+        self.refresh()
+        self.timer = self.canvas.after(self.interval, self.tick)
+# ~~~~~~~~ End Screen Widget Definition ~~~~~~~~
+
+
+# ~~~~~~~~ Begin RAM Viewer Definition ~~~~~~~~
+# A view of the whole RAM that only ever holds the rows on screen
+# The text widget has one line per visible row, and scrolling just changes which rows those lines show
+# Between scrolls, only the visible rows with a word in the emulation thread's change log are formatted again
+class RAMViewer:
+    WordsPerRow = 8
+    Formats = ["hex", "dec", "signed"]
+    
+    def __init__(self, parent, emu, rows=16, font=("Courier New", 10)):
+        self.emu = emu
+        self.rows = rows
+        self.words = emu.fet80.ram.words
+        self.total_rows = (self.words + RAMViewer.WordsPerRow - 1) // RAMViewer.WordsPerRow
+        self.dec_data = emu.dec_data
+        self.dec_address = emu.dec_address
+        self.address_digits = (self.dec_address.bits + 3) // 4
+        self.format = "hex"
+        
+        # The first row on screen, the text on each visible line, and the visible rows to format again
+        self.top = 0
+        self.shown = [None] * rows
+        self.dirty = set(range(rows))
+        
+        self.frame = tk.Frame(parent)
+        controls = tk.Frame(self.frame)
+        controls.grid(row=0, column=0, columnspan=2, sticky="w")
+        self.format_variable = tk.StringVar(value=self.format)
+        for column, name in enumerate(RAMViewer.Formats):
+            button = tk.Radiobutton(controls, text=name, value=name, variable=self.format_variable, command=lambda: self.set_format(self.format_variable.get()))
+            button.grid(row=0, column=column)
+        self.jump_entry = tk.Entry(controls, width=12)
+        self.jump_entry.grid(row=0, column=len(RAMViewer.Formats))
+        self.jump_entry.bind("<Return>", lambda event: self.jump())
+        jump_button = tk.Button(controls, text="Go To", bd=2, command=self.jump)
+        jump_button.grid(row=0, column=len(RAMViewer.Formats) + 1)
+        self.message = tk.Label(controls, text="")
+        self.message.grid(row=0, column=len(RAMViewer.Formats) + 2)
+        
+        self.text = tk.Text(self.frame, height=rows, width=len(self.row_text(0)), wrap=tk.NONE, font=font)
+        self.text.insert("1.0", "\n" * (rows - 1))
+        self.text.configure(state=tk.DISABLED)
+        self.text.grid(row=1, column=0)
+        self.scrollbar = tk.Scrollbar(self.frame, command=self.scroll)
+        self.scrollbar.grid(row=1, column=1, sticky="ns")
+        for sequence, units in [("<Button-4>", -3), ("<Button-5>", 3)]:
+            self.text.bind(sequence, lambda event, units=units: self.scroll_to(self.top + units))
+        self.text.bind("<MouseWheel>", lambda event: self.scroll_to(self.top - 3 * (1 if event.delta > 0 else -1)))
+        self.refresh()
+    
+    
+    # Formats a single word in the current format
+    def format_word(self, value):
+        digits = (self.dec_data.bits + 3) // 4
+        if self.format == "hex":
+            return "-" * digits if value is None else "{:0{}X}".format(value, digits)
+        width = len(str(2 ** self.dec_data.bits - 1)) + (1 if self.format == "signed" else 0)
+        if value is None:
+            return "-".rjust(width)
+        if self.format == "signed":
+            value = self.dec_data.twos_compliment(value)
+        return str(value).rjust(width)
+    
+    
+    # Returns the text of a row: its first address, then its words
+    def row_text(self, row):
+        start = row * RAMViewer.WordsPerRow
+        values = self.emu.get_RAM_int()[start : min(start + RAMViewer.WordsPerRow, self.words)]
+        return "{:0{}X}: {}".format(start, self.address_digits, " ".join(self.format_word(value) for value in values))
+    
+    
+    # Takes the RAM words the emulation thread says changed (`None` means they all might have)
+    def changed(self, words):
+        if words is None:
+            self.dirty = set(range(self.rows))
+            return
+        for address in words:
+            line = address // RAMViewer.WordsPerRow - self.top
+            if 0 <= line < self.rows:
+                self.dirty.add(line)
+    
+    
+    # Formats the dirty visible rows again, only touching the lines whose text changed
+    def refresh(self):
+        if len(self.dirty) == 0:
+            return
+        self.text.configure(state=tk.NORMAL)
+        for line in sorted(self.dirty):
+            row = self.top + line
+            text = self.row_text(row) if row < self.total_rows else ""
+            if text != self.shown[line]:
+                self.text.delete("{}.0".format(line + 1), "{}.end".format(line + 1))
+                self.text.insert("{}.0".format(line + 1), text)
+                self.shown[line] = text
+        self.text.configure(state=tk.DISABLED)
+        self.dirty.clear()
+        self.scrollbar.set(self.top / self.total_rows, min(1.0, (self.top + self.rows) / self.total_rows))
+    
+    
+    # Shows every row again
+    def redraw(self):
+        self.dirty = set(range(self.rows))
+        self.refresh()
+    
+    
+    # Makes `top` the first row on screen
+    def scroll_to(self, top):
+        top = max(0, min(self.total_rows - self.rows, top))
+        if top != self.top:
+            self.top = top
+            self.redraw()
+    
+    
+    # Handles the scrollbar ("moveto" a fraction, or "scroll" by units or pages)
+    def scroll(self, action, amount, units=None):
+        if action == "moveto":
+            self.scroll_to(int(float(amount) * self.total_rows))
+        elif action == "scroll":
+            step = self.rows if units == "pages" else 1
+            self.scroll_to(self.top + int(amount) * step)
+    
+    
+    # Shows the row holding an address near the top
+    def go_to(self, address):
+        self.scroll_to(address // RAMViewer.WordsPerRow)
+    
+    
+    # Goes to the symbol or address typed into the jump box
+    def jump(self):
+        text = self.jump_entry.get().strip()
+        try:
+            symbols = self.emu.fet80.rom.symbols()
+        except Exception:
+            symbols = dict()
+        if text in symbols:
+            address = symbols[text]
+        else:
+            address = self.dec_address.int_from_formatted(text) if len(text) > 0 else False
+            if type(address) == bool:
+                self.message.configure(text="\"{}\" is not a symbol or address!".format(text))
+                return
+        self.message.configure(text="{} = 0x{:0{}X}".format(text, address, self.address_digits))
+        self.go_to(address)
+    
+    
+    # Shows the words in another format ("hex", "dec" or "signed")
+    def set_format(self, name):
+        if name not in RAMViewer.Formats:
+            raise Exception("\"{}\" is not a RAM viewer format! Options are: {}".format(name, ", ".join(RAMViewer.Formats)))
+        self.format = name
+        self.redraw()
+# ~~~~~~~~ End RAM Viewer Definition ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Numbered Pane Definition ~~~~~~~~
+# A read-only text widget showing numbered lines, with one line highlighted
+# Long texts are inserted a chunk at a time from the event loop, so even a huge program shows its first lines straight away
+# Moving the highlight only moves a tag between two lines, and never touches the text
+class NumberedPane:
+    ChunkLines = 2000
+    
+    def __init__(self, root, text, highlight="#FFFF80"):
+        self.root = root
+        self.text = text
+        self.text.tag_configure("current", background=highlight)
+        
+        # The lines still to be inserted, how many are in the widget, and the load they belong to
+        self.lines = list()
+        self.line_start = 0
+        self.delimiter = ". "
+        self.number_length = 0
+        self.inserted = 0
+        self.load = 0
+        # The highlighted line (counting from 0), or None
+        self.current = None
+    
+    
+    # Replaces the text with numbered lines, the first numbered `line_start`
+    def set_lines(self, lines, line_start=0, delimiter=". "):
+        self.lines = lines
+        self.line_start = line_start
+        self.delimiter = delimiter
+        self.number_length = len(str(len(lines)))
+        self.inserted = 0
+        self.current = None
+        # Any chunks still queued from the last text are dropped
+        self.load += 1
+        
+        self.text.configure(state=tk.NORMAL)
+        self.text.delete("1.0", tk.END)
+        self.text.configure(state=tk.DISABLED)
+        self.insert_chunk(self.load)
+    
+    
+    # Inserts the next chunk of lines, and queues the one after it
+    def insert_chunk(self, load):
+        if load != self.load:
+            return
+        start = self.inserted
+        end = min(start + NumberedPane.ChunkLines, len(self.lines))
+        chunk = "".join( "{}{}{}\n".format(str(self.line_start + i).rjust(self.number_length), self.delimiter, self.lines[i])
+                         for i in range(start, end) )
+        self.text.configure(state=tk.NORMAL)
+        self.text.insert(tk.END, chunk)
+        self.text.configure(state=tk.DISABLED)
+        self.inserted = end
+        
+        # The highlight may be on a line that only just arrived
+        if self.current is not None and start <= self.current < end:
+            self.highlight(self.current)
+        if end < len(self.lines):
+            self.root.after(1, lambda: self.insert_chunk(load))
+    
+    
+    # Highlights a line (counting from 0), or nothing if `line` is None
+    def highlight(self, line):
+        if self.current is not None:
+            self.text.tag_remove("current", "{}.0".format(self.current + 1), "{}.0".format(self.current + 2))
+        self.current = line
+        if line is not None and line < self.inserted:
+            self.text.tag_add("current", "{}.0".format(line + 1), "{}.0".format(line + 2))
+            self.text.see("{}.0".format(line + 1))
+# ~~~~~~~~ End Numbered Pane Definition ~~~~~~~~
+
+
+# ~~~~~~~~ Begin GUI Definition ~~~~~~~~
+# The main window
+class MainWindow:
+    def __init__(self):
+        self.root = None
+        self.emu = Emulator()
+        self.screen = self.emu.attach_device(devices.Screen())
+        self.time_travel = None
+        self.padding = 6
+        self.last_load_dir = "."
+        
+        # The emulator runs on its own thread, and the window only ever sees it through the updates it publishes
+        self.thread = None
+        self.clock = emuthread.Unthrottled
+        # The newest cycle, status, message and registers from the emulation thread
+        self.state = None
+        # How often the window takes an update from the emulation thread, in milliseconds
+        self.poll_interval = 16
+        # The source line of each instruction, for highlighting the current one (None if it isn't known)
+        self.source_map = None
+    
+    
+    # Load a program into the emulator
+    def load_program(self, file_in):
+        self.stop_thread()
+        self.emu.load_program(file_in)
+        self.time_travel = TimeTravel(self.emu)
+        self.state = None
+        self.thread = emuthread.EmulationThread(self.emu, self.time_travel, self.clock)
+        self.thread.start()
+        # Update the UI
+        self.source_map = self.emu.fet80.rom.source_map()
+        self.source_pane.set_lines(self.source_code().splitlines(), line_start=1)
+        self.code_pane.set_lines(self.emu.processed_assembly(), line_start=0)
+        self.update_info()
+        self.ram_viewer.redraw()
+    
+    
+    # Stops the emulation thread, if there is one
+    def stop_thread(self):
+        if self.thread is not None:
+            self.thread.shutdown()
+            self.thread = None
+    
+    
+    # Sends a command to the emulation thread, whose results show up with its next update
+    def command(self, function):
+        if self.thread is None:
+            return
+        function(self.thread)
+    
+    
+    # Run freely at the clock rate
+    def run_program(self):
+        self.command(lambda thread: thread.resume())
+    
+    
+    # Stop running freely
+    def pause(self):
+        self.command(lambda thread: thread.pause())
+    
+    
+    # Step forward one instruction
+    def step(self):
+        self.command(lambda thread: thread.step(1))
+    
+    
+    # Step back one instruction
+    def step_back(self):
+        self.command(lambda thread: thread.call(lambda: self.time_travel.step_back(1)))
+    
+    
+    # Jump to the cycle typed into the cycle box
+    def go_to_cycle(self):
+        try:
+            cycle = int(self.cycle_entry.get())
+        except ValueError:
+            self.update_info("\"{}\" is not a cycle number!".format(self.cycle_entry.get()))
+            return
+        self.command(lambda thread: thread.call(lambda: self.time_travel.go_to(cycle)))
+    
+    
+    # Sets the clock typed into the clock box: a number of instructions per second, "max" for unthrottled, or "step" for single stepping
+    def set_clock(self):
+        text = self.clock_entry.get().strip().lower()
+        if text in ["", "max"]:
+            clock = emuthread.Unthrottled
+        elif text == "step":
+            clock = emuthread.SingleStep
+        else:
+            try:
+                clock = float(text)
+            except ValueError:
+                clock = -1
+            if clock < 0:
+                self.update_info("\"{}\" is not a clock rate!".format(self.clock_entry.get()))
+                return
+        self.clock = clock
+        self.command(lambda thread: thread.change_clock(clock))
+    
+    
+    # Takes the newest update from the emulation thread, and schedules the next poll
+    # Only one update is handled per poll, and the thread merges everything that happened since the last one into it,
+    # so the work done here doesn't grow with the speed of the machine
+    def poll_updates(self):
+        if self.thread is not None:
+            update = self.thread.take_update()
+            if update is not None:
+                if self.state is None:
+                    self.state = { "registers" : dict() }
+                self.state["registers"].update(update["registers"])
+                if "PC" in update["registers"]:
+                    self.show_PC(update["registers"]["PC"])
+                for name in ["cycle", "status", "message"]:
+                    self.state[name] = update[name]
+                self.update_info()
+                self.ram_viewer.changed(update["ram"])
+                self.ram_viewer.refresh()
+        self.root.after(self.poll_interval, self.poll_updates)
+    
+    
+    # Highlights the current instruction in the code pane, and its line in the source pane
+    def show_PC(self, pc):
+        self.code_pane.highlight(pc)
+        if pc is None or self.source_map is None or pc >= len(self.source_map) or self.source_map[pc] is None:
+            self.source_pane.highlight(None)
+        else:
+            self.source_pane.highlight(self.source_map[pc] - 1)
+    
+    
+    # Shows the cycle, status and registers in the info area, with an optional message
+    def update_info(self, message=None):
+        if self.state is None:
+            text = "No program loaded." if self.thread is None else "Starting..."
+        else:
+            registers = self.state["registers"]
+            def value(name):
+                return "-" if registers[name] is None else registers[name]
+            text = "Cycle: {}\nStatus: {}\nPC: {}\nA: {}\nB: {}\nMAR: {}\nACC: {}".format( self.state["cycle"],
+                                                                                      self.state["status"],
+                                                                                      value("PC"),
+                                                                                      value("A"),
+                                                                                      value("B"),
+                                                                                      value("MAR"),
+                                                                                      value("ACC") )
+            if self.state["message"] is not None:
+                text += "\n" + self.state["message"]
+        if message is not None:
+            text += "\n" + message
+        self.info_area.configure(text=text)
+    
+    
+    # Get the current program source code
+    def source_code(self):
+        return self.emu.source_code()
+    
+    
+    # Open the GUI to load a file
+    def load_file_gui(self):
+        filetypes  = ( ("FET-80 assembly files", "*.f80asm" ),
+                       ("All files"     , "*.*") )
+        filename = filedialog.askopenfilename( title      = "Open a FET-80 Assembly File...",
+                                               initialdir = self.last_load_dir ,
+                                               filetypes  = filetypes )
+        self.last_load_dir = os.path.split(os.path.realpath(filename))[0]
+        self.load_program(filename)  
+    
+    
+    # Returns the frame of the navbar
+    def make_navbar(self):
+        self.navbar = tk.Frame(self.root)
+        buttons = [ ("Load File...", self.load_file_gui),
+                    ("Run"         , self.run_program),
+                    ("Pause"       , self.pause),
+                    ("Step Back"   , self.step_back),
+                    ("Step"        , self.step) ]
+        for column, (text, command) in enumerate(buttons):
+            button = tk.Button(self.navbar, text=text, bd=2, command=command)
+            button.grid(row=0, column=column, padx=self.padding)
+        self.cycle_entry = tk.Entry(self.navbar, width=10)
+        self.cycle_entry.grid(row=0, column=len(buttons), padx=self.padding)
+        go_button = tk.Button(self.navbar, text="Go To Cycle", bd=2, command=self.go_to_cycle)
+        go_button.grid(row=0, column=len(buttons) + 1, padx=self.padding)
+        self.clock_entry = tk.Entry(self.navbar, width=10)
+        self.clock_entry.insert(0, "max")
+        self.clock_entry.grid(row=0, column=len(buttons) + 2, padx=self.padding)
+        clock_button = tk.Button(self.navbar, text="Set Clock (Hz)", bd=2, command=self.set_clock)
+        clock_button.grid(row=0, column=len(buttons) + 3, padx=self.padding)
+        return self.navbar
+    
+    
+    # Returns the frame of the source code area
+    def make_source_area(self):
+        self.source_text = scrolledtext.ScrolledText( self.root, 
+                                                      wrap   = tk.NONE, 
+                                                      width  = 45, 
+                                                      height = 40, 
+                                                      font   = ("Courier New", 10),
+                                                      state  = tk.DISABLED )
+        self.source_pane = NumberedPane(self.root, self.source_text)
+        return self.source_text
+    
+    
+    # Returns the frame of the program code area
+    def make_code_area(self):
+        self.code_text = scrolledtext.ScrolledText( self.root, 
+                                                    wrap   = tk.NONE, 
+                                                    width  = 45, 
+                                                    height = 20, 
+                                                    font   = ("Courier New", 10),
+                                                    state  = tk.DISABLED )
+        self.code_pane = NumberedPane(self.root, self.code_text)
+        return self.code_text
+    
+    
+    # Returns the frame of the RAM area
+    def make_RAM_area(self):
+        self.ram_viewer = RAMViewer(self.root, self.emu)
+        return self.ram_viewer.frame
+    
+    
+    # Returns the frame of the screen area
+    def make_screen_area(self):
+        self.screen_widget = ScreenWidget(self.root, self.screen)
+        self.screen_widget.start()
+        return self.screen_widget.canvas
+    
+    
+    # Returns the frame of the info area
+    def make_info_area(self):
+        return tk.Label(self.root, text="No program loaded.", font="helvetica 12", justify=tk.LEFT)
+    
+    
+    # Main call
+    def run(self):
+        # Make window
+        load_tk()
+        self.root = tk.Tk()
+        
+        # Make navbar area
+        self.navbar = self.make_navbar()
+        self.navbar.grid(row=0, column=0, columnspan=3, padx=self.padding, pady=self.padding)
+        
+        # Make source text area
+        self.source_label = tk.Label(self.root, text="Source Assembly", font="helvetica 12")
+        self.source_label.grid(row=1, column=0, padx=self.padding, pady=self.padding)
+        self.source_area = self.make_source_area()
+        self.source_area.grid(row=2, column=0, rowspan=3, padx=self.padding, pady=self.padding)
+        
+        # Make program code area
+        self.source_label = tk.Label(self.root, text="Program Code", font="helvetica 12")
+        self.source_label.grid(row=1, column=1, padx=self.padding, pady=self.padding)
+        self.code_area = self.make_code_area()
+        self.code_area.grid(row=2, column=1, padx=self.padding, pady=self.padding)
+        
+        # Make screen area
+        self.screen_area = self.make_screen_area()
+        self.screen_area.grid(row=2, column=2, padx=self.padding, pady=self.padding)
+        
+        # Make RAM area
+        self.memory_area = self.make_RAM_area()
+        self.memory_area.grid(row=4, column=1, padx=self.padding, pady=self.padding)
+        
+        # Make info area
+        self.info_area = self.make_info_area()
+        self.info_area.grid(row=4, column=2, padx=self.padding, pady=self.padding)
+        
+        # Take updates from the emulation thread at display rate
+        self.poll_updates()
+        
+        # Start main event loop
+        self.root.mainloop()
+        self.stop_thread()
+# ~~~~~~~~ End GUI Definition ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Main Program ~~~~~~~~
+def main():
+    # Make the main window
+    main_window = MainWindow()
+    
+    # Run the main window loop
+    main_window.run()
+    return 0
+
+
+if __name__ == '__main__':
+    # Run main
+    exit_code = main()
+    sys.exit(exit_code)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import sys
+
+import assembler
+import engine
+import blocks
+
+
+# ~~~~~~~~ Begin Halt Analysis ~~~~~~~~
+# The jump conditions as functions of the accumulator, carry and sign bit (None for an unconditional jump)
+JumpTests = { opcode : None if condition is None else eval("lambda acc, cout, half: " + condition)
+              for opcode, condition in engine.JumpConditions.items() }
+
+
+# Does the instruction at `address` only move the PC? (a `NOP`, or a jump to a direct value)
+# These never write a register, RAM or the flags, so a cycle made only of them can never change the machine state
+def control_only(decoded, address):
+    op, value = decoded[address]
+    if op == engine.EmptyOp:
+        return False
+    instruction_type, opcode, src, dest = engine.Kinds[op]
+    if instruction_type == assembler.AsmCodes.InstructionType.D_INSTRUCTION:
+        return True
+    return instruction_type == assembler.AsmCodes.InstructionType.J_INSTRUCTION and src == assembler.AsmCodes.Src.DV
+
+
+# Returns the addresses that sit on a cycle made only of control-only instructions
+# Those are the only places a program can spin forever without changing state, so the engine only has to check them
+def halt_candidates(decoded):
+    nodes = {address for address in decoded.addresses if control_only(decoded, address)}
+    edges = {address : [s for s in blocks.successors(decoded, address) if s in nodes] for address in nodes}
+    incoming = {address : 0 for address in nodes}
+    for address in nodes:
+        for s in edges[address]:
+            incoming[s] += 1
+    
+    # Trim away every node with no way in or no way out, until only the cycles (and the paths between them) are left
+    outgoing = {address : len(edges[address]) for address in nodes}
+    predecessors = {address : list() for address in nodes}
+    for address in nodes:
+        for s in edges[address]:
+            predecessors[s].append(address)
+    
+    removed = set()
+    pending = [address for address in nodes if outgoing[address] == 0 or incoming[address] == 0]
+    while len(pending) > 0:
+        address = pending.pop()
+        if address in removed:
+            continue
+        removed.add(address)
+        for p in predecessors[address]:
+            outgoing[p] -= 1
+            if outgoing[p] == 0 and p not in removed:
+                pending.append(p)
+        for s in edges[address]:
+            incoming[s] -= 1
+            if incoming[s] == 0 and s not in removed:
+                pending.append(s)
+    
+    return frozenset(nodes - removed)
+
+
+# Follows the program from `pc` with the flags fixed at (acc, cout), without changing any state
+# Returns True if it comes back around to an address it has already passed, so the program is halted there
+# Returns False as soon as it reaches an instruction that can change the state, or a jump that would fault on unset flags
+def is_halted(decoded, pc, acc, cout, half):
+    seen = set()
+    while control_only(decoded, pc):
+        if pc in seen:
+            return True
+        seen.add(pc)
+        
+        op, value = decoded[pc]
+        instruction_type, opcode, src, dest = engine.Kinds[op]
+        if instruction_type == assembler.AsmCodes.InstructionType.D_INSTRUCTION:
+            # A `NOP` never moves the PC
+            return True
+        
+        test = JumpTests[opcode]
+        if test is None:
+            pc = value
+        elif acc is None:
+            return False
+        elif test(acc, cout, half):
+            pc = value
+        else:
+            pc = (pc + 1) % len(decoded)
+    return False
+# ~~~~~~~~ End Halt Analysis ~~~~~~~~
+
+
+if __name__ == '__main__':
+    print("This module is not meant to be run on it's own!")
+    sys.exit()
@@ -89,6 +89,15 @@ def file_path(string):
     else:
         raise FileNotFoundError(string)
 
+
+# Imports numpy for the tools that need it, which is an optional dependency
+def load_numpy(purpose):
+    try:
+        import numpy
+    except ImportError:
+        raise Exception("{} needs numpy, which is not installed!".format(purpose))
+    return numpy
+
 if __name__ == '__main__':
     print("This module is not meant to be run on it's own!")
     sys.exit()  # next section explains the use of sys.exit
\ No newline at end of file
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import time
+import argparse
+
+import helpers
+import assembler
+import engine
+import halts
+import runner
+from emulator import Fet80
+
+
+# numpy is only imported when a lockstep machine is made, so the other tools run without it
+numpy = None
+def load_numpy():
+    global numpy
+    if numpy is None:
+        numpy = helpers.load_numpy("Lockstep emulation")
+
+
+# ~~~~~~~~ Begin Lockstep Definitions ~~~~~~~~
+# The fault codes kept per lane, and the errors they stand for (0 is no fault)
+NoFault = 0
+UnsetRegisterFault = 1
+UnsetFlagsFault = 2
+EmptyROMFault = 3
+FaultErrors = { UnsetRegisterFault : engine.UnsetRegisterError,
+                UnsetFlagsFault    : engine.UnsetFlagsError,
+                EmptyROMFault      : "No instruction at the current ROM address!" }
+
+# The jump conditions as functions of the accumulator, carry and sign bit arrays (the same tests as `engine.JumpConditions`)
+JumpTests = { assembler.AsmCodes.Opcode.JMP  : None,
+              assembler.AsmCodes.Opcode.JC   : lambda acc, cout, half: cout,
+              assembler.AsmCodes.Opcode.JNC  : lambda acc, cout, half: ~cout,
+              assembler.AsmCodes.Opcode.JEQZ : lambda acc, cout, half: acc == 0,
+              assembler.AsmCodes.Opcode.JNEZ : lambda acc, cout, half: acc != 0,
+              assembler.AsmCodes.Opcode.JGTZ : lambda acc, cout, half: (acc > 0) & (acc < half),
+              assembler.AsmCodes.Opcode.JLTZ : lambda acc, cout, half: acc >= half,
+              assembler.AsmCodes.Opcode.JGEZ : lambda acc, cout, half: acc < half,
+              assembler.AsmCodes.Opcode.JLEZ : lambda acc, cout, half: (acc == 0) | (acc >= half) }
+
+
+# Runs one program over many machine states ("lanes") at once, with every register and flag held in a numpy array of one entry per lane
+# Each step groups the running lanes by PC and executes each group's instruction with whole-array operations,
+# so lanes that take different jumps just end up in different groups
+# RAM is sparse: only addresses that have been written get a column of per-lane values
+# A lane stops when it faults (its error is kept in `fault`) or, with halt detection, when it reaches a halt loop
+class LockstepMachine:
+    def __init__(self, decoded, lanes, data_bits=assembler.Fet80Params.DataWidth, address_bits=assembler.Fet80Params.AddressWidth):
+        load_numpy()
+        self.decoded = decoded
+        self.lanes = lanes
+        self.data_bits = data_bits
+        self.address_bits = address_bits
+        self.dmask = 2 ** data_bits - 1
+        self.amask = 2 ** address_bits - 1
+        self.half = 2 ** (data_bits - 1)
+        self.symbols = dict()
+        
+        # Every value is kept in an int64, so an ADD can't overflow before it is masked
+        self.a = numpy.zeros(lanes, dtype=numpy.int64)
+        self.b = numpy.zeros(lanes, dtype=numpy.int64)
+        self.mar = numpy.zeros(lanes, dtype=numpy.int64)
+        self.acc = numpy.zeros(lanes, dtype=numpy.int64)
+        self.a_set = numpy.zeros(lanes, dtype=bool)
+        self.b_set = numpy.zeros(lanes, dtype=bool)
+        self.mar_set = numpy.zeros(lanes, dtype=bool)
+        self.acc_set = numpy.zeros(lanes, dtype=bool)
+        self.cout = numpy.zeros(lanes, dtype=bool)
+        self.pc = numpy.zeros(lanes, dtype=numpy.int64)
+        # RAM columns, as {address : [values, written]}
+        self.ram = dict()
+        
+        # The instructions each lane completed, its fault code, and whether it stopped at a halt loop
+        self.executed = numpy.zeros(lanes, dtype=numpy.int64)
+        self.fault = numpy.zeros(lanes, dtype=numpy.int8)
+        self.halted = numpy.zeros(lanes, dtype=bool)
+        
+        # The halt candidates, found the first time they are needed
+        self.halt_addresses = None
+    
+    
+    # Makes a lockstep machine for a .f80asm or .f80bin program
+    @staticmethod
+    def from_program(file_in, lanes):
+        fet80 = Fet80()
+        fet80.program(file_in)
+        bits = fet80.bits()
+        machine = LockstepMachine(fet80.rom.decoded, lanes, bits["data"], bits["address"])
+        machine.symbols = fet80.rom.symbols() or dict()
+        return machine
+    
+    
+    # Sets a register ("A", "B", "MAR" or "PC") in every lane, to one value or to an array of one value per lane
+    def set_register(self, name, values):
+        if name == "A":
+            self.a[:] = numpy.asarray(values) & self.dmask
+            self.a_set[:] = True
+        elif name == "B":
+            self.b[:] = numpy.asarray(values) & self.dmask
+            self.b_set[:] = True
+        elif name == "MAR":
+            self.mar[:] = numpy.asarray(values) & self.amask
+            self.mar_set[:] = True
+        elif name == "PC":
+            self.pc[:] = numpy.asarray(values) & self.amask
+        else:
+            raise Exception("\"{}\" is not a register! Options are: A, B, MAR, PC".format(name))
+    
+    
+    # Sets a RAM word in every lane, to one value or to an array of one value per lane
+    def set_RAM(self, address, values):
+        column = self.ram_column(address & self.amask)
+        column[0][:] = numpy.asarray(values) & self.dmask
+        column[1][:] = True
+    
+    
+    # Returns copies of the (values, written) arrays of a RAM word
+    def get_RAM(self, address):
+        column = self.ram.get(address & self.amask)
+        if column is None:
+            return numpy.zeros(self.lanes, dtype=numpy.int64), numpy.zeros(self.lanes, dtype=bool)
+        return column[0].copy(), column[1].copy()
+    
+    
+    # Returns the RAM column at an address, making an unwritten one if there isn't one yet
+    def ram_column(self, address):
+        column = self.ram.get(address)
+        if column is None:
+            column = self.ram[address] = [numpy.zeros(self.lanes, dtype=numpy.int64), numpy.zeros(self.lanes, dtype=bool)]
+        return column
+    
+    
+    # Returns the (values, written) of the RAM word at the MAR of each lane in `idx`
+    def read_RAM(self, idx):
+        addresses = self.mar[idx]
+        values = numpy.zeros(len(idx), dtype=numpy.int64)
+        written = numpy.zeros(len(idx), dtype=bool)
+        if len(idx) == 0:
+            return values, written
+        if addresses.min() == addresses.max():
+            # Every lane reads the same address, which is the usual case
+            column = self.ram.get(int(addresses[0]))
+            if column is None:
+                return values, written
+            return column[0][idx], column[1][idx]
+        for address in numpy.unique(addresses):
+            column = self.ram.get(int(address))
+            if column is None:
+                continue
+            at = addresses == address
+            values[at] = column[0][idx[at]]
+            written[at] = column[1][idx[at]]
+        return values, written
+    
+    
+    # Writes `values` to the RAM word at the MAR of each lane in `idx`
+    def write_RAM(self, idx, values):
+        if len(idx) == 0:
+            return
+        addresses = self.mar[idx]
+        if addresses.min() == addresses.max():
+            column = self.ram_column(int(addresses[0]))
+            column[0][idx] = values
+            column[1][idx] = True
+            return
+        for address in numpy.unique(addresses):
+            at = addresses == address
+            column = self.ram_column(int(address))
+            column[0][idx[at]] = values[at]
+            column[1][idx[at]] = True
+    
+    
+    # Returns (ok, values) for a source of the lanes in `idx`, where `ok` is False for lanes that would fault reading it
+    def read_source(self, src, idx, value):
+        if src == assembler.AsmCodes.Src.A:
+            return self.a_set[idx], self.a[idx]
+        if src == assembler.AsmCodes.Src.B:
+            return self.b_set[idx], self.b[idx]
+        if src == assembler.AsmCodes.Src.M:
+            values, written = self.read_RAM(idx)
+            return self.mar_set[idx] & written, values
+        return numpy.ones(len(idx), dtype=bool), numpy.full(len(idx), value, dtype=numpy.int64)
+    
+    
+    # Returns (ok, values) for a destination of the lanes in `idx`, for the C-instructions that read it first
+    def read_dest(self, dest, idx):
+        return self.read_source({ assembler.AsmCodes.Dest.A : assembler.AsmCodes.Src.A,
+                                  assembler.AsmCodes.Dest.B : assembler.AsmCodes.Src.B,
+                                  assembler.AsmCodes.Dest.M : assembler.AsmCodes.Src.M }[dest], idx, None)
+    
+    
+    # Writes `values` to a destination of the lanes in `idx`
+    def write_dest(self, dest, idx, values):
+        if dest == assembler.AsmCodes.Dest.A:
+            self.a[idx] = values
+            self.a_set[idx] = True
+        elif dest == assembler.AsmCodes.Dest.B:
+            self.b[idx] = values
+            self.b_set[idx] = True
+        else:
+            self.write_RAM(idx, values)
+    
+    
+    # Marks the lanes in `idx` that are not `ok` as faulted with `code`, returning the lanes that are left
+    def check(self, idx, ok, code):
+        if ok.all():
+            return idx, None
+        self.fault[idx[~ok]] = code
+        return idx[ok], ok
+    
+    
+    # Executes the instruction at `pc` for the lanes in `idx`, which all have that PC
+    def execute(self, pc, idx):
+        op, value = self.decoded[pc]
+        if op == engine.EmptyOp:
+            self.fault[idx] = EmptyROMFault
+            return
+        instruction_type, opcode, src, dest = engine.Kinds[op]
+        nxt = (pc + 1) & self.amask
+        
+        if instruction_type == assembler.AsmCodes.InstructionType.T_INSTRUCTION:
+            ok, x = self.read_source(src, idx, value)
+            if dest == assembler.AsmCodes.Dest.M:
+                ok = ok & self.mar_set[idx]
+            idx, kept = self.check(idx, ok, UnsetRegisterFault)
+            if kept is not None:
+                x = x[kept]
+            self.write_dest(dest, idx, x)
+            self.pc[idx] = nxt
+        elif instruction_type == assembler.AsmCodes.InstructionType.M_INSTRUCTION:
+            ok, x = self.read_source(src, idx, value)
+            idx, kept = self.check(idx, ok, UnsetRegisterFault)
+            if kept is not None:
+                x = x[kept]
+            self.mar[idx] = x & self.amask
+            self.mar_set[idx] = True
+            self.pc[idx] = nxt
+        elif instruction_type == assembler.AsmCodes.InstructionType.C_INSTRUCTION:
+            ok_x, x = self.read_dest(dest, idx)
+            ok_y, y = self.read_source(src, idx, value)
+            ok = ok_x & ok_y
+            if dest == assembler.AsmCodes.Dest.M:
+                ok &= self.mar_set[idx]
+            idx, kept = self.check(idx, ok, UnsetRegisterFault)
+            if kept is not None:
+                x = x[kept]
+                y = y[kept]
+            # The carry always comes from the adder, even for a NAND
+            self.cout[idx] = x + y > self.dmask
+            if opcode == assembler.AsmCodes.Opcode.ADD:
+                out = (x + y) & self.dmask
+            else:
+                out = ~(x & y) & self.dmask
+            self.acc[idx] = out
+            self.acc_set[idx] = True
+            self.write_dest(dest, idx, out)
+            self.pc[idx] = nxt
+        elif instruction_type == assembler.AsmCodes.InstructionType.J_INSTRUCTION:
+            test = JumpTests[opcode]
+            if test is not None:
+                idx, kept = self.check(idx, self.acc_set[idx], UnsetFlagsFault)
+                taken = test(self.acc[idx], self.cout[idx], self.half)
+                not_taken = idx[~taken]
+                self.pc[not_taken] = nxt
+                self.executed[not_taken] += 1
+                idx = idx[taken]
+            ok, x = self.read_source(src, idx, value)
+            idx, kept = self.check(idx, ok, UnsetRegisterFault)
+            if kept is not None:
+                x = x[kept]
+            self.pc[idx] = x & self.amask
+        # A `NOP` leaves the PC where it is
+        
+        self.executed[idx] += 1
+    
+    
+    # The lanes that are still running
+    def running(self):
+        return numpy.nonzero((self.fault == NoFault) & ~self.halted)[0]
+    
+    
+    # Executes one instruction in every running lane, returning the number of lanes that were running
+    def step(self, idx=None):
+        if idx is None:
+            idx = self.running()
+        if len(idx) == 0:
+            return 0
+        pcs = self.pc[idx]
+        first = pcs[0]
+        if (pcs == first).all():
+            self.execute(int(first), idx)
+        else:
+            for pc in numpy.unique(pcs):
+                self.execute(int(pc), idx[pcs == pc])
+        return len(idx)
+    
+    
+    # Marks the running lanes that have reached a halt loop as halted
+    # Whether a loop halts only depends on the PC and the packed flags, so each (PC, flags) pair is only checked once
+    def check_halts(self, idx):
+        if self.halt_addresses is None:
+            self.halt_addresses = numpy.array(sorted(halts.halt_candidates(self.decoded)), dtype=numpy.int64)
+        if len(self.halt_addresses) == 0 or len(idx) == 0:
+            return idx
+        at = numpy.isin(self.pc[idx], self.halt_addresses)
+        if not at.any():
+            return idx
+        candidates = idx[at]
+        acc = self.acc[candidates]
+        packed = self.cout[candidates] | ((acc == 0) << 1) | ((acc >= self.half) << 2)
+        packed = numpy.where(self.acc_set[candidates], packed, 8)
+        keys = self.pc[candidates] * 16 + packed
+        unique_keys, first = numpy.unique(keys, return_index=True)
+        for key, lane in zip(unique_keys, candidates[first]):
+            unset = not self.acc_set[lane]
+            if halts.is_halted(self.decoded, int(self.pc[lane]), None if unset else int(self.acc[lane]), bool(self.cout[lane]), self.half):
+                self.halted[candidates[keys == key]] = True
+        return self.running()
+    
+    
+    # Runs every lane for up to `cycles` instructions, or until they have all stopped
+    # With `detect_halts`, lanes stop at halt loops instead of spinning there
+    # Returns the number of steps taken
+    def run(self, cycles, detect_halts=True):
+        for n in range(cycles):
+            idx = self.running()
+            if detect_halts:
+                idx = self.check_halts(idx)
+            if self.step(idx) == 0:
+                return n
+        if detect_halts:
+            self.check_halts(self.running())
+        return cycles
+    
+    
+    # Returns the result of a single lane, in the same form as a `runner` result
+    def lane_result(self, lane, dumps=None):
+        fault = int(self.fault[lane])
+        if fault != NoFault:
+            status = "error"
+        elif self.halted[lane]:
+            status = "halted"
+        else:
+            status = "budget"
+        result = { "status"    : status,
+                   "cycles"    : int(self.executed[lane]),
+                   "pc"        : int(self.pc[lane]),
+                   "registers" : { "A"   : int(self.a[lane]) if self.a_set[lane] else None,
+                                   "B"   : int(self.b[lane]) if self.b_set[lane] else None,
+                                   "MAR" : int(self.mar[lane]) if self.mar_set[lane] else None,
+                                   "ACC" : int(self.acc[lane]) if self.acc_set[lane] else None },
+                   "ram"       : dict() }
+        if fault != NoFault:
+            result["error"] = FaultErrors[fault]
+        for text in dumps or []:
+            start, end = runner.parse_range(text, self.address_bits, self.symbols)
+            words = list()
+            for address in range(start, end):
+                column = self.ram.get(address)
+                words.append(int(column[0][lane]) if column is not None and column[1][lane] else None)
+            result["ram"][text] = words
+        return result
+# ~~~~~~~~ End Lockstep Definitions ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Main Program ~~~~~~~~
+# Converts a sweep argument (`ADDRESS=START:END`, END exclusive, or `ADDRESS=VALUE`) to an (address text, range text) tuple
+def sweep_value(string):
+    if "=" not in string:
+        raise argparse.ArgumentTypeError("\"{}\" is not in the form ADDRESS=START:END".format(string))
+    return tuple(string.split("=", 1))
+
+
+# Runs a program over every combination of the swept RAM inputs, writing one JSON line per lane
+def main(file_in, sweeps, cycles=runner.DefaultCycles, dumps=None, halt=True, output=None):
+    load_numpy()
+    fet80 = Fet80()
+    fet80.program(file_in)
+    symbols = fet80.rom.symbols() or dict()
+    bits = fet80.bits()
+    
+    # Every lane gets one combination of the swept values
+    addresses = list()
+    ranges = list()
+    for address_text, range_text in sweeps:
+        addresses.append(runner.parse_value(address_text, bits["address"], symbols))
+        # One more bit, so the exclusive end can be one past the largest value
+        start, end = runner.parse_range(range_text, bits["data"] + 1, symbols)
+        ranges.append(numpy.arange(start, end, dtype=numpy.int64))
+    grids = [grid.ravel() for grid in numpy.meshgrid(*ranges, indexing="ij")] if len(ranges) > 0 else []
+    lanes = len(grids[0]) if len(grids) > 0 else 1
+    
+    machine = LockstepMachine(fet80.rom.decoded, lanes, bits["data"], bits["address"])
+    machine.symbols = symbols
+    for address, values in zip(addresses, grids):
+        machine.set_RAM(address, values)
+    
+    start_time = time.perf_counter()
+    steps = machine.run(cycles, halt)
+    seconds = time.perf_counter() - start_time
+    
+    out = open(output, "w") if output is not None else sys.stdout
+    try:
+        for lane in range(lanes):
+            result = machine.lane_result(lane, dumps)
+            result["inputs"] = {text : int(values[lane]) for (text, _), values in zip(sweeps, grids)}
+            out.write(json.dumps(result) + "\n")
+    finally:
+        if output is not None:
+            out.close()
+    print("{} lanes, {} steps, {} instructions in {:.3f} s".format(lanes, steps, int(machine.executed.sum()), seconds), file=sys.stderr)
+    return 1 if (machine.fault != NoFault).any() else 0
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        description="Runs a FET-80 program over many inputs at once, printing the results as JSON lines",
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    argparser.add_argument("-f", "--file", type=helpers.file_path, required=True,
+        help="the .f80asm or .f80bin file to run")
+    argparser.add_argument("-s", "--sweep", type=sweep_value, action="append", default=[],
+        help="a RAM word to sweep, as ADDRESS=START:END (END exclusive) or ADDRESS=VALUE, every combination gets a lane (can be repeated)")
+    argparser.add_argument("-c", "--cycles", type=int, default=runner.DefaultCycles,
+        help="the most instructions to run in each lane (default: {})".format(runner.DefaultCycles))
+    argparser.add_argument("-d", "--dump", action="append", default=[],
+        help="a RAM range to include in the results, as START:END or ADDRESS (can be repeated)")
+    argparser.add_argument("--no-halt", action="store_true",
+        help="don't stop lanes at halt loops")
+    argparser.add_argument("-o", "--output", default=None,
+        help="the file to write the results to (default: stdout)")
+    args = vars(argparser.parse_args())
+    
+    # Run main
+    exit_code = main(args["file"], args["sweep"], args["cycles"], args["dump"], not args["no_halt"], args["output"])
+    sys.exit(exit_code)
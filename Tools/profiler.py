@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import argparse
+from array import array
+
+import helpers
+
+
+# ~~~~~~~~ Begin Profile Definition ~~~~~~~~
+# The execution counters filled in by the profiled core
+# Executions and jumps are counted per ROM address, and reads and writes per RAM address
+class Profile:
+    def __init__(self, rom_words, ram_words):
+        self.rom_words = rom_words
+        self.ram_words = ram_words
+        
+        self.counts = array("Q", [0]) * self.rom_words
+        self.taken = array("Q", [0]) * self.rom_words
+        self.not_taken = array("Q", [0]) * self.rom_words
+        self.reads = array("Q", [0]) * self.ram_words
+        self.writes = array("Q", [0]) * self.ram_words
+    
+    
+    # Zeroes every counter, keeping the same arrays so an engine keeps counting into them
+    def reset(self):
+        for counter in [self.counts, self.taken, self.not_taken, self.reads, self.writes]:
+            counter[:] = array("Q", [0]) * len(counter)
+    
+    
+    # The counter arrays, keyed by the names the profiled core uses for them
+    def counters(self):
+        return { "counts"    : self.counts,
+                 "taken"     : self.taken,
+                 "not_taken" : self.not_taken,
+                 "reads"     : self.reads,
+                 "writes"    : self.writes }
+    
+    
+    # The total number of instructions counted
+    def total(self):
+        return sum(self.counts)
+    
+    
+    # Returns a row for every ROM address that was executed
+    # `source_map` gives the source line of each address, and `assembly` its disassembled text
+    def address_rows(self, source_map=None, assembly=None):
+        rows = list()
+        for address, count in enumerate(self.counts):
+            if count == 0:
+                continue
+            rows.append({ "address"   : address,
+                          "line"      : source_map[address] if source_map is not None and address < len(source_map) else None,
+                          "asm"       : assembly[address] if assembly is not None and address < len(assembly) else None,
+                          "count"     : count,
+                          "taken"     : self.taken[address],
+                          "not_taken" : self.not_taken[address] })
+        return rows
+    
+    
+    # Returns a row for every source line that was executed, adding up all of the addresses assembled from it
+    # One source line can become many instructions (indirect `@` operands expand into MEM chains), and pruned MEM lines don't appear at all
+    def line_rows(self, source_map, source=None):
+        lines = dict()
+        for row in self.address_rows(source_map):
+            line = lines.get(row["line"])
+            if line is None:
+                line = lines[row["line"]] = { "line"      : row["line"],
+                                              "text"      : None,
+                                              "addresses" : list(),
+                                              "count"     : 0,
+                                              "taken"     : 0,
+                                              "not_taken" : 0 }
+                if source is not None and row["line"] is not None and 0 < row["line"] <= len(source):
+                    line["text"] = source[row["line"] - 1].strip()
+            line["addresses"].append(row["address"])
+            line["count"] += row["count"]
+            line["taken"] += row["taken"]
+            line["not_taken"] += row["not_taken"]
+        return list(lines.values())
+    
+    
+    # Returns a row for every RAM address that was read or written
+    def ram_rows(self):
+        rows = list()
+        for address in range(self.ram_words):
+            if self.reads[address] or self.writes[address]:
+                rows.append({ "address" : address,
+                              "reads"   : self.reads[address],
+                              "writes"  : self.writes[address] })
+        return rows
+    
+    
+    # Returns everything that was counted as a JSON-ready dict
+    def dump(self, source_map=None, source=None, assembly=None):
+        result = { "total"     : self.total(),
+                   "addresses" : self.address_rows(source_map, assembly),
+                   "ram"       : self.ram_rows() }
+        if source_map is not None:
+            result["lines"] = self.line_rows(source_map, source)
+        return result
+# ~~~~~~~~ End Profile Definition ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Report Formatting ~~~~~~~~
+# The columns a hotspot report can be sorted by
+SortKeys = ["count", "taken", "not_taken", "address", "line"]
+
+
+# Sorts report rows, biggest counts first, or in program order for `address` and `line`
+def sort_rows(rows, sort_by="count"):
+    if sort_by not in SortKeys:
+        raise Exception("\"{}\" is not a valid sort key! Options are: {}".format(sort_by, ", ".join(SortKeys)))
+    if sort_by in ["address", "line"]:
+        return sorted(rows, key=lambda row: (row[sort_by] is None, row[sort_by] or 0))
+    return sorted(rows, key=lambda row: row[sort_by], reverse=True)
+
+
+# Formats the hotspot report as text, by source line when there is a source map, otherwise by ROM address
+def hotspot_report(profile, source_map=None, source=None, assembly=None, sort_by="count", limit=20):
+    total = profile.total()
+    if source_map is not None:
+        rows = sort_rows(profile.line_rows(source_map, source), sort_by if sort_by != "address" else "line")
+        heading = "{:>6} {:>12} {:>7} {:>10} {:>10}  {}".format("line", "count", "%", "taken", "not taken", "source")
+    else:
+        rows = sort_rows(profile.address_rows(None, assembly), sort_by if sort_by != "line" else "address")
+        heading = "{:>6} {:>12} {:>7} {:>10} {:>10}  {}".format("addr", "count", "%", "taken", "not taken", "instruction")
+    if limit is not None:
+        rows = rows[:limit]
+    
+    out = ["{} instructions executed".format(total), heading]
+    for row in rows:
+        if source_map is not None:
+            where = "?" if row["line"] is None else row["line"]
+            text = row["text"] or ""
+        else:
+            where = row["address"]
+            text = row["asm"] or ""
+        share = 100 * row["count"] / total if total > 0 else 0
+        out.append("{:>6} {:>12} {:>6.2f}% {:>10} {:>10}  {}".format(where, row["count"], share, row["taken"], row["not_taken"], text))
+    return "\n".join(out)
+# ~~~~~~~~ End Report Formatting ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Main Program ~~~~~~~~
+def main(file_in, cycles, sort_by="count", limit=20, json_file=None):
+    # The emulator is only needed to run a program from the command line
+    import emulator
+    
+    emu = emulator.Emulator()
+    emu.load_program(file_in)
+    emu.enable_profiling()
+    emu.run(cycles, detect_halts=True)
+    
+    print(emu.profile_report(sort_by, limit))
+    if json_file is not None:
+        with open(json_file, "w") as f:
+            json.dump(emu.profile_dump(), f)
+    return 0
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        description="Runs a FET-80 program with the profiler, and prints where it spent its cycles",
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    argparser.add_argument("-f", "--file", type=helpers.file_path, required=True,
+        help="the .f80asm or .f80bin file to profile")
+    argparser.add_argument("-c", "--cycles", type=int, default=1000000,
+        help="the most instructions to run (default: 1000000)")
+    argparser.add_argument("-s", "--sort", choices=SortKeys, default="count",
+        help="the column to sort the report by (default: count)")
+    argparser.add_argument("-n", "--top", type=int, default=20,
+        help="the number of rows to show (default: 20)")
+    argparser.add_argument("-j", "--json", default=None,
+        help="also write the full profile to this JSON file")
+    args = vars(argparser.parse_args())
+    
+    # Run main
+    exit_code = main(args["file"], args["cycles"], args["sort"], args["top"], args["json"])
+    sys.exit(exit_code)
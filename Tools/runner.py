@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import helpers
+import assembler
+import asmcache
+import engine
+import timing
+from emulator import Emulator, Engines
+
+
+# The default cycle budget for a single program
+DefaultCycles = 1000000
+
+
+# ~~~~~~~~ Begin Job Definition ~~~~~~~~
+# Converts an address or value argument to an integer
+# It can be a number (decimal, 0x hex or 0b binary), an assembler constant like `IO0`, or a symbol of the program
+def parse_value(text, bits, symbols=None):
+    for s in assembler.Fet80Params.AsmConstants:
+        if s["name"] == text:
+            return s["value"]
+    if symbols is not None and text in symbols:
+        return symbols[text]
+    value = helpers.Dec2(bits).int_from_formatted(text)
+    if value is False:
+        raise Exception("\"{}\" is not a valid number or symbol!".format(text))
+    return value
+
+
+# Converts a RAM range argument (`START:END` with END exclusive, or a single `ADDRESS`) to a (start, end) tuple
+def parse_range(text, bits, symbols=None):
+    if ":" in text:
+        start, end = text.split(":", 1)
+        return parse_value(start, bits, symbols), parse_value(end, bits, symbols)
+    start = parse_value(text, bits, symbols)
+    return start, start + 1
+
+
+# Makes the description of a single run, which is sent to a worker process
+# With a `clock`, the program is profiled and the result gets a runtime estimate for the hardware (using `costs`, or the defaults)
+def make_job(file_in, cycles=DefaultCycles, ram=None, dumps=None, stop_pcs=None, halt=True, engine_name="fast", clock=None, costs=None):
+    return { "file"     : file_in,
+             "cycles"   : cycles,
+             "ram"      : list(ram or []),
+             "dumps"    : list(dumps or []),
+             "stop_pcs" : list(stop_pcs or []),
+             "halt"     : halt,
+             "engine"   : engine_name,
+             "clock"    : clock,
+             "costs"    : costs }
+
+
+# Returns the registers, flags and selected RAM ranges of an emulator
+# `dumps` is a list of (text, start, end) ranges, already parsed with `parse_range()`
+def machine_state(emu, dumps):
+    fet80 = emu.fet80
+    a, b, mar, acc, cout, pc = engine.read_state(fet80)
+    ram = emu.get_RAM_int()
+    ranges = dict()
+    for text, start, end in dumps:
+        ranges[text] = ram[start:end]
+    return { "pc"        : pc,
+             "registers" : { "A" : a, "B" : b, "MAR" : mar, "ACC" : acc },
+             "flags"     : None if fet80.alu.unset else fet80.flags(),
+             "ram"       : ranges }
+
+
+# Runs a single job, returning its result as a dict
+# Errors are reported in the result rather than raised, so one bad program doesn't stop a batch
+def run_job(job):
+    result = { "file"   : job["file"],
+               "status" : "error",
+               "error"  : None }
+    
+    # Load the program
+    start_time = time.perf_counter()
+    try:
+        emu = Emulator(job["engine"])
+        emu.load_program(job["file"])
+        bits = emu.fet80.bits()
+        symbols = emu.fet80.rom.symbols()
+        for address, value in job["ram"]:
+            emu.set_RAM(parse_value(address, bits["address"], symbols), parse_value(value, bits["data"], symbols))
+        stop_pcs = {parse_value(text, bits["address"], symbols) for text in job["stop_pcs"]}
+        # The dump ranges and cost table are checked before running, as a symbol may only exist in some of the programs
+        dumps = [(text,) + parse_range(text, bits["address"], symbols) for text in job["dumps"]]
+        if job["clock"] is not None:
+            costs = timing.CostTable(job["costs"])
+            emu.enable_profiling()
+    except Exception as e:
+        result["error"] = str(e)
+        return result
+    result["load_seconds"] = time.perf_counter() - start_time
+    
+    # Run the program
+    cycles = 0
+    start_time = time.perf_counter()
+    try:
+        cycles = emu.run(job["cycles"], stop_pcs if stop_pcs else None, detect_halts=job["halt"])
+        if emu.halted is not None:
+            result["status"] = "halted"
+        elif emu.get_PC() in stop_pcs:
+            result["status"] = "stopped"
+        else:
+            result["status"] = "budget"
+    except Exception as e:
+        cycles = emu.executed
+        result["error"] = str(e)
+    seconds = time.perf_counter() - start_time
+    
+    result["cycles"] = cycles
+    result["seconds"] = seconds
+    result["ips"] = cycles / seconds if seconds > 0 else None
+    
+    # Collect the results
+    try:
+        result.update(machine_state(emu, dumps))
+        if job["clock"] is not None:
+            estimate = emu.estimate_time(costs, job["clock"])
+            result["timing"] = { "clock"        : job["clock"],
+                                 "clock_cycles" : estimate.total_cycles(),
+                                 "seconds"      : estimate.seconds() }
+    except Exception as e:
+        result["status"] = "error"
+        if result["error"] is None:
+            result["error"] = str(e)
+    return result
+
+
+# Points the assembly cache of a worker process at an on-disk store
+def init_worker(cache_dir):
+    if cache_dir is not None:
+        asmcache.default_cache.set_directory(cache_dir)
+
+
+# Runs a list of jobs across `processes` worker processes, yielding the results in job order
+def run_jobs(jobs, processes=None, cache_dir=None):
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(jobs))
+    
+    if processes <= 1:
+        init_worker(cache_dir)
+        for job in jobs:
+            yield run_job(job)
+        return
+    
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_worker, initargs=(cache_dir,)) as pool:
+        for result in pool.map(run_job, jobs):
+            yield result
+# ~~~~~~~~ End Job Definition ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Main Program ~~~~~~~~
+def main(files, cycles=DefaultCycles, ram=None, dumps=None, stop_pcs=None, halt=True, engine_name="fast", processes=None, cache_dir=None, output=None, clock=None, costs_file=None):
+    costs = timing.CostTable.from_file(costs_file).to_dict() if costs_file is not None else None
+    jobs = [make_job(f, cycles, ram, dumps, stop_pcs, halt, engine_name, clock, costs) for f in files]
+    
+    out = sys.stdout if output is None else open(output, "w")
+    failed = False
+    try:
+        for result in run_jobs(jobs, processes, cache_dir):
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            if result["status"] == "error":
+                failed = True
+    finally:
+        if output is not None:
+            out.close()
+    
+    return 1 if failed else 0
+
+
+# Splits an `ADDRESS=VALUE` argument
+def ram_value(string):
+    if "=" not in string:
+        raise argparse.ArgumentTypeError("RAM values must be given as ADDRESS=VALUE: \"{}\"".format(string))
+    address, value = string.split("=", 1)
+    return address, value
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        description="Runs .f80asm or .f80bin programs without the GUI, printing the results as JSON lines",
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    argparser.add_argument("files", nargs="+", type=helpers.file_path,
+        help="the .f80asm or .f80bin files to run")
+    argparser.add_argument("-c", "--cycles", type=int, default=DefaultCycles,
+        help="the most instructions to run per program (default: {})".format(DefaultCycles))
+    argparser.add_argument("-r", "--ram", type=ram_value, action="append", default=[],
+        help="set a RAM word before running, as ADDRESS=VALUE (e.g. IO0=0x12), may be repeated")
+    argparser.add_argument("-d", "--dump", action="append", default=[],
+        help="a RAM range to report, as START:END (END exclusive) or a single ADDRESS, may be repeated")
+    argparser.add_argument("-p", "--stop-pc", action="append", default=[],
+        help="stop when the PC reaches this address or label, may be repeated")
+    argparser.add_argument("--no-halt", action="store_true",
+        help="don't stop when the program reaches a loop that can never change the machine state")
+    argparser.add_argument("-e", "--engine", choices=list(Engines.keys()), default="fast",
+        help="the execution engine to use (default: fast)")
+    argparser.add_argument("-j", "--jobs", type=int, default=None,
+        help="the number of worker processes (default: one per CPU)")
+    argparser.add_argument("--cache-dir", default=None,
+        help="a directory to share assembled programs between workers and runs")
+    argparser.add_argument("-k", "--clock", type=float, default=None,
+        help="estimate the runtime on the hardware at this clock frequency in Hz (runs the profiler)")
+    argparser.add_argument("-t", "--costs", type=helpers.file_path, default=None,
+        help="a JSON file of instruction cycle costs for the runtime estimate (see timing.CostTable)")
+    argparser.add_argument("-o", "--output", default=None,
+        help="the file to write the results to (default: stdout)")
+    args = vars(argparser.parse_args())
+    
+    # Run main
+    exit_code = main( args["files"],
+                      cycles      = args["cycles"],
+                      ram         = args["ram"],
+                      dumps       = args["dump"],
+                      stop_pcs    = args["stop_pc"],
+                      halt        = not args["no_halt"],
+                      engine_name = args["engine"],
+                      processes   = args["jobs"],
+                      cache_dir   = args["cache_dir"],
+                      output      = args["output"],
+                      clock       = args["clock"],
+                      costs_file  = args["costs"] )
+    sys.exit(exit_code)
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import helpers
+import engine
+import tracer
+import runner
+from emulator import Emulator, Engines
+
+
+# ~~~~~~~~ Begin Manifest Definition ~~~~~~~~
+# A manifest is a JSON file of program tests:
+#   { "defaults" : { "cycles" : 100000, "halt" : true, "engine" : "fast" },
+#     "tests"    : [ { "name"   : "sub",
+#                      "file"   : "../Code/SUB.f80asm",
+#                      "ram"    : { "IO1" : 5 },
+#                      "expect" : { "status"    : "halted",
+#                                   "ram"       : { "IO0" : 87, "0x10:0x12" : [1, 2] },
+#                                   "registers" : { "A" : 87, "PC" : "LOOP" },
+#                                   "flags"     : { "eqz" : false } } } ] }
+# Files are relative to the manifest, and addresses and values can be numbers, assembler constants or program symbols
+# `ram` sets RAM words before the run, and anything left out of `expect` isn't checked (null expects an unset value)
+Defaults = { "cycles" : runner.DefaultCycles,
+             "halt"   : True,
+             "engine" : "fast" }
+
+
+# Reads a manifest, returning its tests with the defaults filled in and the files made absolute
+def load_manifest(file_in):
+    with open(file_in, "r") as f:
+        manifest = json.load(f)
+    if isinstance(manifest, list):
+        manifest = {"tests" : manifest}
+    defaults = dict(Defaults)
+    defaults.update(manifest.get("defaults", dict()))
+    base = os.path.dirname(os.path.abspath(file_in))
+    
+    tests = list()
+    for index, entry in enumerate(manifest["tests"]):
+        if "file" not in entry:
+            raise Exception("Test {} of \"{}\" has no program file!".format(index, file_in))
+        test = dict(defaults)
+        test.update(entry)
+        test["index"] = index
+        test["name"] = entry.get("name", "{}#{}".format(entry["file"], index))
+        test["file"] = os.path.normpath(os.path.join(base, entry["file"]))
+        test["ram"] = dict(entry.get("ram", dict()))
+        test["expect"] = dict(entry.get("expect", dict()))
+        if test["engine"] not in Engines:
+            raise Exception("Test \"{}\" uses an unknown engine \"{}\"! Options are: {}".format(test["name"], test["engine"], ", ".join(Engines.keys())))
+        tests.append(test)
+    return tests
+
+
+# Splits tests into shards for the worker processes, keeping tests of the same program together so a worker loads it once
+def make_shards(tests, shard_size):
+    shards = list()
+    for test in sorted(tests, key=lambda test: (test["file"], test["index"])):
+        if len(shards) == 0 or len(shards[-1]) >= shard_size or shards[-1][-1]["file"] != test["file"]:
+            shards.append(list())
+        shards[-1].append(test)
+    return shards
+# ~~~~~~~~ End Manifest Definition ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Worker Definition ~~~~~~~~
+# Each worker process keeps one emulator per engine, with a snapshot of its blank state
+# Every test loads its program only if it isn't loaded already, then restores the blank snapshot, so nothing is rebuilt between tests
+worker_emulators = dict()
+
+
+# Returns the worker's emulator for an engine, loaded with `file_in` and reset to a blank machine
+def worker_emulator(engine_name, file_in):
+    if engine_name not in worker_emulators:
+        emu = Emulator(engine_name)
+        worker_emulators[engine_name] = (emu, emu.snapshot())
+    emu, blank = worker_emulators[engine_name]
+    if emu.current_program != file_in:
+        try:
+            emu.load_program(file_in)
+        except Exception:
+            # Don't let a failed load look like a loaded program to the next test
+            emu.current_program = None
+            raise
+    emu.restore(blank)
+    return emu
+
+
+# Sets the RAM inputs of a test, returning them as {address : value}
+def set_inputs(emu, test, symbols):
+    bits = emu.fet80.bits()
+    inputs = dict()
+    for address, value in test["ram"].items():
+        address = runner.parse_value(str(address), bits["address"], symbols)
+        value = runner.parse_value(str(value), bits["data"], symbols)
+        emu.set_RAM(address, value)
+        inputs[address] = value
+    return inputs
+
+
+# Returns the (name, expected, actual, location) of every expectation of a test that doesn't hold
+# `location` is what was written to get the actual value, as an (`engine` target, address) tuple, or None if it can't be traced
+def check_expectations(emu, test, status, symbols):
+    expect = test["expect"]
+    bits = emu.fet80.bits()
+    mismatches = list()
+    
+    def expected_value(value, bits):
+        return value if value is None else runner.parse_value(str(value), bits, symbols)
+    
+    if "status" in expect and expect["status"] != status:
+        mismatches.append(("status", expect["status"], status, None))
+    
+    ram = emu.get_RAM_int()
+    for text, value in expect.get("ram", dict()).items():
+        start, end = runner.parse_range(str(text), bits["address"], symbols)
+        values = value if isinstance(value, list) else [value]
+        if len(values) != end - start:
+            raise Exception("Test \"{}\" expects {} values for RAM \"{}\", which is {} words!".format(test["name"], len(values), text, end - start))
+        for offset, value in enumerate(values):
+            wanted = expected_value(value, bits["data"])
+            if ram[start + offset] != wanted:
+                mismatches.append(("RAM[{}]".format(start + offset), wanted, ram[start + offset], (engine.TargetRAM, start + offset)))
+    
+    a, b, mar, acc, cout, pc = engine.read_state(emu.fet80)
+    registers = { "A"   : (a, engine.TargetA),
+                  "B"   : (b, engine.TargetB),
+                  "MAR" : (mar, engine.TargetMAR),
+                  "ACC" : (acc, "ACC"),
+                  "PC"  : (pc, None) }
+    for name, value in expect.get("registers", dict()).items():
+        if name not in registers:
+            raise Exception("Test \"{}\" expects an unknown register \"{}\"! Options are: {}".format(test["name"], name, ", ".join(registers.keys())))
+        actual, target = registers[name]
+        wanted = expected_value(value, bits["address"] if name in ["MAR", "PC"] else bits["data"])
+        if actual != wanted:
+            mismatches.append((name, wanted, actual, None if target is None else (target, 0)))
+    
+    flags = None if emu.fet80.alu.unset else emu.fet80.flags()
+    for name, value in expect.get("flags", dict()).items():
+        actual = None if flags is None else flags.get(name)
+        if actual != value:
+            mismatches.append(("flag " + name, value, actual, ("ACC", 0)))
+    return mismatches
+
+
+# Finds where a failing test went wrong, by running it again with the tracer on
+# Returns the earliest of the last writes to each wrong location, as the cycle, PC and source line of the instruction that made it
+def find_divergence(test, locations):
+    locations = [location for location in locations if location is not None]
+    if len(locations) == 0:
+        return None
+    
+    handle, trace_file = tempfile.mkstemp(suffix=".f80trace")
+    os.close(handle)
+    try:
+        emu = worker_emulator(test["engine"], test["file"])
+        set_inputs(emu, test, emu.fet80.rom.symbols())
+        emu.enable_tracing(trace_file)
+        try:
+            emu.run(test["cycles"], detect_halts=test["halt"])
+        except Exception:
+            pass
+        finally:
+            emu.disable_tracing()
+        
+        last = dict()
+        previous_acc = None
+        for record in tracer.TraceReader(trace_file).records():
+            if record.target != engine.NoTarget:
+                last[(record.target, record.address if record.target == engine.TargetRAM else 0)] = record
+            if record.acc != previous_acc:
+                last[("ACC", 0)] = record
+                previous_acc = record.acc
+    finally:
+        os.remove(trace_file)
+    
+    writes = [last[location] for location in locations if location in last]
+    if len(writes) == 0:
+        return None
+    record = min(writes, key=lambda record: record.cycle)
+    source_map = emu.fet80.rom.source_map()
+    return { "cycle" : record.cycle,
+             "pc"    : record.pc,
+             "line"  : source_map[record.pc] if source_map is not None and record.pc < len(source_map) else None }
+
+
+# Builds the runner command line that reproduces a test
+def repro_command(test):
+    command = ["python", "runner.py", test["file"], "-c", str(test["cycles"])]
+    for address, value in test["ram"].items():
+        command += ["-r", "{}={}".format(address, value)]
+    for text in test["expect"].get("ram", dict()).keys():
+        command += ["-d", str(text)]
+    if not test["halt"]:
+        command.append("--no-halt")
+    if test["engine"] != "fast":
+        command += ["-e", test["engine"]]
+    return " ".join(command)
+
+
+# Runs a single test on the worker's emulator, returning its result as a dict
+def run_test(test):
+    result = { "index"  : test["index"],
+               "name"   : test["name"],
+               "file"   : test["file"],
+               "passed" : False,
+               "error"  : None }
+    start_time = time.perf_counter()
+    try:
+        emu = worker_emulator(test["engine"], test["file"])
+        symbols = emu.fet80.rom.symbols()
+        set_inputs(emu, test, symbols)
+        status = "error"
+        try:
+            emu.run(test["cycles"], detect_halts=test["halt"])
+            status = "halted" if emu.halted is not None else "budget"
+        except Exception as e:
+            result["error"] = str(e)
+        result["status"] = status
+        result["cycles"] = emu.executed
+        
+        # A fault fails the test unless it expects one
+        mismatches = check_expectations(emu, test, status, symbols)
+        if status == "error" and "status" not in test["expect"]:
+            mismatches.append(("status", "no error", status, None))
+        result["passed"] = len(mismatches) == 0
+        result["mismatches"] = [ { "name"     : name,
+                                   "expected" : expected,
+                                   "actual"   : actual } for name, expected, actual, location in mismatches ]
+        if not result["passed"]:
+            result["repro"] = { "file"       : test["file"],
+                                "ram"        : test["ram"],
+                                "cycles"     : test["cycles"],
+                                "command"    : repro_command(test),
+                                "divergence" : find_divergence(test, [m[3] for m in mismatches]) }
+    except Exception as e:
+        # The test itself is broken (a missing file, a bad address, ...)
+        result["status"] = "broken"
+        result["error"] = str(e)
+    result["seconds"] = time.perf_counter() - start_time
+    return result
+
+
+# Runs a shard of tests in a worker process
+def run_shard(shard):
+    return [run_test(test) for test in shard]
+
+
+# Runs tests across `processes` worker processes, yielding the results as each shard finishes
+def run_tests(tests, processes=None, cache_dir=None, shard_size=None):
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(tests)))
+    if shard_size is None:
+        # A few shards per process, so the pool stays balanced when some tests are slow
+        shard_size = max(1, len(tests) // (processes * 4))
+    shards = make_shards(tests, shard_size)
+    
+    if processes <= 1:
+        runner.init_worker(cache_dir)
+        for shard in shards:
+            for result in run_shard(shard):
+                yield result
+        return
+    
+    with ProcessPoolExecutor(max_workers=processes, initializer=runner.init_worker, initargs=(cache_dir,)) as pool:
+        for results in pool.map(run_shard, shards):
+            for result in results:
+                yield result
+# ~~~~~~~~ End Worker Definition ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Report Definition ~~~~~~~~
+# Adds up the results of a run
+def summarize(results, wall_seconds, slowest=5):
+    summary = { "tests"        : len(results),
+                "passed"       : sum(1 for result in results if result["passed"]),
+                "failed"       : sum(1 for result in results if not result["passed"] and result["status"] != "broken"),
+                "broken"       : sum(1 for result in results if result["status"] == "broken"),
+                "cycles"       : sum(result.get("cycles", 0) for result in results),
+                "wall_seconds" : wall_seconds,
+                "test_seconds" : sum(result["seconds"] for result in results) }
+    summary["slowest"] = [ { "name"    : result["name"],
+                             "seconds" : result["seconds"] } for result in sorted(results, key=lambda result: result["seconds"], reverse=True)[:slowest] ]
+    return summary
+
+
+# Formats a failed or broken test as text
+def format_failure(result):
+    out = ["{} {}: {}".format("BROKEN" if result["status"] == "broken" else "FAIL", result["name"], result["error"] or "")]
+    for mismatch in result.get("mismatches", list()):
+        out.append("    {}: expected {}, got {}".format(mismatch["name"], mismatch["expected"], mismatch["actual"]))
+    repro = result.get("repro")
+    if repro is not None:
+        divergence = repro["divergence"]
+        if divergence is not None:
+            out.append("    last bad write at cycle {} (PC {}, line {})".format(divergence["cycle"], divergence["pc"], divergence["line"]))
+        out.append("    repro: {}".format(repro["command"]))
+    return "\n".join(out)
+# ~~~~~~~~ End Report Definition ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Main Program ~~~~~~~~
+def main(manifest_file, processes=None, cache_dir=None, shard_size=None, output=None):
+    tests = load_manifest(manifest_file)
+    start_time = time.perf_counter()
+    results = sorted(run_tests(tests, processes, cache_dir, shard_size), key=lambda result: result["index"])
+    summary = summarize(results, time.perf_counter() - start_time)
+    
+    for result in results:
+        if not result["passed"]:
+            print(format_failure(result))
+    print("{} tests: {} passed, {} failed, {} broken ({} cycles in {:.3f} s)".format( summary["tests"],
+                                                                                     summary["passed"],
+                                                                                     summary["failed"],
+                                                                                     summary["broken"],
+                                                                                     summary["cycles"],
+                                                                                     summary["wall_seconds"] ))
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump({"summary" : summary, "results" : results}, f)
+    return 0 if summary["passed"] == summary["tests"] else 1
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        description="Runs a manifest of FET-80 program tests across worker processes, checking their final RAM, registers and flags",
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    argparser.add_argument("manifest", type=helpers.file_path,
+        help="the JSON manifest of tests to run")
+    argparser.add_argument("-j", "--jobs", type=int, default=None,
+        help="the number of worker processes (default: one per CPU)")
+    argparser.add_argument("--cache-dir", default=None,
+        help="a directory to share assembled programs between workers and runs")
+    argparser.add_argument("-s", "--shard-size", type=int, default=None,
+        help="the most tests sent to a worker at once (default: a few shards per worker)")
+    argparser.add_argument("-o", "--output", default=None,
+        help="also write the summary and every result to this JSON file")
+    args = vars(argparser.parse_args())
+    
+    # Run main
+    exit_code = main(args["manifest"], args["jobs"], args["cache_dir"], args["shard_size"], args["output"])
+    sys.exit(exit_code)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+import sys
+from array import array
+
+import engine
+import devices
+
+
+# ~~~~~~~~ Begin Undo Log Definition ~~~~~~~~
+# What each control word overwrites, with nothing for an empty ROM word (it faults before changing anything)
+Targets = {op : engine.kind_target(kind) for op, kind in engine.Kinds.items()}
+Targets[engine.EmptyOp] = engine.NoTarget
+
+
+# A fixed size ring buffer of undo records, one per executed instruction
+# Each record holds the old PC, what was overwritten and its old value, and the old ALU accumulator and flags
+# Unset values are stored as -1
+class UndoLog:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.pcs = array("L", [0]) * capacity
+        self.targets = array("B", [0]) * capacity
+        self.addresses = array("L", [0]) * capacity
+        self.values = array("q", [0]) * capacity
+        self.accs = array("q", [0]) * capacity
+        self.flags = array("b", [0]) * capacity
+        self.clear()
+    
+    
+    # Forgets every record
+    def clear(self):
+        self.head = 0
+        self.count = 0
+    
+    
+    # Adds a record, dropping the oldest one when the log is full
+    def push(self, pc, target, address, value, acc, flags):
+        i = self.head
+        self.pcs[i] = pc
+        self.targets[i] = target
+        self.addresses[i] = address
+        self.values[i] = value
+        self.accs[i] = acc
+        self.flags[i] = flags
+        self.head = (i + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+    
+    
+    # Removes the newest record, returning it as a (pc, target, address, value, acc, flags) tuple
+    def pop(self):
+        if self.count == 0:
+            raise Exception("The undo log is empty!")
+        i = (self.head - 1) % self.capacity
+        self.head = i
+        self.count -= 1
+        return self.pcs[i], self.targets[i], self.addresses[i], self.values[i], self.accs[i], self.flags[i]
+    
+    
+    # The memory used by the log, in bytes
+    def size(self):
+        return sum(a.itemsize * len(a) for a in [self.pcs, self.targets, self.addresses, self.values, self.accs, self.flags])
+# ~~~~~~~~ End Undo Log Definition ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Time Travel Definition ~~~~~~~~
+# Time travel debugging for an `Emulator`: stepping back, running back to a breakpoint, and jumping to any cycle
+# The last `capacity` instructions are undone straight from the undo log
+# Anything further back restores the last checkpoint before it and runs forward from there, which gives the same states again
+# Checkpoints are snapshots taken every `checkpoint_interval` cycles; when there are more than `max_checkpoints`, the interval doubles and every other one is dropped
+# Call `reset()` after changing the machine state by hand, as the history no longer leads to it
+class TimeTravel:
+    def __init__(self, emu, capacity=16384, checkpoint_interval=4096, max_checkpoints=256):
+        if capacity < 1 or checkpoint_interval < 1 or max_checkpoints < 2:
+            raise Exception("Time travel needs room for at least 1 undo record and 2 checkpoints!")
+        self.emu = emu
+        self.log = UndoLog(capacity)
+        self.base_interval = checkpoint_interval
+        self.max_checkpoints = max_checkpoints
+        self.reset()
+    
+    
+    # Makes the current machine state cycle 0, forgetting all history
+    def reset(self):
+        self.cycle = 0
+        self.log.clear()
+        self.interval = self.base_interval
+        self.checkpoints = { 0 : self.emu.snapshot() }
+    
+    
+    # Takes a checkpoint at the current cycle, thinning the checkpoints out if there are too many
+    def checkpoint(self):
+        if self.cycle in self.checkpoints:
+            return
+        self.checkpoints[self.cycle] = self.emu.snapshot()
+        while len(self.checkpoints) > self.max_checkpoints:
+            self.interval *= 2
+            self.checkpoints = {c : s for c, s in self.checkpoints.items() if c % self.interval == 0}
+    
+    
+    # Executes a single instruction, recording how to undo it
+    def record_step(self):
+        fet80 = self.emu.fet80
+        pc = fet80.rom.pc.value
+        op, value = fet80.rom.decoded[pc]
+        target = Targets[op]
+        
+        address = 0
+        old = -1
+        if target == engine.TargetA or target == engine.TargetB:
+            register = fet80.registers["A" if target == engine.TargetA else "B"]
+            if register.is_set():
+                old = register.value
+        elif target == engine.TargetMAR:
+            if fet80.ram.address.is_set():
+                old = fet80.ram.address.value
+        elif target == engine.TargetRAM and fet80.ram.address.is_set():
+            address = fet80.ram.address.value
+            if fet80.ram.written[address]:
+                old = fet80.ram.data[address]
+        
+        alu = fet80.alu
+        acc = -1 if alu.unset else alu.acc.value
+        flags = -1 if alu.unset else alu.packed
+        
+        # Only record the step if it completed
+        self.emu.engine.run(1)
+        self.log.push(pc, target, address, old, acc, flags)
+        self.cycle += 1
+        if self.cycle % self.interval == 0:
+            self.checkpoint()
+    
+    
+    # Undoes the newest recorded instruction
+    def undo_step(self):
+        pc, target, address, old, acc, flags = self.log.pop()
+        fet80 = self.emu.fet80
+        
+        fet80.rom.pc.value = pc
+        if target == engine.TargetA or target == engine.TargetB:
+            register = fet80.registers["A" if target == engine.TargetA else "B"]
+            register.value = None if old < 0 else old
+            register.set_flag = old >= 0
+        elif target == engine.TargetMAR:
+            fet80.ram.address.value = None if old < 0 else old
+            fet80.ram.address.set_flag = old >= 0
+        elif target == engine.TargetRAM:
+            fet80.ram.data[address] = 0 if old < 0 else old
+            fet80.ram.written[address] = 0 if old < 0 else 1
+            if fet80.ram.bus.pages[address >> devices.PageBits] is not None:
+                fet80.ram.bus.changed(address)
+        
+        alu = fet80.alu
+        alu.unset = acc < 0
+        alu.packed = None if acc < 0 else flags
+        alu.acc.value = None if acc < 0 else acc
+        alu.acc.set_flag = acc >= 0
+        self.cycle -= 1
+    
+    
+    # Runs forward up to `cycles` instructions, stopping after one that leaves the PC at an address in `breakpoints`
+    # Only the instructions that can still fit in the undo log are recorded, everything before them runs at full engine speed
+    # With `record` off nothing is recorded, so stepping back afterwards replays from the last checkpoint
+    # Returns the number of instructions executed
+    def run(self, cycles=1, breakpoints=None, record=True):
+        stops = frozenset(breakpoints) if breakpoints else None
+        start = self.cycle
+        target = self.cycle + cycles
+        recorded = self.log.capacity if record else 0
+        while self.cycle < target:
+            remaining = target - self.cycle
+            if remaining > recorded:
+                # None of these will be left in the undo log, so run them on the engine, stopping at each checkpoint
+                chunk = min(remaining - recorded, self.interval - self.cycle % self.interval)
+                self.log.clear()
+                try:
+                    self.emu.engine.run(chunk, stops)
+                finally:
+                    self.cycle += self.emu.engine.executed
+                if self.cycle % self.interval == 0:
+                    self.checkpoint()
+                # A breakpoint on the last instruction of the chunk uses the whole chunk, so the PC is checked as well
+                if self.emu.engine.executed < chunk or (stops is not None and self.emu.get_PC() in stops):
+                    # Stopped at a breakpoint
+                    break
+            else:
+                self.record_step()
+                if stops is not None and self.emu.get_PC() in stops:
+                    break
+        return self.cycle - start
+    
+    
+    # Goes to cycle `target`, forwards or backwards
+    def go_to(self, target):
+        if target < 0:
+            raise Exception("Can't go back before cycle 0!")
+        if target > self.cycle:
+            # Start from the latest checkpoint on the way if there is one, as the program always takes the same path
+            latest = max(c for c in self.checkpoints if c <= target)
+            if latest > self.cycle:
+                self.restore_checkpoint(latest)
+            self.run(target - self.cycle)
+        elif self.cycle - target <= self.log.count:
+            while self.cycle > target:
+                self.undo_step()
+        else:
+            self.restore_checkpoint(max(c for c in self.checkpoints if c <= target))
+            self.run(target - self.cycle)
+    
+    
+    # Puts the machine back to a checkpoint
+    def restore_checkpoint(self, cycle):
+        self.emu.restore(self.checkpoints[cycle])
+        self.cycle = cycle
+        self.log.clear()
+    
+    
+    # Steps back `cycles` instructions (stopping at cycle 0)
+    def step_back(self, cycles=1):
+        self.go_to(max(0, self.cycle - cycles))
+        return self.cycle
+    
+    
+    # Steps back until an instruction leaves the PC at an address in `breakpoints`, or all the way to cycle 0
+    # Returns the cycle it stopped at
+    def run_back(self, breakpoints):
+        breakpoints = frozenset(breakpoints)
+        while self.cycle > 0:
+            if self.log.count == 0:
+                # Refill the undo log from the checkpoint before this cycle
+                self.go_to(self.cycle - 1)
+            else:
+                self.undo_step()
+            if self.emu.get_PC() in breakpoints:
+                break
+        return self.cycle
+    
+    
+    # The memory used by the undo log and checkpoints, in bytes (shared RAM pages are only counted once)
+    def size(self):
+        pages = dict()
+        for snapshot in self.checkpoints.values():
+            for page in snapshot.pages:
+                pages[id(page)] = len(page[0]) + len(page[1])
+        return self.log.size() + sum(pages.values())
+# ~~~~~~~~ End Time Travel Definition ~~~~~~~~
+
+
+if __name__ == '__main__':
+    print("This module is not meant to be run on it's own!")
+    sys.exit()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import bisect
+import argparse
+
+import helpers
+import assembler
+import engine
+import blocks
+
+
+# The default clock of the real board, in Hz
+DefaultClock = 1000
+
+
+# ~~~~~~~~ Begin Cost Table Definition ~~~~~~~~
+# The number of clock cycles each kind of instruction takes on the hardware
+# An instruction costs the base cost of its type, plus extra cycles for RAM operands and for taken or not-taken jumps
+class CostTable:
+    # The default costs, to be replaced with measurements from the board
+    Defaults = { "T"              : 4,
+                 "M"              : 3,
+                 "C"              : 5,
+                 "J"              : 3,
+                 "D"              : 2,
+                 "src_M"          : 2,
+                 "src_DV"         : 1,
+                 "dest_M"         : 2,
+                 "jump_taken"     : 1,
+                 "jump_not_taken" : 0 }
+    
+    TypeNames = { assembler.AsmCodes.InstructionType.T_INSTRUCTION : "T",
+                  assembler.AsmCodes.InstructionType.M_INSTRUCTION : "M",
+                  assembler.AsmCodes.InstructionType.C_INSTRUCTION : "C",
+                  assembler.AsmCodes.InstructionType.J_INSTRUCTION : "J",
+                  assembler.AsmCodes.InstructionType.D_INSTRUCTION : "D" }
+    
+    def __init__(self, costs=None):
+        self.costs = dict(CostTable.Defaults)
+        if costs is not None:
+            for name, cost in costs.items():
+                if name not in self.costs:
+                    raise Exception("\"{}\" is not a known cost! Options are: {}".format(name, ", ".join(self.costs.keys())))
+                self.costs[name] = cost
+    
+    
+    # Makes a cost table from a JSON file of {name : cycles}, using the defaults for anything it leaves out
+    @staticmethod
+    def from_file(file_in):
+        with open(file_in, "r") as f:
+            return CostTable(json.load(f))
+    
+    
+    # Returns the cost table as a {name : cycles} dict
+    def to_dict(self):
+        return dict(self.costs)
+    
+    
+    # Returns the (not taken, taken) cycle costs of an instruction kind, which are the same for anything but a jump
+    def kind_cycles(self, kind):
+        instruction_type, opcode, src, dest = kind
+        cycles = self.costs[CostTable.TypeNames[instruction_type]]
+        if src == assembler.AsmCodes.Src.M:
+            cycles += self.costs["src_M"]
+        elif src == assembler.AsmCodes.Src.DV:
+            cycles += self.costs["src_DV"]
+        if dest == assembler.AsmCodes.Dest.M:
+            cycles += self.costs["dest_M"]
+        if instruction_type == assembler.AsmCodes.InstructionType.J_INSTRUCTION:
+            return cycles + self.costs["jump_not_taken"], cycles + self.costs["jump_taken"]
+        return cycles, cycles
+    
+    
+    # Returns the (not taken, taken) cycle costs for every control word
+    def op_cycles(self):
+        return {op : self.kind_cycles(kind) for op, kind in engine.Kinds.items()}
+# ~~~~~~~~ End Cost Table Definition ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Estimate Definition ~~~~~~~~
+# A runtime estimate for the real hardware, worked out from the execution counts of a `profiler.Profile`
+class Estimate:
+    def __init__(self, profile, decoded, table=None, clock=DefaultClock):
+        self.profile = profile
+        self.decoded = decoded
+        self.table = table if table is not None else CostTable()
+        self.clock = clock
+        
+        # Work out the clock cycles spent at every executed address
+        op_cycles = self.table.op_cycles()
+        self.cycles = dict()
+        for address, count in enumerate(profile.counts):
+            if count == 0:
+                continue
+            not_taken, taken = op_cycles[decoded[address][0]]
+            jumps = profile.taken[address]
+            self.cycles[address] = (count - jumps) * not_taken + jumps * taken
+    
+    
+    # The total number of clock cycles
+    def total_cycles(self):
+        return sum(self.cycles.values())
+    
+    
+    # The estimated wall clock time on the hardware, in seconds
+    def seconds(self):
+        return self.total_cycles() / self.clock
+    
+    
+    # Returns a row for every basic block that was executed, with its instructions, clock cycles and time
+    def block_rows(self, source_map=None):
+        leaders = sorted(blocks.find_leaders(self.decoded))
+        rows = dict()
+        for address, cycles in self.cycles.items():
+            start = leaders[bisect.bisect_right(leaders, address) - 1]
+            row = rows.get(start)
+            if row is None:
+                row = rows[start] = { "start"        : start,
+                                      "end"          : start,
+                                      "lines"        : None,
+                                      "instructions" : 0,
+                                      "cycles"       : 0 }
+            row["end"] = max(row["end"], address)
+            row["instructions"] += self.profile.counts[address]
+            row["cycles"] += cycles
+        
+        total = self.total_cycles()
+        for row in rows.values():
+            row["seconds"] = row["cycles"] / self.clock
+            row["share"] = row["cycles"] / total if total > 0 else 0
+            if source_map is not None:
+                lines = [source_map[a] for a in range(row["start"], row["end"] + 1) if a < len(source_map) and source_map[a] is not None]
+                if len(lines) > 0:
+                    row["lines"] = [min(lines), max(lines)]
+        return sorted(rows.values(), key=lambda row: row["cycles"], reverse=True)
+    
+    
+    # Returns the estimate as a JSON-ready dict
+    def dump(self, source_map=None):
+        return { "clock"        : self.clock,
+                 "costs"        : self.table.to_dict(),
+                 "instructions" : self.profile.total(),
+                 "cycles"       : self.total_cycles(),
+                 "seconds"      : self.seconds(),
+                 "blocks"       : self.block_rows(source_map) }
+    
+    
+    # Formats the estimate as text, with the blocks that took the most time first
+    def report(self, source_map=None, limit=20):
+        out = [ "{} instructions, {} clock cycles".format(self.profile.total(), self.total_cycles()),
+                "Estimated time at {} Hz: {}".format(self.clock, format_seconds(self.seconds())),
+                "{:>13} {:>11} {:>12} {:>12} {:>7}  {}".format("block", "lines", "instructions", "cycles", "%", "time") ]
+        rows = self.block_rows(source_map)
+        if limit is not None:
+            rows = rows[:limit]
+        for row in rows:
+            block = "{}-{}".format(row["start"], row["end"])
+            lines = "" if row["lines"] is None else "{}-{}".format(*row["lines"])
+            out.append("{:>13} {:>11} {:>12} {:>12} {:>6.2f}%  {}".format(block, lines, row["instructions"], row["cycles"], 100 * row["share"], format_seconds(row["seconds"])))
+        return "\n".join(out)
+
+
+# Formats a time in seconds with a sensible unit
+def format_seconds(seconds):
+    for unit, scale in [("s", 1), ("ms", 1e-3), ("us", 1e-6)]:
+        if seconds >= scale:
+            return "{:.3f} {}".format(seconds / scale, unit)
+    return "{:.3f} ns".format(seconds / 1e-9)
+# ~~~~~~~~ End Estimate Definition ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Main Program ~~~~~~~~
+def main(file_in, cycles, clock=DefaultClock, costs_file=None, limit=20, json_file=None):
+    # The emulator is only needed to run a program from the command line
+    import emulator
+    
+    table = CostTable.from_file(costs_file) if costs_file is not None else CostTable()
+    emu = emulator.Emulator()
+    emu.load_program(file_in)
+    emu.enable_profiling()
+    emu.run(cycles, detect_halts=True)
+    
+    estimate = emu.estimate_time(table, clock)
+    source_map = emu.fet80.rom.source_map()
+    print(estimate.report(source_map, limit))
+    if json_file is not None:
+        with open(json_file, "w") as f:
+            json.dump(estimate.dump(source_map), f)
+    return 0
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        description="Runs a FET-80 program and estimates how long it would take on the real hardware",
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    argparser.add_argument("-f", "--file", type=helpers.file_path, required=True,
+        help="the .f80asm or .f80bin file to run")
+    argparser.add_argument("-c", "--cycles", type=int, default=1000000,
+        help="the most instructions to run (default: 1000000)")
+    argparser.add_argument("-k", "--clock", type=float, default=DefaultClock,
+        help="the clock frequency of the hardware in Hz (default: {})".format(DefaultClock))
+    argparser.add_argument("-t", "--costs", type=helpers.file_path, default=None,
+        help="a JSON file of {name : cycles} costs to use in place of the defaults")
+    argparser.add_argument("-n", "--top", type=int, default=20,
+        help="the number of blocks to show (default: 20)")
+    argparser.add_argument("-j", "--json", default=None,
+        help="also write the full estimate to this JSON file")
+    args = vars(argparser.parse_args())
+    
+    # Run main
+    exit_code = main(args["file"], args["cycles"], args["clock"], args["costs"], args["top"], args["json"])
+    sys.exit(exit_code)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+import sys
+import bz2
+import gzip
+import lzma
+import struct
+import argparse
+from array import array
+from collections import namedtuple
+
+import helpers
+import assembler
+import engine
+
+
+# ~~~~~~~~ Begin Trace Format Definition ~~~~~~~~
+# A trace file is a header followed by one fixed size record per executed instruction, with the whole file optionally compressed
+# Every record is `engine.TraceFields` words, little endian, with the word size given in the header
+# Records carry no cycle number: the first one is at the header's start cycle, and each one after it is one cycle later
+Magic = b"F80TRACE"
+Version = 1
+
+# Magic, version, word size in bytes, fields per record, data bits, start cycle
+Header = struct.Struct("<8sBBBBQ")
+
+# The number of records buffered before they are written out
+DefaultBatch = 65536
+
+# The compressed stream openers, and the leading bytes each one writes so a reader can tell them apart
+Compressions = { "none" : open,
+                 "gzip" : gzip.open,
+                 "bz2"  : bz2.open,
+                 "lzma" : lzma.open }
+# The compression levels used when writing, picked for speed as a trace is written far more often than it is read
+CompressionLevels = { "none" : {},
+                      "gzip" : { "compresslevel" : 1 },
+                      "bz2"  : { "compresslevel" : 1 },
+                      "lzma" : { "preset" : 0 } }
+Signatures = { b"\x1f\x8b"         : "gzip",
+               b"BZh"              : "bz2",
+               b"\xfd7zXZ\x00"     : "lzma" }
+
+# The names of what a record's `target` field says was written
+TargetNames = { engine.NoTarget  : "-",
+                engine.TargetA   : "A",
+                engine.TargetB   : "B",
+                engine.TargetMAR : "MAR",
+                engine.TargetRAM : "M" }
+
+
+# The struct codes for little endian words of each size in bytes
+WordCodes = { 1 : "B",
+              2 : "H",
+              4 : "I",
+              8 : "Q" }
+
+
+# Returns the array typecode for words of `size` bytes
+def size_typecode(size):
+    for typecode in "BHILQ":
+        if array(typecode).itemsize == size:
+            return typecode
+    raise Exception("No array type is {} bytes wide!".format(size))
+
+
+# Returns the name of the compression used by a file, from its leading bytes
+def detect_compression(file_in):
+    with open(file_in, "rb") as f:
+        start = f.read(max(len(s) for s in Signatures.keys()))
+    for signature, name in Signatures.items():
+        if start.startswith(signature):
+            return name
+    return "none"
+# ~~~~~~~~ End Trace Format Definition ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Trace Writer Definition ~~~~~~~~
+# Streams trace records to a file
+# The traced core packs each record with `pack` and appends it straight onto `records`, and the engine calls `flush()`
+# every `batch` instructions, so memory use stays at one batch however long the run is
+class TraceWriter:
+    def __init__(self, file_out, data_bits=assembler.Fet80Params.DataWidth, word_size=2, compression="none", batch=DefaultBatch, start_cycle=0):
+        if compression not in Compressions:
+            raise Exception("\"{}\" is not a known compression! Options are: {}".format(compression, ", ".join(Compressions.keys())))
+        if word_size not in WordCodes:
+            raise Exception("Trace words can't be {} bytes wide! Options are: {}".format(word_size, ", ".join(str(size) for size in WordCodes.keys())))
+        if batch < 1:
+            raise Exception("The trace batch size must be at least 1!")
+        self.file_out = file_out
+        self.compression = compression
+        self.batch = batch
+        self.fields = len(engine.TraceFields)
+        self.record_size = word_size * self.fields
+        self.pack = struct.Struct("<{}{}".format(self.fields, WordCodes[word_size])).pack
+        self.records = bytearray()
+        # The number of records written so far
+        self.count = 0
+        
+        self.file = Compressions[compression](file_out, "wb", **CompressionLevels[compression])
+        self.file.write(Header.pack(Magic, Version, word_size, self.fields, data_bits, start_cycle))
+    
+    
+    # Writes out every buffered record, emptying the buffer in place so the core keeps appending to the same one
+    def flush(self):
+        if len(self.records) == 0:
+            return
+        self.file.write(self.records)
+        self.count += len(self.records) // self.record_size
+        del self.records[:]
+    
+    
+    # Flushes and closes the trace file
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *exc):
+        self.close()
+# ~~~~~~~~ End Trace Writer Definition ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Trace Reader Definition ~~~~~~~~
+# A single decoded trace record
+# `acc` and `flags` are None until the ALU has been used, otherwise `flags` is packed like `ALU.packed`
+TraceRecord = namedtuple("TraceRecord", ["cycle", "pc", "op", "operand", "target", "address", "value", "acc", "flags"])
+
+
+# Reads a trace file lazily, a batch of records at a time
+class TraceReader:
+    def __init__(self, file_in):
+        self.file_in = file_in
+        self.compression = detect_compression(file_in)
+        with Compressions[self.compression](file_in, "rb") as f:
+            header = f.read(Header.size)
+        if len(header) < Header.size:
+            raise Exception("\"{}\" is too short to be a trace!".format(file_in))
+        magic, version, self.word_size, self.fields, self.data_bits, self.start_cycle = Header.unpack(header)
+        if magic != Magic:
+            raise Exception("\"{}\" is not a FET-80 trace!".format(file_in))
+        if version != Version:
+            raise Exception("\"{}\" is a version {} trace, but only version {} can be read!".format(file_in, version, Version))
+        if self.fields != len(engine.TraceFields):
+            raise Exception("\"{}\" has {} fields per record, expected {}!".format(file_in, self.fields, len(engine.TraceFields)))
+        self.typecode = size_typecode(self.word_size)
+        self.record_size = self.word_size * self.fields
+    
+    
+    # Yields (first cycle, little endian bytes) for every batch of records
+    def blocks(self, batch=DefaultBatch):
+        cycle = self.start_cycle
+        with Compressions[self.compression](self.file_in, "rb") as f:
+            f.read(Header.size)
+            while True:
+                data = f.read(batch * self.record_size)
+                if len(data) == 0:
+                    return
+                if len(data) % self.record_size != 0:
+                    raise Exception("\"{}\" ends part way through a record!".format(self.file_in))
+                yield cycle, data
+                cycle += len(data) // self.record_size
+    
+    
+    # Yields (first cycle, words) for every batch of records, with the words in a flat array
+    def chunks(self, batch=DefaultBatch):
+        for cycle, data in self.blocks(batch):
+            words = array(self.typecode, data)
+            if sys.byteorder == "big":
+                words.byteswap()
+            yield cycle, words
+    
+    
+    # Yields every record as a `TraceRecord`
+    def records(self, batch=DefaultBatch):
+        half = 2 ** (self.data_bits - 1)
+        for cycle, words in self.chunks(batch):
+            columns = [words[i::self.fields] for i in range(self.fields)]
+            for pc, op, operand, target, address, value, acc, alu in zip(*columns):
+                if alu == 2:
+                    acc = flags = None
+                else:
+                    flags = alu | (2 if acc == 0 else 0) | (4 if acc >= half else 0)
+                yield TraceRecord(cycle, pc, op, operand, target, address, value, acc, flags)
+                cycle += 1
+    
+    
+    def __iter__(self):
+        return self.records()
+    
+    
+    # The numpy structured dtype of the arrays from `arrays()`, with a `cycle` field before the record fields
+    def dtype(self):
+        numpy = helpers.load_numpy("Reading a trace as arrays")
+        word = "<u{}".format(self.word_size)
+        return numpy.dtype([("cycle", "<u8")] + [(name, word) for name in engine.TraceFields])
+    
+    
+    # Yields every batch of records as a numpy structured array (the `alu` field is 2 while the ALU is unset)
+    def arrays(self, batch=DefaultBatch):
+        numpy = helpers.load_numpy("Reading a trace as arrays")
+        word = "<u{}".format(self.word_size)
+        raw = numpy.dtype([(name, word) for name in engine.TraceFields])
+        dtype = self.dtype()
+        for cycle, data in self.blocks(batch):
+            records = numpy.frombuffer(data, dtype=raw)
+            out = numpy.empty(len(records), dtype=dtype)
+            out["cycle"] = numpy.arange(cycle, cycle + len(records), dtype="<u8")
+            for name in engine.TraceFields:
+                out[name] = records[name]
+            yield out
+
+
+# Formats a trace record as a line of text
+def format_record(record):
+    return "{:>12} {:>6} {:>5} {:>6} {:>3} {:>6} {:>6} {:>6} {:>5}".format( record.cycle,
+                                                                             record.pc,
+                                                                             record.op,
+                                                                             record.operand,
+                                                                             TargetNames.get(record.target, "?"),
+                                                                             record.address,
+                                                                             record.value,
+                                                                             "-" if record.acc is None else record.acc,
+                                                                             "-" if record.flags is None else "{:03b}".format(record.flags) )
+# ~~~~~~~~ End Trace Reader Definition ~~~~~~~~
+
+
+# ~~~~~~~~ Begin Main Program ~~~~~~~~
+# Runs a program with tracing on, writing the trace to `file_out`
+def record(file_in, file_out, cycles, compression="none", batch=DefaultBatch):
+    # The emulator is only needed to run a program from the command line
+    import emulator
+    
+    emu = emulator.Emulator()
+    emu.load_program(file_in)
+    writer = emu.enable_tracing(file_out, compression, batch)
+    try:
+        emu.run(cycles, detect_halts=True)
+    finally:
+        emu.disable_tracing()
+    print("Traced {} instructions to \"{}\"".format(writer.count, file_out))
+    return 0
+
+
+# Prints the records of a trace file, starting at cycle `start`
+def show(file_in, start=0, limit=None):
+    reader = TraceReader(file_in)
+    print("{:>12} {:>6} {:>5} {:>6} {:>3} {:>6} {:>6} {:>6} {:>5}".format("cycle", "pc", "op", "opnd", "tgt", "addr", "value", "acc", "flags"))
+    shown = 0
+    for trace_record in reader.records():
+        if trace_record.cycle < start:
+            continue
+        if limit is not None and shown >= limit:
+            break
+        print(format_record(trace_record))
+        shown += 1
+    return 0
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        description="Records a trace of every instruction a FET-80 program runs, or prints a recorded trace",
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    argparser.add_argument("-f", "--file", type=helpers.file_path, default=None,
+        help="the .f80asm or .f80bin file to trace")
+    argparser.add_argument("-o", "--out", default=None,
+        help="the trace file to write")
+    argparser.add_argument("-c", "--cycles", type=int, default=1000000,
+        help="the most instructions to run (default: 1000000)")
+    argparser.add_argument("-z", "--compression", choices=Compressions.keys(), default="none",
+        help="how to compress the trace (default: none)")
+    argparser.add_argument("-b", "--batch", type=int, default=DefaultBatch,
+        help="the number of records to buffer between writes (default: {})".format(DefaultBatch))
+    argparser.add_argument("-r", "--read", type=helpers.file_path, default=None,
+        help="a trace file to print instead")
+    argparser.add_argument("-s", "--start", type=int, default=0,
+        help="the first cycle to print (default: 0)")
+    argparser.add_argument("-n", "--limit", type=int, default=None,
+        help="the most records to print")
+    args = vars(argparser.parse_args())
+    
+    # Run main
+    if args["read"] is not None:
+        exit_code = show(args["read"], args["start"], args["limit"])
+    elif args["file"] is not None and args["out"] is not None:
+        exit_code = record(args["file"], args["out"], args["cycles"], args["compression"], args["batch"])
+    else:
+        argparser.error("either --read, or both --file and --out, are needed")
+    sys.exit(exit_code)